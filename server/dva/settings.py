@@ -237,9 +237,10 @@ Q_EXTRACTOR = 'qextract'
 Q_STREAMER = 'qstreamer'
 Q_TRAINER = 'qtrainer'
 Q_LAMBDA = 'qlambda'
-GLOBAL_MODEL_FLASK_SERVER_PORT = 8989
 GLOBAL_MODEL = 'qglobal_model'  # if a model specific queue does not exists then this is where the task ends up
 GLOBAL_RETRIEVER = 'qglobal_retriever' # if a retriever specific queue does not exists then the task ends up here
+GLOBAL_MODEL_SERVERS = int(os.environ.get('GLOBAL_MODEL_SERVERS', 2))  # warm model server processes per global model worker
+GLOBAL_MODEL_SERVER_TIMEOUT = int(os.environ.get('GLOBAL_MODEL_SERVER_TIMEOUT', 300))  # seconds to load a model
 DEFAULT_REDUCER_TIMEOUT_SECONDS = 60 # Reducer tasks checks every 60 seconds if map tasks are finished.
 
 TASK_NAMES_TO_QUEUE = {
@@ -258,6 +259,7 @@ TASK_NAMES_TO_QUEUE = {
     "perform_import":Q_EXTRACTOR,
     "perform_stream_capture": Q_STREAMER,
     "perform_matching": Q_TRAINER,
+    "perform_index_compaction": Q_TRAINER,
     "perform_training": Q_TRAINER,
     "perform_reduce": Q_REDUCER,
     "perform_video_decode_lambda": Q_LAMBDA
@@ -269,7 +271,7 @@ RESTARTABLE_TASKS = {
         'delete_models':['IndexEntries',],
     },
     'perform_detection':{
-        'delete_models':['Region',]
+        'delete_models':['Region','IndexEntries']
     },
     'perform_analysis':{
         'delete_models':['Region',]
@@ -280,10 +282,14 @@ RESTARTABLE_TASKS = {
     'perform_video_decode':{
         'delete_models':['Frame',]
     },
+    'perform_index_compaction':{
+        'delete_models':['IndexShard',]
+    },
 }
 
 
-NON_PROCESSING_TASKS = {'perform_training','perform_training_set_creation','perform_deletion', 'perform_export'}
+NON_PROCESSING_TASKS = {'perform_training','perform_training_set_creation','perform_deletion', 'perform_export',
+                        'perform_index_compaction'}
 
 TRAINING_TASKS = {'perform_training','perform_training_set_creation'}
 
@@ -291,14 +297,37 @@ TRAINING_TASKS = {'perform_training','perform_training_set_creation'}
 KUBE_MODE = 'KUBE_MODE' in os.environ
 # How many video segments should we process at a time?
 DEFAULT_SEGMENTS_BATCH_SIZE = int(os.environ.get('DEFAULT_SEGMENTS_BATCH_SIZE',10))
+# How many frames decoded in memory should be sent to a detector at a time?
+DEFAULT_SEGMENT_DETECTION_BATCH_SIZE = int(os.environ.get('DEFAULT_SEGMENT_DETECTION_BATCH_SIZE',8))
+# How many segments should a decode task decode concurrently (one ffmpeg process each)?
+DEFAULT_DECODE_CONCURRENCY = int(os.environ.get('DEFAULT_DECODE_CONCURRENCY',1))
 # How many frames/images in a dataset should we process at a time?
 DEFAULT_FRAMES_BATCH_SIZE = int(os.environ.get('DEFAULT_FRAMES_BATCH_SIZE',500))
+# How many threads should read image sizes while a dataset zip is extracted?
+DEFAULT_EXTRACTION_CONCURRENCY = int(os.environ.get('DEFAULT_EXTRACTION_CONCURRENCY',4))
+# How many images of a framelist should a frame download task download concurrently?
+DEFAULT_DOWNLOAD_CONCURRENCY = int(os.environ.get('DEFAULT_DOWNLOAD_CONCURRENCY',8))
+# How many times should a failed download be retried, waiting DOWNLOAD_BACKOFF_SECONDS * 2^attempt in between?
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES',3))
+DOWNLOAD_BACKOFF_SECONDS = float(os.environ.get('DOWNLOAD_BACKOFF_SECONDS',1.0))
+# How many frames/regions should an analyzer process per model invocation?
+DEFAULT_ANALYSIS_BATCH_SIZE = int(os.environ.get('DEFAULT_ANALYSIS_BATCH_SIZE',32))
 # Default video decoding 1 frame per 30 frames AND all i-frames
 DEFAULT_RATE = int(os.environ.get('DEFAULT_RATE',30))
 # Max task attempts
 MAX_TASK_ATTEMPTS = 5
 # FAISS
 ENABLE_FAISS = 'DISABLE_FAISS' not in os.environ
+# Memory map exact retriever index files instead of reading them into each worker
+ENABLE_INDEX_MMAP = 'DISABLE_INDEX_MMAP' not in os.environ
+# Number of processes used to compute LOPQ codes for a batch of vectors
+LOPQ_CODE_PROCESSES = int(os.environ.get('LOPQ_CODE_PROCESSES', 4))
+# Memory (MB) a worker may use for loaded models before least recently used ones are evicted, 0 for no limit.
+# Models are measured when loaded unless their TrainedModel arguments declare memory_mb.
+MODEL_MEMORY_BUDGET = int(os.environ.get('MODEL_MEMORY_BUDGET_MB', 0)) * 1024 * 1024
+# Load and warm up the model of model specific (q_indexer_, q_detector_, q_analyzer_) workers when they start,
+# enabled by PRELOAD_MODELS=1 / true / yes
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', '').strip().lower() in ('1', 'true', 'yes')
 # Serializer version
 SERIALIZER_VERSION = "0.1"
 
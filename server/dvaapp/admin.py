@@ -1,7 +1,7 @@
 from django.contrib import admin
 from .models import Video, Frame, TEvent, IndexEntries, QueryResults, DVAPQL, Region, Tube, Segment, DeletedVideo, \
     ManagementAction, TrainedModel, Retriever, SystemState, Worker, QueryRegion, TrainingSet, Export, TaskRestart, \
-    RegionRelation, TubeRelation, TubeRegionRelation, HyperRegionRelation, HyperTubeRegionRelation
+    RegionRelation, TubeRelation, TubeRegionRelation, HyperRegionRelation, HyperTubeRegionRelation, IndexShard
 
 
 @admin.register(HyperRegionRelation)
@@ -89,6 +89,11 @@ class IndexEntriesAdmin(admin.ModelAdmin):
     pass
 
 
+@admin.register(IndexShard)
+class IndexShardAdmin(admin.ModelAdmin):
+    pass
+
+
 @admin.register(TEvent)
 class TEventAdmin(admin.ModelAdmin):
     pass
@@ -2,12 +2,16 @@ from django.conf import settings
 import os
 import shlex
 import boto3
+import botocore.exceptions
 import shutil
 import errno
 import logging
 import subprocess
+import threading
+import time
 import requests
 import urlparse
+from multiprocessing.pool import ThreadPool
 from dva.in_memory import redis_client
 
 try:
@@ -43,6 +47,11 @@ if 'DO_ACCESS_KEY_ID' in os.environ and 'DO_SECRET_ACCESS_KEY' and os.environ:
                                   aws_access_key_id=os.environ['DO_ACCESS_KEY_ID'],
                                   aws_secret_access_key=os.environ['DO_SECRET_ACCESS_KEY'])
 
+# Bytes written per read of an HTTP response
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Seconds to wait for an HTTP server to connect / send data
+DOWNLOAD_TIMEOUT = 60
+
 
 def cacheable(path):
     return path.startswith('/queries/') or '/segments/' in path or '/regions/' in path \
@@ -162,11 +171,12 @@ def ensure(path, dirnames=None, media_root=None, safe=False, event_id=None):
                 get_from_remote_fs(src, path, dlpath, original_path, safe)
 
 
-def get_path_to_file(path, local_path):
+def get_path_to_file(path, local_path, session=None):
     """
     # resource.meta.client.download_file(bucket, key, ofname, ExtraArgs={'RequestPayer': 'requester'})
     :param remote_path: e.g. s3://bucket/asd/asdsad/key.zip or gs:/bucket_name/key .. or /
     :param local_path:
+    :param session: requests.Session used for http(s) paths so that connections are reused
     :return:
     """
     if settings.ENABLE_CLOUDFS and path.startswith('/ingest/'):
@@ -184,22 +194,26 @@ def get_path_to_file(path, local_path):
         shutil.move(path, local_path)
     elif path.startswith('http'):
         u = urlparse.urlparse(path)
+        requester = requests if session is None else session
         if u.hostname == 'www.dropbox.com' and not path.endswith('?dl=1'):
-            r = requests.get(path + '?dl=1')
+            r = requester.get(path + '?dl=1', timeout=DOWNLOAD_TIMEOUT)
         else:
-            r = requests.get(path, stream=True)
-        with open(local_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-        r.close()
+            r = requester.get(path, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        try:
+            r.raise_for_status()
+            with open(local_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+        finally:
+            r.close()
     elif path.endswith('/'):
         raise NotImplementedError("Importing directories disabled {}".format(path))
     elif path.startswith('s3'):
         bucket_name = path[5:].split('/')[0]
         key = '/'.join(path[5:].split('/')[1:])
-        remote_bucket = S3.Bucket(bucket_name)
-        remote_bucket.download_file(key, local_path)
+        # the client is thread safe and keeps its connection pool across calls, unlike resources
+        S3.meta.client.download_file(bucket_name, key, local_path)
     elif path.startswith('gs'):
         bucket_name = path[5:].split('/')[0]
         key = '/'.join(path[5:].split('/')[1:])
@@ -214,6 +228,92 @@ def get_path_to_file(path, local_path):
         raise NotImplementedError("Unknown file system {}".format(path))
 
 
+
+class Downloader(object):
+    """
+    Download files with up to concurrency threads. Each thread keeps a requests.Session, so HTTP connections are
+    pooled per host, S3 downloads share the thread safe client of S3. Downloads that fail with a transient error
+    (see is_transient_error) are retried after backoff, 2 * backoff, ... seconds, other errors are raised at once.
+    """
+
+    def __init__(self, concurrency, retries, backoff):
+        self.concurrency = max(int(concurrency), 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'failed': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0}
+
+    def get_session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+            self.local.session.mount('http://', adapter)
+            self.local.session.mount('https://', adapter)
+        return self.local.session
+
+    def download(self, path, local_path):
+        attempt = 0
+        while True:
+            try:
+                get_path_to_file(path, local_path, session=self.get_session())
+            except Exception as e:
+                if attempt >= self.retries or not is_transient_error(e):
+                    raise
+                with self.lock:
+                    self.stats['retries'] += 1
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+            else:
+                with self.lock:
+                    self.stats['downloaded'] += 1
+                    self.stats['bytes'] += os.path.getsize(local_path)
+                return local_path
+
+    def download_all(self, items, process=None):
+        """
+        :param items: list of (path, local_path)
+        :param process: called with local_path in the downloading thread once the file is downloaded
+        :return: list of the results of process (local_path if process is None) in the order of items, None for
+        items that failed
+        """
+        def run(item):
+            path, local_path = item
+            try:
+                self.download(path, local_path)
+                return local_path if process is None else process(local_path)
+            except Exception:
+                logging.exception("Failed to get {}".format(path))
+                with self.lock:
+                    self.stats['failed'] += 1
+                return None
+        start = time.time()
+        pool = ThreadPool(self.concurrency)
+        try:
+            results = pool.map(run, items, chunksize=1)
+        finally:
+            pool.terminate()
+        self.stats['seconds'] += time.time() - start
+        logging.info("downloaded {downloaded} files ({bytes} bytes) in {seconds:.1f}s with {retries} retries, "
+                     "{failed} failed".format(**self.stats))
+        return results
+
+
+def is_transient_error(e):
+    """
+    :return: True for connection errors, timeouts, throttling (429) and server (5xx) errors of HTTP and S3 downloads
+    """
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    elif isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    elif isinstance(e, botocore.exceptions.ClientError):
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        code = e.response.get('Error', {}).get('Code')
+        return status == 429 or status >= 500 or code in ('Throttling', 'SlowDown')
+    return isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError))
+
+
 def upload_file_to_path(local_path, remote_path):
     fs_type = remote_path[:2]
     bucket_name = remote_path[5:].split('/')[0]
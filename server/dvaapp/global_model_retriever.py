@@ -1,12 +1,11 @@
-import subprocess,os,requests, signal, time
+import subprocess, os, logging, tempfile, time, atexit
+from collections import OrderedDict
+from multiprocessing.connection import Client
 from django.conf import settings
 from . import processing
 from .models import TrainedModel
 from dva.celery import app
 
-GLOBAL_FLASK_SERVER_PROCESS = None
-LAST_GLOBAL_QUEUE_NAME = None
-
 
 def defer(start):
     """
@@ -26,15 +25,13 @@ def defer(start):
     return False
 
 
-def run_task_in_new_process(start):
+def get_model_envs(trained_model):
     """
-    Run in a new process,
-    TODO: Make sure that the new process has correct environment variable mode.
-    E.g. TF or PyTorch, otherwise it won't be able to import necessary library
-    :param start:
+    Environment with the mode (TF / PyTorch / Caffe / MXNet) of the model set so that the new process is able to
+    import the necessary library.
+    :param trained_model:
     :return:
     """
-    trained_model = TrainedModel.objects.get(pk=processing.get_model_pk_from_args(start.operation,start.arguments))
     new_envs = os.environ.copy()
     for k in {'PYTORCH_MODE','CAFFE_MODE','MXNET_MODE'}:
         if k in new_envs:
@@ -45,55 +42,125 @@ def run_task_in_new_process(start):
         new_envs['CAFFE_MODE'] = '1'
     elif trained_model.mode == TrainedModel.MXNET:
         new_envs['MXNET_MODE'] = '1'
-    s = subprocess.Popen(['python', 'scripts/run_task.py', start.operation, str(start.pk)],env=new_envs)
+    return new_envs
+
+
+def run_task_in_new_process(start):
+    """
+    Run in a new process
+    :param start:
+    :return:
+    """
+    trained_model = TrainedModel.objects.get(pk=processing.get_model_pk_from_args(start.operation,start.arguments))
+    s = subprocess.Popen(['python', 'scripts/run_task.py', start.operation, str(start.pk)],
+                         env=get_model_envs(trained_model))
     s.wait()
     if s.returncode != 0:
         raise ValueError("run_task.py failed")
     return True
 
 
-def run_task_in_model_specific_flask_server(start):
+class ModelServers(object):
+    """
+    Pool of model server processes (scripts/run_model_server.py) owned by this worker, one per (TrainedModel pk, mode).
+    Each server loads its model once and then processes tasks sent to it over a unix socket, so tasks for models
+    that were used recently do not pay for process startup and model loading. At most settings.GLOBAL_MODEL_SERVERS
+    servers are kept, the least recently used one is stopped to make room for a new one.
+    """
+    _servers = OrderedDict()  # (pk, mode) -> (process, socket path), least recently used first
+
+    @classmethod
+    def get_server(cls, trained_model):
+        key = (trained_model.pk, trained_model.mode)
+        if key in cls._servers:
+            process, socket_path = cls._servers.pop(key)
+            if process.poll() is None:
+                cls._servers[key] = (process, socket_path)
+                return socket_path
+            logging.warning("Model server for {} exited with {}, restarting".format(key, process.returncode))
+            cls.remove_socket(socket_path)
+        while len(cls._servers) >= max(settings.GLOBAL_MODEL_SERVERS, 1):
+            cls.stop_server(next(iter(cls._servers)))
+        socket_path = os.path.join(tempfile.gettempdir(), 'dva_model_server_{}_{}_{}.sock'.format(
+            os.getpid(), trained_model.pk, trained_model.mode))
+        cls.remove_socket(socket_path)
+        process = subprocess.Popen(['python', 'scripts/run_model_server.py', socket_path, str(trained_model.pk)],
+                                   env=get_model_envs(trained_model))
+        cls._servers[key] = (process, socket_path)
+        cls.wait_until_ready(key)
+        return socket_path
+
+    @classmethod
+    def wait_until_ready(cls, key):
+        """
+        The server starts listening only after loading its model, wait until the socket accepts connections.
+        """
+        process, socket_path = cls._servers[key]
+        deadline = time.time() + settings.GLOBAL_MODEL_SERVER_TIMEOUT
+        while time.time() < deadline:
+            if process.poll() is not None:
+                cls._servers.pop(key)
+                cls.remove_socket(socket_path)
+                raise ValueError("Model server for {} exited with {}".format(key, process.returncode))
+            if os.path.exists(socket_path):
+                try:
+                    Client(socket_path, family='AF_UNIX', authkey=settings.SECRET_KEY).close()
+                    return
+                except:
+                    pass
+            time.sleep(0.5)
+        cls.stop_server(key)
+        raise ValueError("Model server for {} did not start in {} seconds".format(key,
+                                                                                  settings.GLOBAL_MODEL_SERVER_TIMEOUT))
+
+    @classmethod
+    def stop_server(cls, key):
+        process, socket_path = cls._servers.pop(key)
+        if process.poll() is None:
+            logging.info("Stopping model server for {}".format(key))
+            process.terminate()
+            process.wait()
+        cls.remove_socket(socket_path)
+
+    @classmethod
+    def stop_all(cls):
+        for key in list(cls._servers):
+            cls.stop_server(key)
+
+    @staticmethod
+    def remove_socket(socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    @classmethod
+    def run(cls, start, trained_model):
+        """
+        :return: value returned by the task handler in the model server
+        """
+        socket_path = cls.get_server(trained_model)
+        try:
+            conn = Client(socket_path, family='AF_UNIX', authkey=settings.SECRET_KEY)
+            try:
+                conn.send(start.pk)
+                status, result = conn.recv()
+            finally:
+                conn.close()
+        except (EOFError, IOError):
+            cls.stop_server((trained_model.pk, trained_model.mode))
+            raise ValueError("Model server for {} died while processing {}".format(trained_model.pk, start.pk))
+        if status != 'ok':
+            raise ValueError("Could not process {} : {}".format(start.pk, result))
+        return result
+
+
+atexit.register(ModelServers.stop_all)
+
+
+def run_task_in_model_server(start):
     """
-    Run in a new flask server,
+    Run in a warm model server
     :param start:
-    :return:
+    :return: value returned by the task handler
     """
-    global GLOBAL_FLASK_SERVER_PROCESS
-    global LAST_GLOBAL_QUEUE_NAME
-    model_specific_queue_name = processing.get_model_specific_queue_name(start.operation, start.arguments)
     trained_model = TrainedModel.objects.get(pk=processing.get_model_pk_from_args(start.operation,start.arguments))
-    new_envs = os.environ.copy()
-    for k in {'PYTORCH_MODE','CAFFE_MODE','MXNET_MODE'}:
-        if k in new_envs:
-            del new_envs[k]
-    if trained_model.mode == TrainedModel.PYTORCH:
-        new_envs['PYTORCH_MODE'] = '1'
-    elif trained_model.mode == TrainedModel.CAFFE:
-        new_envs['CAFFE_MODE'] = '1'
-    elif trained_model.mode == TrainedModel.MXNET:
-        new_envs['MXNET_MODE'] = '1'
-    if GLOBAL_FLASK_SERVER_PROCESS is None or LAST_GLOBAL_QUEUE_NAME != model_specific_queue_name:
-        if GLOBAL_FLASK_SERVER_PROCESS:
-            GLOBAL_FLASK_SERVER_PROCESS.terminate()
-            os.remove('flask.pid')
-        elif os.path.isfile('flask.pid'):
-            try:
-                os.kill(int(file('flask.pid').read()),signal.SIGTERM)
-            except:
-                pass
-        GLOBAL_FLASK_SERVER_PROCESS = subprocess.Popen(['python', 'scripts/run_flask.py',
-                                                        start.operation, str(start.pk)],env=new_envs)
-        LAST_GLOBAL_QUEUE_NAME = model_specific_queue_name
-        max_attempts = 15
-        while max_attempts:
-            try:
-                r = requests.get('http://localhost:{port}/'.format(port=settings.GLOBAL_MODEL_FLASK_SERVER_PORT))
-                if r.ok:
-                    break
-            except:
-                max_attempts -= 1
-                time.sleep(4)
-    r = requests.get('http://localhost:{port}/{pk}/'.format(port=settings.GLOBAL_MODEL_FLASK_SERVER_PORT,pk=start.pk))
-    if not r.ok:
-        raise ValueError("Coud not process")
-    return True
+    return ModelServers.run(start, trained_model)
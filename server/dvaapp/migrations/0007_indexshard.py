@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dvaapp', '0006_remove_region_materialized'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('algorithm', models.CharField(max_length=100)),
+                ('indexer_shasum', models.CharField(max_length=40)),
+                ('approximator_shasum', models.CharField(max_length=40, null=True)),
+                ('count', models.IntegerField()),
+                ('index_entries_count', models.IntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='date created')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dvaapp.TEvent')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='indexentries',
+            name='shard',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='dvaapp.IndexShard'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dvaapp', '0007_indexshard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='worker',
+            name='warmup_time',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 16:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dvaapp', '0008_worker_warmup_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='frame',
+            name='scale',
+            field=models.FloatField(default=1.0),
+        ),
+    ]
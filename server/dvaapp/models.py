@@ -4,6 +4,8 @@ import os, json, gzip, sys, shutil, zipfile, uuid, hashlib
 sys.path.append(os.path.join(os.path.dirname(__file__),
                              "../../client/"))  # This ensures that the constants are same between client and server
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.conf import settings
@@ -37,6 +39,7 @@ class Worker(models.Model):
     alive = models.BooleanField(default=True)
     last_ping = models.DateTimeField('date last ping', null=True)
     created = models.DateTimeField('date created', auto_now_add=True)
+    warmup_time = models.FloatField(null=True)
 
 
 class DVAPQL(models.Model):
@@ -342,6 +345,7 @@ class Frame(models.Model):
     t = models.FloatField(null=True)  # time in seconds for keyframes
     keyframe = models.BooleanField(default=False)  # is this a key frame for a video?
     segment_index = models.IntegerField(null=True)
+    scale = models.FloatField(default=1.0)  # w / original width, divide coordinates by it to map back to the video
 
     class Meta:
         unique_together = (("video", "frame_index"),)
@@ -540,6 +544,8 @@ class IndexEntries(models.Model):
     contains_detections = models.BooleanField(default=False)
     created = models.DateTimeField('date created', auto_now_add=True)
     event = models.ForeignKey(TEvent)
+    # Set once the vectors have been compacted into a shard, the original features file is retained.
+    shard = models.ForeignKey('IndexShard', null=True, on_delete=models.SET_NULL)
 
     def __unicode__(self):
         return "{} in {} index by {}".format(self.detection_name, self.algorithm, self.video.name)
@@ -550,7 +556,13 @@ class IndexEntries(models.Model):
         else:
             return "{}/{}/indexes/{}".format(settings.MEDIA_ROOT, self.video_id, self.features_file_name)
 
-    def load_index(self, media_root=None):
+    def load_index(self, media_root=None, mmap=False):
+        """
+        :param media_root:
+        :param mmap: memory map .npy files read-only instead of reading them, so that processes on the same host
+        share the page cache and pages are only read when accessed.
+        :return: vectors (or path to the index file) and entries
+        """
         if media_root is None:
             media_root = settings.MEDIA_ROOT
         video_dir = "{}/{}".format(media_root, self.video_id)
@@ -563,14 +575,78 @@ class IndexEntries(models.Model):
         if self.features_file_name.strip():
             fs.ensure(self.npy_path(media_root=''), dirnames, media_root)
             if self.features_file_name.endswith('.npy'):
-                vectors = np.load(self.npy_path(media_root))
+                vectors = np.load(self.npy_path(media_root), mmap_mode='r' if mmap else None)
+            elif self.features_file_name.endswith('.npz'):
+                # LOPQ coarse / fine codes
+                with np.load(self.npy_path(media_root)) as codes:
+                    vectors = {k: codes[k] for k in codes.files}
             else:
                 vectors = self.npy_path(media_root)
         else:
             vectors = None
+        # Entries created before video_primary_key was recorded only carry frame / detection keys.
+        for entry in self.entries:
+            entry.setdefault('video_primary_key', self.video_id)
         return vectors, self.entries
 
 
+class IndexShard(models.Model):
+    """
+    Vectors of several IndexEntries sharing indexer / approximator compacted into a single contiguous .npy file,
+    along with a companion JSON file containing the concatenated entries.
+    """
+    uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    algorithm = models.CharField(max_length=100)
+    indexer_shasum = models.CharField(max_length=40)
+    approximator_shasum = models.CharField(max_length=40, null=True)
+    count = models.IntegerField()
+    index_entries_count = models.IntegerField()
+    created = models.DateTimeField('date created', auto_now_add=True)
+    event = models.ForeignKey(TEvent)
+
+    def __unicode__(self):
+        return "{} shard {} with {} vectors".format(self.algorithm, self.uuid, self.count)
+
+    def npy_path(self, media_root=None):
+        if media_root is None:
+            media_root = settings.MEDIA_ROOT
+        return "{}/shards/{}.npy".format(media_root, self.uuid)
+
+    def entries_path(self, media_root=None):
+        if media_root is None:
+            media_root = settings.MEDIA_ROOT
+        return "{}/shards/{}.json".format(media_root, self.uuid)
+
+    def load_index(self, media_root=None, mmap=False):
+        if media_root is None:
+            media_root = settings.MEDIA_ROOT
+        dirnames = {}
+        fs.ensure(self.npy_path(media_root=''), dirnames, media_root)
+        fs.ensure(self.entries_path(media_root=''), dirnames, media_root)
+        vectors = np.load(self.npy_path(media_root), mmap_mode='r' if mmap else None)
+        with open(self.entries_path(media_root)) as entries_file:
+            entries = json.load(entries_file)
+        return vectors, entries
+
+
+@receiver(post_delete, sender=IndexEntries)
+def delete_index_entries_shard(sender, instance, **kwargs):
+    """
+    A shard is only valid while all of its IndexEntries exist, deleting any of them (e.g. by deleting a video) deletes
+    the shard, which resets shard on the remaining IndexEntries so that the next compaction rebuilds them.
+    """
+    if instance.shard_id is not None:
+        for ds in IndexShard.objects.filter(pk=instance.shard_id):
+            ds.delete()
+
+
+@receiver(post_delete, sender=IndexShard)
+def delete_index_shard_files(sender, instance, **kwargs):
+    for path in [instance.npy_path(), instance.entries_path()]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
 class Tube(models.Model):
     """
     A tube is a collection of sequential frames / regions that track a certain object
@@ -1,5 +1,6 @@
 import logging
 from django.conf import settings
+from .runtime import ModelRuntime, get_declared_memory
 
 try:
     from dvalib import analyzer
@@ -22,4 +23,6 @@ class Analyzers(object):
             elif da.algorithm == 'location_net':
                 Analyzers._analyzers[da.name] = analyzer.LocationNet(aroot + "{}/".format(da.uuid),epoch=da.argumets['epoch'])
             else:
-                raise ValueError,"analyzer by id {} not found".format(da.pk)
\ No newline at end of file
+                raise ValueError,"analyzer by id {} not found".format(da.pk)
+        return ModelRuntime.acquire(('analyzer', da.pk), Analyzers._analyzers[da.name],
+                                    memory=get_declared_memory(da))
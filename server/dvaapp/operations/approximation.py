@@ -65,13 +65,15 @@ class Approximators(object):
             approx_ind = IndexEntries()
             vectors, entries = index_entry.load_index()
             if da.algorithm == 'LOPQ':
-                for i, e in enumerate(entries):
-                    e['codes'] = approx.approximate(vectors[i, :])
+                coarse, fine = approx.approximate_batch(np.atleast_2d(vectors.squeeze()),
+                                                        num_procs=settings.LOPQ_CODE_PROCESSES)
+                codes_fname = "{}/{}/indexes/{}.npz".format(settings.MEDIA_ROOT, index_entry.video_id, uid)
+                with open(codes_fname, 'w') as codesfile:
+                    np.savez(codesfile, coarse=coarse, fine=fine)
+                approx_ind.features_file_name = "{}.npz".format(uid)
                 approx_ind.entries = entries
-                approx_ind.features_file_name = ""
             elif da.algorithm == 'PCA':
-                # TODO optimize this by doing matmul rather than calling for each entry
-                approx_vectors = np.array([approx.approximate(vectors[i, :]) for i, e in enumerate(entries)])
+                approx_vectors = approx.approximate_batch(np.atleast_2d(vectors.squeeze()))
                 feat_fname = "{}/{}/indexes/{}.npy".format(settings.MEDIA_ROOT, index_entry.video_id, uid)
                 with open(feat_fname, 'w') as featfile:
                     np.save(featfile, approx_vectors)
@@ -0,0 +1,105 @@
+import logging, json, os
+from django.conf import settings
+from django.db import transaction
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logging.warning("Could not import numpy assuming running in front-end mode")
+
+from ..models import IndexEntries, IndexShard
+from .. import fs
+
+# Default maximum number of vectors in a single shard file
+DEFAULT_MAX_SHARD_ROWS = 1000000
+
+
+def get_compactable_queryset(indexer_shasum, approximator_shasum=None, filters=None):
+    """
+    Completed, non-empty IndexEntries with vectors stored in .npy files that are not yet part of a shard.
+    LOPQ codes are stored in .npz files (or entries) and FAISS indexes in .index files, neither benefit from
+    compaction.
+    """
+    kwargs = dict(filters) if filters else {}
+    kwargs['event__completed'] = True
+    kwargs['shard__isnull'] = True
+    kwargs['count__gt'] = 0
+    kwargs['features_file_name__endswith'] = '.npy'
+    kwargs['indexer_shasum'] = indexer_shasum
+    kwargs['approximator_shasum'] = approximator_shasum
+    return IndexEntries.objects.filter(**kwargs).order_by('pk')
+
+
+def build_shard(index_entries, event):
+    """
+    Concatenate vectors and entries of index_entries into a new shard and mark them as compacted. The shard keeps
+    the dtype of the source vectors, IndexEntries with different dtypes or dimensions cannot share a shard.
+    """
+    shard = IndexShard()
+    shard_dir = "{}/shards/".format(settings.MEDIA_ROOT)
+    if not os.path.isdir(shard_dir):
+        try:
+            os.mkdir(shard_dir)
+        except OSError:
+            pass
+    sources = []
+    for di in index_entries:
+        vectors, entries = di.load_index(mmap=True)
+        vectors = np.atleast_2d(vectors.squeeze())
+        if vectors.shape[0] != len(entries):
+            raise ValueError("IndexEntries {} has {} vectors but {} entries".format(di.pk, vectors.shape[0],
+                                                                                    len(entries)))
+        if sources and (vectors.dtype != sources[0][0].dtype or vectors.shape[1] != sources[0][0].shape[1]):
+            raise ValueError("IndexEntries {} has {} {} vectors but IndexEntries {} has {} {} vectors".format(
+                di.pk, vectors.shape[1], vectors.dtype, index_entries[0].pk, sources[0][0].shape[1],
+                sources[0][0].dtype))
+        sources.append((vectors, entries))
+    shard_vectors = np.lib.format.open_memmap(shard.npy_path(), mode='w+', dtype=sources[0][0].dtype,
+                                              shape=(sum(v.shape[0] for v, _ in sources), sources[0][0].shape[1]))
+    shard_entries = []
+    offset = 0
+    for vectors, entries in sources:
+        shard_vectors[offset:offset + vectors.shape[0]] = vectors
+        offset += vectors.shape[0]
+        shard_entries.extend(entries)
+    shard_vectors.flush()
+    del shard_vectors
+    with open(shard.entries_path(), 'w') as entries_file:
+        json.dump(shard_entries, entries_file)
+    if settings.ENABLE_CLOUDFS:
+        fs.upload_file_to_remote(shard.npy_path(media_root=''), cache=False)
+        fs.upload_file_to_remote(shard.entries_path(media_root=''), cache=False)
+    first = index_entries[0]
+    shard.algorithm = first.algorithm
+    shard.indexer_shasum = first.indexer_shasum
+    shard.approximator_shasum = first.approximator_shasum
+    shard.count = offset
+    shard.index_entries_count = len(index_entries)
+    shard.event = event
+    with transaction.atomic():
+        shard.save()
+        IndexEntries.objects.filter(pk__in=[di.pk for di in index_entries]).update(shard=shard)
+    logging.info("Compacted {} IndexEntries into shard {} with {} vectors".format(len(index_entries), shard.pk,
+                                                                                   offset))
+    return shard
+
+
+def compact_index_entries(event, indexer_shasum, approximator_shasum=None, filters=None,
+                          max_shard_rows=DEFAULT_MAX_SHARD_ROWS, min_index_entries=2):
+    """
+    Merge IndexEntries into shards of at most max_shard_rows vectors, groups with fewer than min_index_entries
+    entries are left as they are.
+    """
+    shards = []
+    group, group_rows = [], 0
+    for di in get_compactable_queryset(indexer_shasum, approximator_shasum, filters):
+        if group and group_rows + di.count > max_shard_rows:
+            if len(group) >= min_index_entries:
+                shards.append(build_shard(group, event))
+            group, group_rows = [], 0
+        group.append(di)
+        group_rows += di.count
+    if len(group) >= min_index_entries:
+        shards.append(build_shard(group, event))
+    return shards
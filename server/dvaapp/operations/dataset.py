@@ -1,7 +1,13 @@
-import os,zipfile,logging
+import os,zipfile,logging,shutil,struct
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
 from PIL import Image
 from ..models import Frame, Region
 
+# Start of frame markers of baseline, progressive, lossless and arithmetic coded jpegs
+JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+COPY_BUFFER_SIZE = 1024 * 1024
+
 
 class DatasetCreator(object):
     """
@@ -21,48 +27,66 @@ class DatasetCreator(object):
         self.segment_frames_dict = {}
         self.csv_format = None
 
-    def extract(self,extract_event):
-        self.extract_zip_dataset(extract_event)
+    def extract(self,extract_event,batch_size=settings.DEFAULT_FRAMES_BATCH_SIZE,concurrency=1,batch_callback=None):
+        self.extract_zip_dataset(extract_event,batch_size,concurrency,batch_callback)
         os.remove("{}/{}/video/{}.zip".format(self.media_dir, self.primary_key, self.primary_key))
 
-    def extract_zip_dataset(self,event):
+    def extract_zip_dataset(self,event,batch_size=settings.DEFAULT_FRAMES_BATCH_SIZE,concurrency=1,batch_callback=None):
+        """
+        Stream members of the zip in order directly to frames/<i>.jpg, image sizes are read from the jpeg headers by
+        a pool of concurrency threads while the following members are written. Frames and Regions are created every
+        batch_size images so that memory use does not depend on the size of the dataset.
+        :param batch_callback: called with (first frame index, last frame index + 1) once Frames and Regions of a batch
+        are created
+        """
+        frames_dir = "{}/{}/frames".format(self.media_dir, self.primary_key)
         zipf = zipfile.ZipFile("{}/{}/video/{}.zip".format(self.media_dir, self.primary_key, self.primary_key), 'r')
-        zipf.extractall("{}/{}/frames/".format(self.media_dir, self.primary_key))
-        zipf.close()
+        pool = ThreadPool(max(int(concurrency), 1))
         i = 0
-        df_list = []
-        root_length = len("{}/{}/frames/".format(self.media_dir, self.primary_key))
-        for subdir, dirs, files in os.walk("{}/{}/frames/".format(self.media_dir, self.primary_key)):
-            if '__MACOSX' not in subdir:
-                for ofname in files:
-                    fname = os.path.join(subdir, ofname)
-                    if fname.endswith('jpg') or fname.endswith('jpeg'):
-                        i += 1
-                        try:
-                            im = Image.open(fname)
-                            w, h = im.size
-                        except IOError:
-                            logging.info("Could not open {} skipping".format(fname))
-                        else:
-                            dst = "{}/{}/frames/{}.jpg".format(self.media_dir, self.primary_key, i)
-                            os.rename(fname, dst)
-                            df = Frame()
-                            df.frame_index = i
-                            df.video_id = self.dvideo.pk
-                            df.h = h
-                            df.w = w
-                            df.event_id = event.pk
-                            df.name = os.path.join(subdir[root_length:], ofname)
-                            if not df.name.startswith('/'):
-                                df.name = "/{}".format(df.name)
-                            df_list.append(df)
+        batch = []
+        self.dvideo.frames = 0
+        try:
+            for member in zipf.infolist():
+                fname = member.filename
+                if fname.endswith('/'):
+                    continue
+                elif '__MACOSX' in fname:
+                    logging.warning("skipping {} ".format(fname))
+                elif fname.endswith('jpg') or fname.endswith('jpeg'):
+                    i += 1
+                    dst = "{}/{}.jpg".format(frames_dir, i)
+                    with zipf.open(member) as src, open(dst, 'wb') as out:
+                        shutil.copyfileobj(src, out, COPY_BUFFER_SIZE)
+                    batch.append((i, fname, dst, pool.apply_async(get_image_size, (dst,))))
+                    if len(batch) >= batch_size:
+                        self.create_frames(event, batch, batch_callback)
+                        batch = []
+                else:
+                    logging.warning("skipping {} not a jpeg file".format(fname))
+            if batch:
+                self.create_frames(event, batch, batch_callback)
+        finally:
+            pool.terminate()
+            zipf.close()
 
-                    else:
-                        logging.warning("skipping {} not a jpeg file".format(fname))
+    def create_frames(self,event,batch,batch_callback=None):
+        """
+        :param batch: list of (frame index, name in the zip, path, async result of get_image_size)
+        """
+        df_list = []
+        for i, fname, dst, size in batch:
+            size = size.get()
+            if size is None:
+                logging.info("Could not open {} skipping".format(fname))
+                os.remove(dst)
             else:
-                logging.warning("skipping {} ".format(subdir))
-        self.dvideo.frames = len(df_list)
-        self.dvideo.save()
+                df = Frame()
+                df.frame_index = i
+                df.video_id = self.dvideo.pk
+                df.w, df.h = size
+                df.event_id = event.pk
+                df.name = fname if fname.startswith('/') else "/{}".format(fname)
+                df_list.append(df)
         df_ids = Frame.objects.bulk_create(df_list,batch_size=1000)
         regions = []
         for i,f in enumerate(df_list):
@@ -79,3 +103,35 @@ class DatasetCreator(object):
                 a.event_id = event.pk
                 regions.append(a)
         Region.objects.bulk_create(regions, batch_size=1000)
+        self.dvideo.frames += len(df_list)
+        self.dvideo.save()
+        if batch_callback is not None:
+            batch_callback(batch[0][0], batch[-1][0] + 1)
+
+
+def get_image_size(path):
+    """
+    Read the size of a jpeg from its start of frame segment without decoding the image, files that cannot be parsed
+    are opened with PIL.
+    :return: (width, height) or None if path is not an image
+    """
+    try:
+        with open(path, 'rb') as fh:
+            if fh.read(2) == '\xff\xd8':
+                while fh.read(1) == '\xff':
+                    marker = fh.read(1)
+                    while marker == '\xff':  # fill bytes
+                        marker = fh.read(1)
+                    if not marker:
+                        break
+                    marker = ord(marker)
+                    if marker == 0x01 or 0xd0 <= marker <= 0xd8:  # markers without a length
+                        continue
+                    length = struct.unpack('>H', fh.read(2))[0]
+                    if marker in JPEG_SOF_MARKERS:
+                        height, width = struct.unpack('>xHH', fh.read(5))
+                        return width, height
+                    fh.seek(length - 2, 1)
+        return Image.open(path).size
+    except (IOError, struct.error):
+        return None
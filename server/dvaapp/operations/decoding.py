@@ -1,17 +1,37 @@
-import time
+import time, re, bisect, math
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 import shlex,json,os, logging
 import subprocess as sp
 from PIL import Image
 from ..models import Frame, Segment
 
+try:
+    import numpy as np
+except ImportError:
+    pass
+
+SAMPLE_RATE = 'rate'  # every rate-th frame and I-frames
+SAMPLE_KEYFRAMES = 'keyframes'  # keyframes only, other frames are not decoded
+SAMPLE_SCENE = 'scene'  # frames whose scene change score is above a threshold
+SAMPLE_FPS = 'fps'  # fixed number of frames per second of video
+DEFAULT_SCENE_THRESHOLD = 0.3
+SEGMENT_TIME_TOLERANCE = 1e-4  # segments.csv times are rounded to microseconds
+SHOWINFO_PTS_TIME = re.compile(r'Parsed_showinfo.*pts_time:\s*(-?[0-9.]+)')
+
 
 class VideoDecoder(object):
     """
     Wrapper object for a video / dataset
     """
 
-    def __init__(self,dvideo,media_dir):
+    def __init__(self,dvideo,media_dir,rescale=0):
+        """
+        :param rescale: when set frames are downscaled while decoding so that their larger side is at most rescale
+        pixels, aspect ratio is preserved and frames are never upscaled
+        """
         self.dvideo = dvideo
+        self.rescale = int(rescale) if rescale else 0
         self.primary_key = self.dvideo.pk
         self.media_dir = media_dir
         self.local_path = dvideo.path()
@@ -21,45 +41,28 @@ class VideoDecoder(object):
         self.height = None
         self.metadata = {}
         self.segment_frames_dict = {}
-        self.csv_format = None
-
-    def detect_csv_segment_format(self):
-        format_path = "{}format.txt".format(self.segments_dir)
-        self.csv_format = {}
-        if not os.path.isfile(format_path):
-            command ="ffprobe -i {}0.mp4 -show_frames -select_streams v:0 -print_format csv=nokey=0".format(self.segments_dir)
-            csv_format_lines = sp.check_output(shlex.split(command))
-            with open(format_path,'w') as formatfile:
-                formatfile.write(csv_format_lines)
-            logging.info("Generated csv format {}".format(self.csv_format))
-        for line in file(format_path).read().splitlines():
-            if line.strip():
-                for i,kv in enumerate(line.strip().split(',')):
-                    if '=' in kv:
-                        k,v = kv.strip().split('=')
-                        self.csv_format[k] = i
-                    else:
-                        self.csv_format[kv] = i
-                break
-        self.field_count = len(self.csv_format)
-        self.pict_type_index = self.csv_format['pict_type']
-        self.time_index = self.csv_format['best_effort_timestamp_time']
-
-    def parse_segment_framelist(self,segment_id, framelist):
-        if self.csv_format is None:
-            self.detect_csv_segment_format()
-        frames = {}
-        findex = 0
-        for line in framelist.splitlines():
-            if line.strip():
-                entries = line.strip().split(',')
-                if len(entries) == self.field_count:
-                    frames[findex] = (entries[self.pict_type_index],float(entries[self.time_index]))
-                    findex += 1
-                else:
-                    errro_message = "format used {} \n {} (expected) != {} entries in {} \n {} ".format(self.csv_format,self.field_count,len(entries),segment_id, line)
-                    logging.error(errro_message)
-                    raise ValueError, errro_message
+        self.display_size = None
+
+    def get_framelist(self):
+        """
+        Probe frames of the video stream once for the whole video.
+        :return: list of (pict_type, time, key_frame, packet position or None) in presentation order
+        """
+        command = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-show_entries',
+                   'frame=key_frame,pict_type,best_effort_timestamp_time,pkt_pos', '-print_format', 'csv=nokey=0',
+                   self.local_path]
+        logging.info(" ".join(command))
+        probe = sp.Popen(command, stdout=sp.PIPE)
+        frames = []
+        for line in probe.stdout:
+            if line.startswith('frame'):
+                fields = dict(kv.split('=', 1) for kv in line.strip().split(',') if '=' in kv)
+                pkt_pos = fields.get('pkt_pos', 'N/A')
+                frames.append((fields['pict_type'], float(fields['best_effort_timestamp_time']),
+                               fields.get('key_frame') == '1', int(pkt_pos) if pkt_pos.isdigit() else None))
+        probe.wait()
+        if probe.returncode != 0:
+            raise ValueError, "{} : ffprobe exited with {}".format(self.local_path, probe.returncode)
         return frames
 
     def get_metadata(self):
@@ -80,17 +83,84 @@ class VideoDecoder(object):
         self.dvideo.width = self.width
         self.dvideo.save()
 
-    def decode_segment(self,ds,denominator=None,event_id=None,frame_indexes=None):
-        existing_frame_indexes = { f.frame_index
-                                   for f in Frame.objects.filter(video_id=ds.video_id,segment_index=ds.segment_index)}
-        existing_count = len(existing_frame_indexes)
-        output_dir = "{}/{}/{}/".format(self.media_dir, self.primary_key, 'frames')
-        input_segment = ds.path()
+    def get_scale(self):
+        """
+        :return: ratio of decoded frame size to original video size
+        """
+        if self.rescale and self.dvideo.width and self.dvideo.height:
+            return min(1.0, float(self.rescale) / max(self.dvideo.width, self.dvideo.height))
+        return 1.0
+
+    def get_frame_size(self):
+        """
+        :return: (width, height) of decoded frames, based on the size of frames output by ffmpeg (display_size) once it
+        has been probed and on the size of the video otherwise
+        """
+        width, height = self.display_size if self.display_size else (self.dvideo.width, self.dvideo.height)
+        scale = self.get_scale()
+        return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+    def get_filters(self, select=None, force_size=False):
+        """
+        :param force_size: always scale frames to get_frame_size, so that the size of frames is known exactly
+        :return: ffmpeg filter chain selecting frames matching the select expression and scaling them to get_frame_size
+        """
+        filters = [] if select is None else ['select={}'.format(select)]
+        if force_size or self.get_scale() < 1.0:
+            filters.append('scale={}:{}'.format(*self.get_frame_size()))
+        return filters
+
+    def decode_segments(self,segments,concurrency,event_id=None,**kwargs):
+        """
+        Decode segments running up to concurrency ffmpeg processes at a time, Frames of all segments are created with
+        one bulk insert. Threads are enough since the decoding happens in the ffmpeg processes.
+        :param kwargs: sampling arguments of extract_segment_frames
+        """
+        segments = list(segments)
+        existing_frame_indexes = defaultdict(set)
+        for segment_index, frame_index in Frame.objects.filter(
+                video_id=self.primary_key, segment_index__in=[ds.segment_index for ds in segments]).values_list(
+                'segment_index', 'frame_index'):
+            existing_frame_indexes[segment_index].add(frame_index)
+        pool = ThreadPool(max(int(concurrency), 1))
+        try:
+            decoded = pool.map(lambda ds: self.extract_segment_frames(ds, **kwargs), segments)
+        finally:
+            pool.terminate()
         df_list = []
-        if denominator:
+        for ds, (decoded_frames, frame_size) in zip(segments, decoded):
+            df_list.extend(self.get_new_frames(ds, decoded_frames, frame_size,
+                                               existing_frame_indexes[ds.segment_index], event_id))
+        _ = Frame.objects.bulk_create(df_list, batch_size=1000)
+
+    def extract_segment_frames(self,ds,denominator=None,frame_indexes=None,sampling=None,fps=None,
+                               scene_threshold=None):
+        """
+        Decode frames of a segment to <frame index>.jpg files in the frames directory, does not touch the database.
+        :param denominator: with the default sampling (SAMPLE_RATE) every denominator-th frame and I-frames are decoded
+        :param frame_indexes: decode only these (video level) frame indexes
+        :param sampling: SAMPLE_KEYFRAMES only decodes keyframes, SAMPLE_SCENE frames whose scene change score is
+        above scene_threshold and SAMPLE_FPS fps frames per second of video.
+        :return: list of (segment frame index, frame data) of the decoded frames, (width, height) of the frames
+        """
+        output_dir = "{}/{}/{}/".format(self.media_dir, self.primary_key, 'frames')
+        segment_frames = sorted([(int(k),v) for k,v in ds.framelist.iteritems()])
+        if sampling == SAMPLE_KEYFRAMES:
+            # non-key frames are skipped by the decoder instead of being decoded and dropped by a filter
+            times = self.decode_frames(ds, output_dir, input_flags='-skip_frame nokey')
+            decoded_frames = self.match_decoded_frames(ds, output_dir, segment_frames, times)
+        elif sampling == SAMPLE_SCENE:
+            threshold = DEFAULT_SCENE_THRESHOLD if scene_threshold is None else float(scene_threshold)
+            times = self.decode_frames(ds, output_dir, select='gt(scene\,{})'.format(threshold))
+            decoded_frames = self.match_decoded_frames(ds, output_dir, segment_frames, times)
+        elif sampling == SAMPLE_FPS:
+            decoded_frames = self.decode_selected_frames(ds, output_dir, select_frames(segment_frames, sampling=sampling,
+                                                                                       fps=fps))
+        elif denominator:
             # Alternative to igndts is setting vsync vfr
-            ffmpeg_command = 'ffmpeg -fflags +igndts -loglevel panic -i {} -vf'.format(input_segment)
-            filter_command = '"select=not(mod(n\,{}))+eq(pict_type\,PICT_TYPE_I)" -vsync 0'.format(denominator)
+            ffmpeg_command = 'ffmpeg -fflags +igndts -loglevel panic -i {} -vf'.format(ds.path())
+            filter_command = '"{}" -vsync 0'.format(','.join(self.get_filters(
+                'not(mod(n\,{}))+eq(pict_type\,PICT_TYPE_I)'.format(denominator))))
             output_command = "{}/segment_{}_%d_b.jpg".format(output_dir,ds.segment_index)
             command = " ".join([ffmpeg_command,filter_command,output_command])
             logging.info(command)
@@ -98,29 +168,16 @@ class VideoDecoder(object):
                 _ = sp.check_output(shlex.split(command), stderr=sp.STDOUT)
             except:
                 raise ValueError,"for {} could not run {}".format(self.dvideo.name,command)
-            segment_frames_dict = ds.framelist
-            ordered_frames = sorted([(int(k),v) for k,v in segment_frames_dict.iteritems()
-                                     if int(k) % denominator == 0 or v[0] == 'I'])
+            decoded_frames = [(i+1,f) for i,f in enumerate(select_frames(segment_frames, denominator=denominator))]
         elif frame_indexes:
-            denominator = 1
-            ffmpeg_command = 'ffmpeg -fflags +igndts -loglevel panic -i {} -vf'.format(input_segment)
-            filter_command = '"select=not(mod(n\,{}))" -vsync 0'.format(denominator)
-            output_command = "{}/segment_{}_%d_b.jpg".format(output_dir,ds.segment_index)
-            command = " ".join([ffmpeg_command,filter_command,output_command])
-            logging.info(command)
-            try:
-                _ = sp.check_output(shlex.split(command), stderr=sp.STDOUT)
-            except:
-                raise ValueError,"for {} could not run {}".format(self.dvideo.name,command)
-            segment_frames_dict = ds.framelist
-            ordered_frames = sorted([(int(k),v) for k,v in segment_frames_dict.iteritems()
-                                     if int(k)+ds.start_index in frame_indexes])
+            decoded_frames = self.decode_selected_frames(ds, output_dir, select_frames(
+                segment_frames, frame_indexes=frame_indexes, start_index=ds.start_index))
         else:
             raise ValueError("Either provide list of frames to decode or denominator to provide rate")
         frame_width, frame_height = 0, 0
-        for i,f_id in enumerate(ordered_frames):
+        for i,(output_number,f_id) in enumerate(decoded_frames):
             frame_index, frame_data = f_id
-            src = "{}/segment_{}_{}_b.jpg".format(output_dir,ds.segment_index,i+1)
+            src = "{}/segment_{}_{}_b.jpg".format(output_dir,ds.segment_index,output_number)
             dst = "{}/{}.jpg".format(output_dir,frame_index+ds.start_index)
             try:
                 os.rename(src,dst)
@@ -129,8 +186,17 @@ class VideoDecoder(object):
             if i ==0:
                 im = Image.open(dst)
                 frame_width, frame_height = im.size  # this remains constant for all frames
+        return [f_id for _, f_id in decoded_frames], (frame_width, frame_height)
+
+    def get_new_frames(self,ds,decoded_frames,frame_size,existing_frame_indexes,event_id):
+        """
+        :return: unsaved Frames for decoded frames of the segment that are not in existing_frame_indexes
+        """
+        frame_width, frame_height = frame_size
+        df_list = []
+        for frame_index, frame_data in decoded_frames:
             findex = int(frame_index+ds.start_index)
-            if existing_count == 0 or findex not in existing_frame_indexes:
+            if findex not in existing_frame_indexes:
                 df = Frame()
                 df.frame_index = findex
                 df.video_id = self.dvideo.pk
@@ -140,8 +206,106 @@ class VideoDecoder(object):
                 df.h = frame_height
                 df.event_id = event_id
                 df.w = frame_width
+                df.scale = self.get_scale()
                 df_list.append(df)
-        _ = Frame.objects.bulk_create(df_list, batch_size=1000)
+        return df_list
+
+    def iter_frame_arrays(self,ds,denominator=None,frame_indexes=None,sampling=None,fps=None):
+        """
+        Decode frames of a segment in memory, ffmpeg writes raw RGB frames to a pipe and nothing is written to disk.
+        Only sampling modes that select frames from the framelist are supported.
+        :return: iterator of (segment frame index, frame data, (height, width, 3) uint8 array)
+        """
+        segment_frames = sorted([(int(k),v) for k,v in ds.framelist.iteritems()])
+        selected_frames = select_frames(segment_frames, denominator, frame_indexes, sampling, fps, ds.start_index)
+        if not selected_frames:
+            return
+        if self.display_size is None:
+            # rotated videos are decoded with width and height swapped
+            self.display_size = probe_display_size(ds.path())
+        width, height = self.get_frame_size()
+        frame_bytes = width * height * 3
+        select = '+'.join('eq(n\\,{})'.format(k) for k, _ in selected_frames)
+        command = ['ffmpeg', '-fflags', '+igndts', '-loglevel', 'panic', '-i', ds.path(), '-vf',
+                   ','.join(self.get_filters(select, force_size=True)), '-vsync', '0',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+        logging.info(" ".join(command))
+        decoder = sp.Popen(command, stdout=sp.PIPE)
+        count = 0
+        try:
+            for frame_index, frame_data in selected_frames:
+                buf = decoder.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    break
+                count += 1
+                yield frame_index, frame_data, np.frombuffer(buf, dtype=np.uint8).reshape((height, width, 3))
+        finally:
+            decoder.stdout.close()
+            decoder.wait()
+        if count != len(selected_frames):
+            raise ValueError("for {} decoded {} frames of segment {} instead of {}".format(
+                self.dvideo.name, count, ds.segment_index, len(selected_frames)))
+
+    def materialize_frames(self,ds,frame_arrays,event_id):
+        """
+        Write frames decoded in memory to the frames directory and create their Frames.
+        :param frame_arrays: list of (segment frame index, frame data, array)
+        :return: dict of frame index to Frame, for frames that already existed the existing Frame
+        """
+        output_dir = "{}/{}/{}/".format(self.media_dir, self.primary_key, 'frames')
+        if frame_arrays and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        frames = {df.frame_index: df for df in Frame.objects.filter(video_id=ds.video_id,segment_index=ds.segment_index)}
+        decoded_frames = []
+        frame_size = (0, 0)
+        for frame_index, frame_data, image in frame_arrays:
+            Image.fromarray(image).save("{}/{}.jpg".format(output_dir,frame_index+ds.start_index))
+            decoded_frames.append((frame_index, frame_data))
+            frame_size = (image.shape[1], image.shape[0])
+        df_list = Frame.objects.bulk_create(self.get_new_frames(ds, decoded_frames, frame_size, frames, event_id),
+                                            batch_size=1000)
+        for df in df_list:
+            frames[df.frame_index] = df
+        return frames
+
+    def decode_frames(self,ds,output_dir,input_flags='',select=None):
+        """
+        Decode frames of the segment (all of them or those matching the select expression) to
+        segment_<segment_index>_<n>_b.jpg where n starts at 1.
+        :return: list of timestamps of the decoded frames reported by the showinfo filter, segments keep the timestamps
+        of the video and -copyts keeps ffmpeg from shifting them to 0 so that they match the framelist times
+        """
+        filters = ','.join(self.get_filters(select) + ['showinfo'])
+        command = 'ffmpeg -fflags +igndts -copyts -loglevel info {} -i {} -vf "{}" -vsync 0 ' \
+                  '{}/segment_{}_%d_b.jpg'.format(input_flags, ds.path(), filters, output_dir, ds.segment_index)
+        logging.info(command)
+        try:
+            output = sp.check_output(shlex.split(command), stderr=sp.STDOUT)
+        except:
+            raise ValueError,"for {} could not run {}".format(self.dvideo.name,command)
+        return [float(t) for t in SHOWINFO_PTS_TIME.findall(output)]
+
+    def match_decoded_frames(self,ds,output_dir,segment_frames,times):
+        """
+        Match frames decoded by a data dependent selection to the segment framelist, decoded frames that could not be
+        matched are removed.
+        :return: list of (output number, (segment frame index, frame data))
+        """
+        decoded_frames = match_frame_times(segment_frames, times)
+        matched = {output_number for output_number, _ in decoded_frames}
+        for output_number in range(1, len(times) + 1):
+            if output_number not in matched:
+                os.remove("{}/segment_{}_{}_b.jpg".format(output_dir, ds.segment_index, output_number))
+        return decoded_frames
+
+    def decode_selected_frames(self,ds,output_dir,selected_frames):
+        """
+        :param selected_frames: ordered list of (segment frame index, frame data) to decode
+        :return: list of (output number, (segment frame index, frame data))
+        """
+        if selected_frames:
+            self.decode_frames(ds, output_dir, select='+'.join('eq(n\\,{})'.format(k) for k,_ in selected_frames))
+        return [(i+1,f) for i,f in enumerate(selected_frames)]
 
     def segment_video(self,event_id):
         segments_dir = "{}/{}/{}/".format(self.media_dir, self.primary_key, 'segments')
@@ -155,35 +319,174 @@ class VideoDecoder(object):
             raise ValueError
         else:
             timer_start = time.time()
+            segments = read_segment_list('{}/segments.csv'.format(segments_dir))
+            segment_frames = assign_segment_frames(self.get_framelist(), [start_time for _, start_time, _ in segments])
+            video_streams = [st for st in self.metadata.get('streams', []) if st.get('codec_type') == 'video']
+            ds_list = []
             start_index = 0
-            for line in file('{}/segments.csv'.format(segments_dir)):
-                segment_file_name, start_time, end_time = line.strip().split(',')
-                segment_id = int(segment_file_name.split('.')[0])
-                command = 'ffprobe -select_streams v -show_streams  -print_format json {}  '.format(segment_file_name)
-                # logging.info(command)
-                segment_json = sp.check_output(shlex.split(command), cwd=segments_dir)
-                command = 'ffprobe -show_frames -select_streams v:0 -print_format csv {}'.format(segment_file_name)
-                # logging.info(command)
-                framelist= sp.check_output(shlex.split(command), cwd=segments_dir)
-                self.segment_frames_dict[segment_id] = self.parse_segment_framelist(segment_id,framelist)
-                logging.warning("Processing line {}".format(line))
-                start_time = float(start_time)
-                end_time = float(end_time)
+            for (segment_id, start_time, end_time), frames in zip(segments, segment_frames):
+                self.segment_frames_dict[segment_id] = dict(enumerate(frames))
                 ds = Segment()
                 ds.segment_index = segment_id
                 ds.framelist = self.segment_frames_dict[segment_id]
                 ds.start_time = start_time
                 ds.start_index = start_index
-                start_index += len(self.segment_frames_dict[segment_id])
-                ds.frame_count = len(self.segment_frames_dict[segment_id])
+                start_index += len(frames)
+                ds.frame_count = len(frames)
                 ds.end_time = end_time
                 ds.video_id = self.dvideo.pk
                 ds.event_id = event_id
-                ds.metadata = segment_json
-                ds.save()
+                ds.metadata = json.dumps({'streams': [get_segment_stream(st, start_time, end_time, len(frames))
+                                                      for st in video_streams]})
+                ds_list.append(ds)
+            _ = Segment.objects.bulk_create(ds_list, batch_size=1000)
             logging.info("Took {} seconds to process {} segments".format(time.time() - timer_start,len(self.segment_frames_dict)))
         self.dvideo.frames = sum([len(c) for c in self.segment_frames_dict.itervalues()])
         self.dvideo.segments = len(self.segment_frames_dict)
         self.dvideo.save()
-        self.detect_csv_segment_format() # detect and save
 
+
+
+def get_segment_stream(stream, start_time, end_time, frame_count):
+    """
+    ffprobe stream metadata of a segment derived from the stream of the whole video, the timing fields are replaced by
+    those of the segment and the rest (codec, size, frame rate...) is shared by all segments.
+    """
+    stream = dict(stream)
+    stream['start_time'] = '{:.6f}'.format(start_time)
+    stream['duration'] = '{:.6f}'.format(end_time - start_time)
+    stream['nb_frames'] = str(frame_count)
+    try:
+        num, den = [int(v) for v in stream['time_base'].split('/')]
+        stream['start_pts'] = int(round(start_time * den / num))
+        stream['duration_ts'] = int(round((end_time - start_time) * den / num))
+    except (KeyError, ValueError, ZeroDivisionError):
+        stream.pop('start_pts', None)
+        stream.pop('duration_ts', None)
+    return stream
+
+
+def probe_display_size(path):
+    """
+    :return: (width, height) of frames ffmpeg decodes from the first video stream of path, which are rotated by the
+    rotation of the stream
+    """
+    command = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-show_streams', '-print_format', 'json', path]
+    try:
+        stream = json.loads(sp.check_output(command))['streams'][0]
+        width, height = int(stream['width']), int(stream['height'])
+    except (sp.CalledProcessError, ValueError, KeyError, IndexError):
+        raise ValueError("{} : could not probe the video stream".format(path))
+    rotation = stream.get('tags', {}).get('rotate', 0)
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if int(round(float(rotation))) % 180 == 90:
+        width, height = height, width
+    return width, height
+
+
+def read_segment_list(path):
+    """
+    :param path: csv segment list written by the segment muxer
+    :return: sorted list of (segment index, start time, end time)
+    """
+    segments = []
+    for line in file(path):
+        segment_file_name, start_time, end_time = line.strip().split(',')
+        segments.append((int(segment_file_name.split('.')[0]), float(start_time), float(end_time)))
+    segments.sort()
+    return segments
+
+
+def assign_segment_frames(frames, starts):
+    """
+    Assign frames of the video to the segments cut by the segment muxer. Segments are cut at keyframe packets, the
+    keyframe starting each segment is found by its time in segments.csv and frames are assigned by the position of
+    their packet, so that frames presented before that keyframe but stored after it (B-frames of an open GOP) stay
+    in its segment. When packet positions are not available frames are assigned by time.
+    :param frames: list of (pict_type, time, key_frame, packet position or None) in presentation order
+    :param starts: sorted start times of the segments
+    :return: list of (pict_type, time) frames in presentation order for each segment
+    """
+    boundaries = {}
+    for _, t, key_frame, pkt_pos in frames:
+        if key_frame and pkt_pos is not None:
+            i = bisect.bisect_left(starts, t - SEGMENT_TIME_TOLERANCE)
+            if 0 < i < len(starts) and abs(starts[i] - t) <= SEGMENT_TIME_TOLERANCE and i not in boundaries:
+                boundaries[i] = pkt_pos
+    positions = [boundaries[i] for i in sorted(boundaries)]
+    by_position = len(positions) == len(starts) - 1 and positions == sorted(positions) and \
+        all(pkt_pos is not None for _, _, _, pkt_pos in frames)
+    if not by_position and len(starts) > 1:
+        logging.warning("found {} of {} segment keyframes, assigning frames to segments by time".format(
+            len(boundaries), len(starts) - 1))
+    segment_frames = [[] for _ in starts]
+    for pict_type, t, _, pkt_pos in frames:
+        if by_position:
+            i = bisect.bisect_right(positions, pkt_pos)
+        else:
+            # the segment that starts at or before the timestamp
+            i = max(bisect.bisect_right(starts, t + SEGMENT_TIME_TOLERANCE) - 1, 0)
+        segment_frames[i].append((pict_type, t))
+    return segment_frames
+
+
+def match_frame_times(segment_frames, times):
+    """
+    Match timestamps of decoded frames to the closest frames in the segment framelist.
+    :param segment_frames: sorted list of (segment frame index, (pict_type, time))
+    :param times: timestamps of decoded frames in output order
+    :return: list of (output number, (segment frame index, frame data)), outputs matching an already matched frame are
+    removed
+    """
+    frame_times = [v[1] for _, v in segment_frames]
+    matched, seen = [], set()
+    for output_number, t in enumerate(times, 1):
+        i = bisect.bisect_left(frame_times, t)
+        if i == len(frame_times) or (i > 0 and t - frame_times[i - 1] < frame_times[i] - t):
+            i -= 1
+        if i >= 0 and i not in seen:
+            seen.add(i)
+            matched.append((output_number, segment_frames[i]))
+    return matched
+
+
+def select_frames(segment_frames, denominator=None, frame_indexes=None, sampling=None, fps=None, start_index=0):
+    """
+    Frames selected by sampling modes that only depend on the framelist.
+    :param segment_frames: sorted list of (segment frame index, (pict_type, time))
+    :return: selected (segment frame index, frame data)
+    """
+    if sampling == SAMPLE_FPS:
+        if not fps:
+            raise ValueError("fps is required for {} sampling".format(SAMPLE_FPS))
+        return sample_fps(segment_frames, float(fps))
+    elif sampling in (SAMPLE_KEYFRAMES, SAMPLE_SCENE):
+        raise ValueError("{} sampling selects frames while decoding".format(sampling))
+    elif denominator:
+        return [(k,v) for k,v in segment_frames if k % denominator == 0 or v[0] == 'I']
+    elif frame_indexes:
+        return [(k,v) for k,v in segment_frames if k+start_index in frame_indexes]
+    else:
+        raise ValueError("Either provide list of frames to decode or denominator to provide rate")
+
+
+def sample_fps(segment_frames, fps):
+    """
+    Select the first frame at or after every 1/fps seconds of video, frames are matched by time so that sampling is
+    continuous across segments.
+    :param segment_frames: sorted list of (segment frame index, (pict_type, time))
+    :return: selected (segment frame index, frame data)
+    """
+    selected = []
+    for i, (k, v) in enumerate(segment_frames):
+        t = v[1]
+        if i > 0:
+            previous_t = segment_frames[i - 1][1][1]
+        elif len(segment_frames) > 1:
+            previous_t = t - (segment_frames[1][1][1] - t)  # frame before the segment is about one interval earlier
+        else:
+            previous_t = None
+        if previous_t is None or math.floor(t * fps) > math.floor(previous_t * fps):
+            selected.append((k, v))
+    return selected
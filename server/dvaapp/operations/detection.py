@@ -1,5 +1,8 @@
+import itertools
 from ..models import TrainedModel
+from .runtime import ModelRuntime, get_declared_memory
 from dvalib import detector
+from dvalib.base_indexer import decode_image
 
 
 class Detectors(object):
@@ -12,7 +15,10 @@ class Detectors(object):
             if cd.detector_type == TrainedModel.TFD:
                 Detectors._detectors[cd.pk] = detector.TFDetector(model_path=cd.get_model_path(),
                                                                   class_index_to_string=
-                                                                  cd.arguments['class_index_to_string'])
+                                                                  cd.arguments['class_index_to_string'],
+                                                                  batch_size=cd.arguments.get(
+                                                                      'batch_size',
+                                                                      detector.DEFAULT_DETECTION_BATCH_SIZE))
             elif cd.detector_type == TrainedModel.YOLO:
                     # class_names = {k: v for k, v in json.loads(self.class_names)}
                     # args = {'root_dir': model_dir,
@@ -25,4 +31,57 @@ class Detectors(object):
             elif cd.name == 'textbox':
                 Detectors._detectors[cd.pk] = detector.TextBoxDetector(model_path=cd.get_model_path())
             else:
-                raise ValueError,"{}".format(cd.pk)
\ No newline at end of file
+                raise ValueError,"{}".format(cd.pk)
+        return ModelRuntime.acquire(('detector', cd.pk), Detectors._detectors[cd.pk],
+                                    memory=get_declared_memory(cd))
+
+    @classmethod
+    def detect_and_index(cls, detector_model, visual_index, paths):
+        """
+        Detect in each image and embed the detected regions with visual_index in the same pass. Every image is decoded
+        once and shared by the detector and the indexer, regions are cropped in memory and embedded in batches.
+        :param paths: list of image paths
+        :return: list of detections per path, list of features in the order of the detections
+        """
+        detections_list = []
+
+        def frame_boxes():
+            for path in paths:
+                image = decode_image(path)
+                detections = detector_model.detect_image(image)
+                detections_list.append(detections)
+                yield image, [(d['x'], d['y'], d['w'], d['h']) for d in detections]
+
+        features = visual_index.index_frame_boxes(frame_boxes())
+        return detections_list, features
+
+    @classmethod
+    def detect_segments(cls, decoder, detector_model, visual_index, segments, event_id, batch_size, materialize=False,
+                        **sampling):
+        """
+        Detect in frames decoded in memory from segments. Only frames with detections (all decoded frames when
+        materialize is set) are written to disk and get Frames. With visual_index the detected regions are embedded
+        from the decoded frames as in detect_and_index.
+        :param decoder: VideoDecoder of the video
+        :param sampling: sampling arguments of VideoDecoder.iter_frame_arrays
+        :return: list of (Frame, detections), list of features in the order of the detections or None
+        """
+        frame_detections_list, features = [], None if visual_index is None else []
+        for ds in segments:
+            kept, batch = [], []
+            for decoded in itertools.chain(decoder.iter_frame_arrays(ds, **sampling), [None]):
+                if decoded is not None:
+                    batch.append(decoded)
+                if batch and (decoded is None or len(batch) == batch_size):
+                    for (frame_index, frame_data, image), detections in zip(
+                            batch, detector_model.detect_arrays([image for _, _, image in batch])):
+                        if detections or materialize:
+                            kept.append((frame_index, frame_data, image, detections))
+                    batch = []
+            frames = decoder.materialize_frames(ds, [(k, data, image) for k, data, image, _ in kept], event_id)
+            for frame_index, _, _, detections in kept:
+                frame_detections_list.append((frames[frame_index + ds.start_index], detections))
+            if visual_index is not None:
+                features.extend(visual_index.index_frame_boxes(
+                    (image, [(d['x'], d['y'], d['w'], d['h']) for d in detections]) for _, _, image, detections in kept))
+        return frame_detections_list, features
@@ -1,4 +1,4 @@
-import logging, json, uuid, tempfile, os
+import logging, json, uuid, os
 from PIL import Image
 from django.conf import settings
 
@@ -10,6 +10,7 @@ except ImportError:
     logging.warning("Could not import indexer / clustering assuming running in front-end mode")
 
 from ..models import IndexEntries, TrainedModel
+from .runtime import ModelRuntime, get_declared_memory
 
 
 class Indexers(object):
@@ -56,17 +57,33 @@ class Indexers(object):
                 Indexers._visual_indexer[di.pk] = indexer.VGGIndexer(iroot + "{}/{}".format(di.uuid,di.files[0]['filename']))
             else:
                 raise ValueError,"unregistered indexer with id {}".format(di.pk)
-        return Indexers._visual_indexer[di.pk]
+        return ModelRuntime.acquire(('indexer', di.pk), Indexers._visual_indexer[di.pk],
+                                    memory=get_declared_memory(di))
+
+    @classmethod
+    def save_features(cls, feat_fname, features, count):
+        """
+        Write features to a .npy file as they are computed, the file is created once the first feature is available.
+        :param features: iterable of count features with identical shape
+        """
+        feats = None
+        for i, f in enumerate(features):
+            if feats is None:
+                feats = np.lib.format.open_memmap(feat_fname, mode='w+', dtype=f.dtype, shape=(count,) + f.shape)
+            feats[i] = f
+        if feats is not None:
+            feats.flush()
+            del feats
 
     @classmethod
     def index_queryset(cls,di,visual_index,event,target,queryset, cloud_paths=False):
         visual_index.load()
-        temp_root = tempfile.mkdtemp()
-        entries, paths, images = [], [], {}
+        entries, paths, crops = [], [], []
         for i, df in enumerate(queryset):
             if target == 'frames':
                 entry = {'frame_index': df.frame_index,
                          'frame_primary_key': df.pk,
+                         'video_primary_key': df.video_id,
                          'index': i,
                          'type': 'frame'}
                 if cloud_paths:
@@ -78,44 +95,62 @@ class Indexers(object):
                     'frame_index': df.frame_index,
                     'detection_primary_key': df.pk,
                     'frame_primary_key': df.frame_id,
+                    'video_primary_key': df.video_id,
                     'index': i,
                     'type': df.region_type
                 }
                 if df.full_frame:
-                    paths.append(df.frame_path())
+                    paths.append((i, df.frame_path()))
                 else:
-                    paths.append(df.crop_and_get_region_path(images,temp_root))
+                    crops.append((i, (df.frame_path(), (df.x, df.y, df.w, df.h))))
             else:
                 raise ValueError,"{} target not configured".format(target)
             entries.append(entry)
         if entries:
             logging.info(paths)  # adding temporary logging to check whether s3:// paths are being correctly used.
             # TODO Ensure that "full frame"/"regions" are not repeatedly indexed.
-            features = visual_index.index_paths(paths)
-            uid = str(uuid.uuid1()).replace('-','_')
-            dirnames = ['{}/{}/'.format(settings.MEDIA_ROOT,event.video_id),
-                        '{}/{}/indexes/'.format(settings.MEDIA_ROOT,event.video_id)]
-            for dirname in dirnames:
-                if not os.path.isdir(dirname):
-                    try:
-                        os.mkdir(dirname)
-                    except:
-                        logging.exception("error creating {}".format(dirname))
-                        pass
-            feat_fname = "{}/{}/indexes/{}.npy".format(settings.MEDIA_ROOT,event.video_id,uid)
-            with open(feat_fname, 'w') as feats:
-                np.save(feats, np.array(features))
-            i = IndexEntries()
-            i.video_id = event.video_id
-            i.count = len(entries)
-            i.contains_detections = target == "regions"
-            i.contains_frames = target == "frames"
-            i.detection_name = '{}_subset_by_{}'.format(target,event.pk)
-            i.algorithm = di.name
-            i.indexer = di
-            i.indexer_shasum = di.shasum
-            i.entries = entries
-            i.features_file_name = feat_fname.split('/')[-1]
-            i.event_id = event.pk
-            i.source_filter_json = event.arguments
-            i.save()
+            if target == 'frames':
+                features = visual_index.iter_features(paths)
+            else:
+                features = [None] * len(entries)
+                if paths:
+                    for (i, _), f in zip(paths, visual_index.index_paths([path for _, path in paths])):
+                        features[i] = f
+                if crops:
+                    for (i, _), f in zip(crops, visual_index.index_crops([crop for _, crop in crops])):
+                        features[i] = f
+            cls.save_index_entries(di, event, target, entries, features)
+
+    @classmethod
+    def save_index_entries(cls, di, event, target, entries, features):
+        """
+        Write features of entries to the indexes directory of the video and create the IndexEntries.
+        :param target: 'frames' or 'regions'
+        :param features: iterable of features in the order of entries
+        """
+        uid = str(uuid.uuid1()).replace('-','_')
+        dirnames = ['{}/{}/'.format(settings.MEDIA_ROOT,event.video_id),
+                    '{}/{}/indexes/'.format(settings.MEDIA_ROOT,event.video_id)]
+        for dirname in dirnames:
+            if not os.path.isdir(dirname):
+                try:
+                    os.mkdir(dirname)
+                except:
+                    logging.exception("error creating {}".format(dirname))
+                    pass
+        feat_fname = "{}/{}/indexes/{}.npy".format(settings.MEDIA_ROOT,event.video_id,uid)
+        cls.save_features(feat_fname, features, len(entries))
+        i = IndexEntries()
+        i.video_id = event.video_id
+        i.count = len(entries)
+        i.contains_detections = target == "regions"
+        i.contains_frames = target == "frames"
+        i.detection_name = '{}_subset_by_{}'.format(target,event.pk)
+        i.algorithm = di.name
+        i.indexer = di
+        i.indexer_shasum = di.shasum
+        i.entries = entries
+        i.features_file_name = feat_fname.split('/')[-1]
+        i.event_id = event.pk
+        i.source_filter_json = event.arguments
+        i.save()
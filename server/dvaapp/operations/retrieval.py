@@ -1,4 +1,7 @@
-import logging
+import logging, threading
+from collections import defaultdict
+from django.conf import settings
+from django.db import close_old_connections
 from .approximation import Approximators
 from .indexing import Indexers
 
@@ -9,13 +12,21 @@ except ImportError:
     np = None
     logging.warning("Could not import indexer / clustering assuming running in front-end mode")
 
-from ..models import IndexEntries, QueryResults, Region, Retriever, Frame
+from ..models import IndexEntries, IndexShard, QueryResults, Retriever
+from dva.in_memory import redis_client
+
+# Redis key incremented whenever new IndexEntries become available to retrievers.
+INDEX_VERSION_KEY = "index_entries_version"
+# Redis pub/sub channel on which new versions are published.
+INDEX_UPDATES_CHANNEL = "index_entries_updates"
 
 
 class Retrievers(object):
     _visual_retriever = {}
     _retriever_object = {}
-    _index_count = 0
+    _index_watermark = {}
+    _index_version = {}
+    _lock = threading.RLock()
 
     @classmethod
     def get_retriever(cls, retriever_pk):
@@ -51,89 +62,188 @@ class Retrievers(object):
                 raise ValueError("{} not valid retriever algorithm".format(dr.algorithm))
         return cls._visual_retriever[retriever_pk], cls._retriever_object[retriever_pk]
 
+    @classmethod
+    def publish_index_update(cls):
+        """
+        Called once IndexEntries are committed (event completed), retrievers compare this version on every query
+        and workers running an index update listener load new entries as soon as it is published.
+        """
+        version = redis_client.incr(INDEX_VERSION_KEY)
+        redis_client.publish(INDEX_UPDATES_CHANNEL, version)
+
+    @classmethod
+    def start_index_update_listener(cls, retriever_pks=None):
+        """
+        Start a daemon thread which loads new index entries in the background. Retriever workers run with the solo
+        pool, so the thread shares retrievers with the tasks.
+        :param retriever_pks: retrievers to preload and refresh, by default all retrievers loaded by this process.
+        """
+        listener = threading.Thread(target=cls.listen_for_index_updates, args=(retriever_pks,),
+                                    name="index_update_listener")
+        listener.daemon = True
+        listener.start()
+        return listener
+
+    @classmethod
+    def listen_for_index_updates(cls, retriever_pks=None):
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(INDEX_UPDATES_CHANNEL)
+        if retriever_pks:
+            cls.refresh_loaded_retrievers(retriever_pks)
+        for _ in pubsub.listen():
+            cls.refresh_loaded_retrievers(retriever_pks)
+
+    @classmethod
+    def refresh_loaded_retrievers(cls, retriever_pks=None):
+        close_old_connections()
+        with cls._lock:
+            for retriever_pk in (retriever_pks if retriever_pks else list(cls._visual_retriever.keys())):
+                try:
+                    _, dr = cls.get_retriever(retriever_pk)
+                    cls.refresh_index(dr)
+                except Exception:
+                    logging.exception("Could not refresh retriever {}".format(retriever_pk))
+
     @classmethod
     def refresh_index(cls, dr):
-        # This has a BUG where total count of index entries remains unchanged
-        # TODO: Waiting for https://github.com/celery/celery/issues/3620 to be resolved to enabel ASYNC index updates
-        # TODO improve this by either having a seperate broadcast queues or using last update timestampl
-        last_count = cls._index_count
-        current_count = IndexEntries.objects.count()
-        visual_index = cls._visual_retriever[dr.pk]
-        if last_count == 0 or last_count != current_count or len(visual_index.loaded_entries) == 0:
-            # update the count
-            cls._index_count = current_count
+        version = redis_client.get(INDEX_VERSION_KEY)
+        if version is None or cls._index_version.get(dr.pk) != version:
+            # store version before loading so that updates published while loading trigger another refresh
+            cls._index_version[dr.pk] = version
             cls.update_index(dr)
 
     @classmethod
     def update_index(cls, dr):
         source_filters = dr.source_filters.copy()
-        # Only select entries with completed events, otherwise indexes might not be synced or complete.
-        source_filters['event__completed'] = True
         if dr.indexer_shasum:
             source_filters['indexer_shasum'] = dr.indexer_shasum
         if dr.approximator_shasum:
             source_filters['approximator_shasum'] = dr.approximator_shasum
         else:
             source_filters['approximator_shasum'] = None  # Required otherwise approximate index entries are selected
-        index_entries = IndexEntries.objects.filter(**source_filters)
+        # Only rows newer than the watermark (max pk loaded so far) are queried.
+        watermark = cls._index_watermark.get(dr.pk, 0)
+        source_filters['pk__gt'] = watermark
+        index_entries = IndexEntries.objects.filter(**source_filters).order_by('pk')
+        # Only select entries with completed events, otherwise indexes might not be synced or complete.
+        # The watermark is not moved past an entry whose event is still running so that it is loaded later.
+        first_pending = index_entries.filter(event__completed=False, event__errored=False).values_list(
+            'pk', flat=True).first()
+        if first_pending is not None:
+            index_entries = index_entries.filter(pk__lt=first_pending)
+        index_entries = index_entries.filter(event__completed=True)
         visual_index = cls._visual_retriever[dr.pk]
+        if visual_index.algorithm not in {'LOPQ', 'FAISS'}:
+            cls.load_shards(visual_index, index_entries)
         for index_entry in index_entries:
             if index_entry.pk not in visual_index.loaded_entries and index_entry.count > 0:
-                if visual_index.algorithm == "LOPQ":
-                    vectors, entries = index_entry.load_index()
-                    logging.info("loading approximate index {}".format(index_entry.pk))
-                    start_index = len(visual_index.entries)
-                    visual_index.load_index(entries=entries)
-                    visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
-                                                                                     end=len(visual_index.entries) - 1)
-                elif visual_index.algorithm == 'FAISS':
-                    index_file_path, entries = index_entry.load_index()
-                    logging.info("loading FAISS index {}".format(index_entry.pk))
-                    start_index = visual_index.findex
-                    visual_index.load_index(index_file_path, entries)
-                    visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
-                                                                                     end=visual_index.findex - 1)
+                try:
+                    cls.load_index_entry(visual_index, index_entry)
+                except Exception:
+                    # Stop at the first failure so that the watermark stays below it and it is retried on the next
+                    # refresh, rather than being skipped forever.
+                    logging.exception("Failed to load IndexEntries {} in {}".format(index_entry.pk,
+                                                                                  visual_index.name))
+                    cls._index_version.pop(dr.pk, None)
+                    break
                 else:
-                    vectors, entries = index_entry.load_index()
-                    logging.info("Starting {} in {} with shape {}".format(index_entry.video_id, visual_index.name,
-                                                                          vectors.shape))
-                    try:
-                        start_index = visual_index.findex
-                        visual_index.load_index(vectors, entries)
-                        visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
-                                                                                         end=visual_index.findex - 1)
-                    except:
-                        logging.info("ERROR Failed to load {} vectors shape {} entries {}".format(
-                            index_entry.video_id, vectors.shape, len(entries)))
-                    else:
-                        logging.info("finished {} in {}".format(index_entry.pk, visual_index.name))
+                    logging.info("finished {} in {}".format(index_entry.pk, visual_index.name))
+            watermark = max(watermark, index_entry.pk)
+        cls._index_watermark[dr.pk] = watermark
+        logging.info("{} holds {} bytes of index data".format(visual_index.name, visual_index.memory_usage()))
+
+    @classmethod
+    def load_index_entry(cls, visual_index, index_entry):
+        if visual_index.algorithm == "LOPQ":
+            codes, entries = index_entry.load_index()
+            logging.info("loading approximate index {}".format(index_entry.pk))
+            start_index = len(visual_index.entries)
+            visual_index.load_index(codes, entries)
+            visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
+                                                                             end=len(visual_index.entries) - 1)
+        elif visual_index.algorithm == 'FAISS':
+            index_file_path, entries = index_entry.load_index()
+            logging.info("loading FAISS index {}".format(index_entry.pk))
+            start_index = visual_index.findex
+            visual_index.load_index(index_file_path, entries)
+            visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
+                                                                             end=visual_index.findex - 1)
+        else:
+            vectors, entries = index_entry.load_index(mmap=settings.ENABLE_INDEX_MMAP)
+            logging.info("Starting {} in {} with shape {}".format(index_entry.video_id, visual_index.name,
+                                                                  vectors.shape))
+            start_index = visual_index.findex
+            visual_index.load_index(vectors, entries)
+            visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
+                                                                             end=visual_index.findex - 1)
+
+    @classmethod
+    def load_shards(cls, visual_index, index_entries):
+        """
+        Load compacted shards in place of their IndexEntries. A shard is only used when all of its IndexEntries
+        are selected by the retriever and none of them are already loaded, remaining entries are loaded one by one.
+        """
+        shard_members = defaultdict(list)
+        for pk, shard_id in index_entries.filter(shard__isnull=False).values_list('pk', 'shard_id'):
+            shard_members[shard_id].append(pk)
+        for ds in IndexShard.objects.filter(pk__in=list(shard_members.keys())):
+            members = shard_members[ds.pk]
+            if len(members) != ds.index_entries_count:
+                continue
+            if any(pk in visual_index.loaded_entries for pk in members):
+                continue
+            vectors, entries = ds.load_index(mmap=settings.ENABLE_INDEX_MMAP)
+            logging.info("loading shard {} with {} vectors in {}".format(ds.pk, ds.count, visual_index.name))
+            start_index = visual_index.findex
+            visual_index.load_index(vectors, entries)
+            for pk in members:
+                visual_index.loaded_entries[pk] = indexer.IndexRange(start=start_index, end=visual_index.findex - 1)
 
     @classmethod
     def retrieve(cls, event, retriever_pk, vector, count, region_pk=None):
-        index_retriever, dr = cls.get_retriever(retriever_pk)
-        cls.refresh_index(dr)
-        # TODO: figure out a better way to store numpy arrays
-        results = index_retriever.nearest(vector=vector, n=count)
-        # TODO: optimize this using batching
-        for rank, r in enumerate(results):
-            qr = QueryResults()
-            if region_pk:
-                qr.query_region_id = region_pk
-            qr.query = event.parent_process
-            qr.retrieval_event_id = event.pk
-            if 'detection_primary_key' in r:
-                dd = Region.objects.get(pk=r['detection_primary_key'])
-                qr.detection = dd
-                qr.frame_id = dd.frame_id
-                qr.video_id = dd.video_id
-            else:
-                dd = Frame.objects.get(pk=r['frame_primary_key'])
-                qr.frame = dd
-                qr.video_id = dd.video_id
-            qr.algorithm = dr.algorithm
-            qr.rank = r.get('rank', rank)
-            qr.distance = r.get('dist', rank)
-            qr.save()
+        with cls._lock:
+            index_retriever, dr = cls.get_retriever(retriever_pk)
+            cls.refresh_index(dr)
+            # TODO: figure out a better way to store numpy arrays
+            results = index_retriever.nearest(vector=vector, n=count)
+        cls.store_results(event, dr, [(region_pk, results)])
+        return 0
+
+    @classmethod
+    def retrieve_batch(cls, event, retriever_pk, vectors, count, region_pks):
+        """
+        Search several query vectors (e.g. every face / object region of a query image) with a single batched
+        nearest neighbor search and store all results together.
+        :param vectors: list of query vectors, one per query region
+        :param region_pks: list of query region primary keys aligned with vectors
+        """
+        if len(vectors) == 0:
+            return 0
+        vectors = np.vstack([np.atleast_2d(v) for v in vectors])
+        with cls._lock:
+            index_retriever, dr = cls.get_retriever(retriever_pk)
+            cls.refresh_index(dr)
+            results = index_retriever.nearest_batch(vectors=vectors, n=count)
+        cls.store_results(event, dr, [(region_pk, results[i]) for i, region_pk in enumerate(region_pks)])
+        return 0
+
+    @classmethod
+    def store_results(cls, event, dr, region_results):
+        query_results = []
+        for region_pk, results in region_results:
+            for rank, r in enumerate(results):
+                qr = QueryResults()
+                if region_pk:
+                    qr.query_region_id = region_pk
+                qr.query = event.parent_process
+                qr.retrieval_event_id = event.pk
+                qr.detection_id = r.get('detection_primary_key', None)
+                qr.frame_id = r['frame_primary_key']
+                qr.video_id = r['video_primary_key']
+                qr.algorithm = dr.algorithm
+                qr.rank = r.get('rank', rank)
+                qr.distance = r.get('dist', rank)
+                query_results.append(qr)
+        QueryResults.objects.bulk_create(query_results, 1000)
         event.parent_process.results_available = True
         event.parent_process.save()
-        return 0
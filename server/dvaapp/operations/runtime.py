@@ -0,0 +1,188 @@
+import logging, os, resource, threading, time, gc, tempfile
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict
+from django.conf import settings
+from PIL import Image
+from ..models import TrainedModel
+
+WARMUP_IMAGE_SIZE = (320, 240)
+
+
+def get_rss():
+    """
+    :return: resident memory of this process in bytes, 0 where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return 0
+
+
+def get_warmup_image():
+    """
+    :return: path to a blank jpeg used to warm up models
+    """
+    path = os.path.join(tempfile.gettempdir(), 'dva_warmup_{}x{}.jpg'.format(*WARMUP_IMAGE_SIZE))
+    if not os.path.isfile(path):
+        Image.new('RGB', WARMUP_IMAGE_SIZE, (128, 128, 128)).save(path)
+    return path
+
+
+def get_declared_memory(trained_model):
+    """
+    :param trained_model: TrainedModel, its arguments may declare the memory the model uses as memory_mb
+    :return: declared memory in bytes or None
+    """
+    memory_mb = (trained_model.arguments or {}).get('memory_mb')
+    return int(memory_mb * 1024 * 1024) if memory_mb else None
+
+
+class ModelRuntime(object):
+    """
+    Owns the indexers, detectors and analyzers loaded by this worker process. Models are loaded through acquire,
+    which records the memory each model takes and evicts the least recently used models when the total exceeds
+    settings.MODEL_MEMORY_BUDGET. The memory is either declared by the TrainedModel or measured as the growth of
+    resident memory while loading and running a warm up image, since TensorFlow only allocates most of its memory
+    on the first run. Evicted models close their session / drop their graph and are loaded again on their next
+    acquire. Models acquired inside a pinned block are not evicted until the block exits, so that a task using
+    several models does not evict one of them while loading another.
+    """
+    _models = OrderedDict()  # least recently used first
+    _memory = {}
+    _stats = defaultdict(int)
+    _load_time = defaultdict(float)
+    _warmup_time = {}
+    _pins = defaultdict(int)
+    _local = threading.local()
+    _lock = threading.RLock()
+
+    @classmethod
+    def acquire(cls, key, model, memory=None):
+        """
+        :param key: e.g. ('indexer', TrainedModel pk)
+        :param model: dvalib indexer / detector / analyzer
+        :param memory: declared memory of the model in bytes, measured when None
+        :return: loaded model
+        """
+        with cls._lock:
+            cls.pin(key)
+            if key in cls._models:
+                cls._models[key] = cls._models.pop(key)
+                cls._stats['hits'] += 1
+                return model
+            budget = settings.MODEL_MEMORY_BUDGET
+            if memory:
+                cls._memory[key] = memory
+            if budget and key in cls._memory:
+                cls.evict_until(budget - cls._memory[key], keep={key})
+            rss, start = get_rss(), time.time()
+            model.load()
+            if not memory:
+                try:
+                    model.warmup(get_warmup_image())
+                except Exception:
+                    logging.exception("Could not warm up {}, memory is measured after load only".format(key))
+                cls._memory[key] = max(get_rss() - rss, 0)
+            cls._load_time[key] += time.time() - start
+            cls._models[key] = model
+            cls._stats['loads'] += 1
+            logging.info("loaded {} in {:.1f}s using {} bytes, {} bytes used by {} models".format(
+                key, time.time() - start, cls._memory[key], cls.memory_usage(), len(cls._models)))
+            if budget:
+                cls.evict_until(budget, keep={key})
+        return model
+
+    @classmethod
+    @contextmanager
+    def pinned(cls):
+        """
+        Models acquired by this thread inside the block are not evicted before it exits.
+        """
+        scopes = getattr(cls._local, 'scopes', None)
+        if scopes is None:
+            scopes = cls._local.scopes = []
+        scopes.append(set())
+        try:
+            yield
+        finally:
+            with cls._lock:
+                for key in scopes.pop():
+                    cls._pins[key] -= 1
+                    if cls._pins[key] <= 0:
+                        del cls._pins[key]
+
+    @classmethod
+    def pin(cls, key):
+        scopes = getattr(cls._local, 'scopes', None)
+        if scopes and key not in scopes[-1]:
+            scopes[-1].add(key)
+            cls._pins[key] += 1
+
+    @classmethod
+    def warmup(cls, trained_model):
+        """
+        Load an indexer, detector or analyzer and run a blank image through it, so that graph parsing, session
+        creation and the slow first run happen before the first task. Models acquired without a declared memory
+        already run the warm up image while being measured.
+        :param trained_model: TrainedModel
+        :return: seconds spent loading and warming up
+        """
+        start = time.time()
+        if trained_model.model_type == TrainedModel.INDEXER:
+            from .indexing import Indexers
+            model = Indexers.get_index(trained_model)
+        elif trained_model.model_type == TrainedModel.DETECTOR:
+            from .detection import Detectors
+            model = Detectors.load_detector(trained_model)
+        elif trained_model.model_type == TrainedModel.ANALYZER:
+            from .analysis import Analyzers
+            model = Analyzers.load_analyzer(trained_model)
+        else:
+            raise ValueError("Cannot warm up {} of type {}".format(trained_model.name, trained_model.model_type))
+        if get_declared_memory(trained_model):
+            model.warmup(get_warmup_image())
+        elapsed = time.time() - start
+        cls._warmup_time[(trained_model.model_type, trained_model.pk)] = elapsed
+        logging.info("warmed up {} in {:.1f}s".format(trained_model.name, elapsed))
+        return elapsed
+
+    @classmethod
+    def evict_until(cls, budget, keep=()):
+        """
+        Evict least recently used models until budget is met, models in keep and pinned models are never evicted.
+        """
+        while cls.memory_usage() > budget:
+            candidates = [k for k in cls._models if k not in keep and k not in cls._pins]
+            if not candidates:
+                break
+            cls.evict(candidates[0])
+
+    @classmethod
+    def evict(cls, key):
+        with cls._lock:
+            model = cls._models.pop(key, None)
+            if model is not None:
+                model.unload()
+                gc.collect()
+                cls._stats['evictions'] += 1
+                logging.info("evicted {} to release {} bytes".format(key, cls._memory.get(key, 0)))
+
+    @classmethod
+    def memory_usage(cls):
+        return sum(cls._memory[k] for k in cls._models)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                'pid': os.getpid(),
+                'budget': settings.MODEL_MEMORY_BUDGET,
+                'memory_usage': cls.memory_usage(),
+                'loads': cls._stats['loads'],
+                'hits': cls._stats['hits'],
+                'evictions': cls._stats['evictions'],
+                'warmup': [{'model': list(k), 'time': t} for k, t in cls._warmup_time.items()],
+                'models': [{'key': list(k), 'memory': cls._memory[k], 'load_time': cls._load_time[k]}
+                           for k in cls._models]
+            }
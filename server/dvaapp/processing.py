@@ -27,6 +27,7 @@ SYNC_TASKS = {
     'perform_transformation': [{'operation': 'perform_sync', 'arguments': {'dirname': 'regions'}}, ],
     'perform_indexing': [{'operation': 'perform_sync', 'arguments': {'dirname': 'indexes'}}, ],
     'perform_index_approximation': [{'operation': 'perform_sync', 'arguments': {'dirname': 'indexes'}}, ],
+    'perform_index_compaction': [],
     'perform_import': [{'operation': 'perform_sync', 'arguments': {}}, ],
     'perform_training': [],
     'perform_stream_capture': [],
@@ -79,6 +80,12 @@ def get_model_specific_queue_name(operation, args):
         if args['retriever'] not in RETRIEVER_NAME_TO_PK:
             RETRIEVER_NAME_TO_PK[args['retriever']] = Retriever.objects.get(name=args['retriever']).pk
         queue_name = 'q_retriever_{}'.format(RETRIEVER_NAME_TO_PK[args['retriever']])
+    # detections that also embed regions have both detector and index, they run on the detector queue
+    elif 'detector' in args:
+        if args['detector'] not in DETECTOR_NAME_TO_PK:
+            DETECTOR_NAME_TO_PK[args['detector']] = TrainedModel.objects.get(name=args['detector'],
+                                                                             model_type=TrainedModel.DETECTOR).pk
+        queue_name = 'q_detector_{}'.format(DETECTOR_NAME_TO_PK[args['detector']])
     elif 'index' in args:
         if args['index'] not in INDEXER_NAME_TO_PK:
             INDEXER_NAME_TO_PK[args['index']] = TrainedModel.objects.get(name=args['index'],
@@ -101,11 +108,6 @@ def get_model_specific_queue_name(operation, args):
             ANALYER_NAME_TO_PK[args['analyzer']] = TrainedModel.objects.get(name=args['analyzer'],
                                                                             model_type=TrainedModel.ANALYZER).pk
         queue_name = 'q_analyzer_{}'.format(ANALYER_NAME_TO_PK[args['analyzer']])
-    elif 'detector' in args:
-        if args['detector'] not in DETECTOR_NAME_TO_PK:
-            DETECTOR_NAME_TO_PK[args['detector']] = TrainedModel.objects.get(name=args['detector'],
-                                                                             model_type=TrainedModel.DETECTOR).pk
-        queue_name = 'q_detector_{}'.format(DETECTOR_NAME_TO_PK[args['detector']])
     else:
         raise NotImplementedError("{}, {}".format(operation, args))
     return queue_name
@@ -121,7 +123,12 @@ def get_model_pk_from_args(operation, args):
     elif 'retriever_pk' in args:
         return args['retriever_pk']
     elif 'analyzer_pk' in args:
-        return ['analyzer_pk']
+        return args['analyzer_pk']
+    elif 'detector' in args:
+        if args['detector'] not in DETECTOR_NAME_TO_PK:
+            DETECTOR_NAME_TO_PK[args['detector']] = TrainedModel.objects.get(name=args['detector'],
+                                                                             model_type=TrainedModel.DETECTOR).pk
+        return DETECTOR_NAME_TO_PK[args['detector']]
     elif 'index' in args:
         if args['index'] not in INDEXER_NAME_TO_PK:
             INDEXER_NAME_TO_PK[args['index']] = TrainedModel.objects.get(name=args['index'],
@@ -132,11 +139,6 @@ def get_model_pk_from_args(operation, args):
             ANALYER_NAME_TO_PK[args['analyzer']] = TrainedModel.objects.get(name=args['analyzer'],
                                                                             model_type=TrainedModel.ANALYZER).pk
         return ANALYER_NAME_TO_PK[args['analyzer']]
-    elif 'detector' in args:
-        if args['detector'] not in DETECTOR_NAME_TO_PK:
-            DETECTOR_NAME_TO_PK[args['detector']] = TrainedModel.objects.get(name=args['detector'],
-                                                                             model_type=TrainedModel.DETECTOR).pk
-        return DETECTOR_NAME_TO_PK[args['detector']]
     elif 'approximator_shasum' in args:
         ashasum = args['approximator_shasum']
         if ashasum not in APPROXIMATOR_SHASUM_TO_PK:
@@ -277,7 +279,8 @@ def launch_tasks(k, dt, inject_filters, map_filters=None, launch_type=""):
     return tids
 
 
-def process_next(dt, inject_filters=None, custom_next_tasks=None, sync=True, launch_next=True, map_filters=None):
+def process_next(dt, inject_filters=None, custom_next_tasks=None, sync=True, launch_next=True, map_filters=None,
+                 launch_reduce=True):
     if custom_next_tasks is None:
         custom_next_tasks = []
     task_id = dt.pk
@@ -286,7 +289,15 @@ def process_next(dt, inject_filters=None, custom_next_tasks=None, sync=True, lau
     logging.info("next tasks for {}".format(dt.operation))
     next_tasks = args.get('map', []) if args and launch_next else []
     if sync and settings.MEDIA_BUCKET:
-        for k in SYNC_TASKS.get(dt.operation, []):
+        sync_tasks = SYNC_TASKS.get(dt.operation, [])
+        if dt.operation == 'perform_detection':
+            if 'index' in args:
+                # detection that also embedded the detected regions wrote index files
+                sync_tasks = sync_tasks + SYNC_TASKS['perform_indexing']
+            if args.get('target', None) == 'segments':
+                # frames with detections were written by the detection
+                sync_tasks = sync_tasks + SYNC_TASKS['perform_video_decode']
+        for k in sync_tasks:
             if settings.ENABLE_CLOUDFS:
                 dirname = k['arguments'].get('dirname', None)
                 task_shared.upload(dirname, task_id, dt.video_id)
@@ -296,7 +307,7 @@ def process_next(dt, inject_filters=None, custom_next_tasks=None, sync=True, lau
         if map_filters is None:
             map_filters = get_map_filters(k, dt.video)
         launched += launch_tasks(k, dt, inject_filters, map_filters, 'map')
-    for reduce_task in args.get('reduce', []):
+    for reduce_task in (args.get('reduce', []) if launch_reduce else []):
         next_task = TEvent.objects.create(video=dt.video, operation="perform_reduce",
                                           arguments=reduce_task['arguments'], parent=dt,
                                           task_group_id=reduce_task['task_group_id'],
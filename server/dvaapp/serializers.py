@@ -60,7 +60,7 @@ class TrainingSetSerializer(serializers.HyperlinkedModelSerializer):
 class WorkerSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Worker
-        fields = ('queue_name', 'id')
+        fields = ('queue_name', 'id', 'warmup_time')
 
 
 class FrameSerializer(serializers.HyperlinkedModelSerializer):
@@ -72,7 +72,7 @@ class FrameSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Frame
         fields = ('url', 'media_url', 'video', 'frame_index', 'keyframe', 'w', 'h', 't',
-                  'name', 'id', 'segment_index')
+                  'name', 'id', 'segment_index', 'scale')
 
 
 class SegmentSerializer(serializers.HyperlinkedModelSerializer):
@@ -275,7 +275,7 @@ class TubeRegionRelationExportSerializer(serializers.ModelSerializer):
 class FrameExportSerializer(serializers.ModelSerializer):
     class Meta:
         model = Frame
-        fields = ('frame_index', 'keyframe', 'w', 'h', 't', 'event', 'name', 'id', 'segment_index')
+        fields = ('frame_index', 'keyframe', 'w', 'h', 't', 'event', 'name', 'id', 'segment_index', 'scale')
 
 
 class IndexEntryExportSerializer(serializers.ModelSerializer):
@@ -530,6 +530,7 @@ class VideoImporter(object):
                     entry['detection_primary_key'] = self.region_to_pk[entry['detection_primary_key']]
                 if 'frame_primary_key' in entry:
                     entry['frame_primary_key'] = self.frame_to_pk[entry['frame_primary_key']]
+                entry['video_primary_key'] = self.video.pk
                 transformed.append(entry)
             di.entries = transformed
             di.save()
@@ -615,6 +616,7 @@ class VideoImporter(object):
         df.event_id = self.event_to_pk[f['event']]
         df.segment_index = f.get('segment_index', 0)
         df.keyframe = f.get('keyframe', False)
+        df.scale = f.get('scale', 1.0)
         return df
 
     def import_tubes(self, tubes, video_obj):
@@ -1,5 +1,5 @@
 from django.conf import settings
-from .operations import indexing, detection, analysis, approximation, retrieval
+from .operations import indexing, detection, analysis, approximation, retrieval, compaction, decoding, runtime
 import io
 import logging
 import tempfile
@@ -75,6 +75,19 @@ def handle_perform_index_approximation(start):
     return True
 
 
+def handle_perform_index_compaction(start):
+    args = start.arguments
+    if 'indexer_shasum' not in args:
+        raise ValueError("indexer_shasum is required for index compaction {}".format(args))
+    shards = compaction.compact_index_entries(start, args['indexer_shasum'],
+                                              approximator_shasum=args.get('approximator_shasum', None),
+                                              filters=args.get('filters', None),
+                                              max_shard_rows=args.get('max_shard_rows',
+                                                                      compaction.DEFAULT_MAX_SHARD_ROWS),
+                                              min_index_entries=args.get('min_index_entries', 2))
+    return shards
+
+
 def handle_perform_detection(start):
     video_id = start.video_id
     args = start.arguments
@@ -89,28 +102,51 @@ def handle_perform_detection(start):
     else:
         detector_name = args['detector']
         cd = models.TrainedModel.objects.get(name=detector_name, model_type=models.TrainedModel.DETECTOR)
-    detection.Detectors.load_detector(cd)
-    detector = detection.Detectors._detectors[cd.pk]
-    if detector.session is None:
-        logging.info("loading detection model")
-        detector.load()
-    if query_flow:
-        local_path = task_shared.download_and_get_query_path(start)
-        frame_detections_list.append((None, detector.detect(local_path)))
-    else:
-        if 'target' not in args:
-            args['target'] = 'frames'
-        dv = models.Video.objects.get(id=video_id)
-        queryset, target = task_shared.build_queryset(args, video_id, start.parent_process_id)
-        task_shared.ensure_files(queryset, target)
-        for k in queryset:
-            if target == 'frames':
-                local_path = k.path()
-            elif target == 'regions':
-                local_path = k.frame_path()
+    # keep the detector loaded while the indexer is acquired and both are used
+    with runtime.ModelRuntime.pinned():
+        detector = detection.Detectors.load_detector(cd)
+        visual_index, di, features = None, None, None
+        if 'index' in args:
+            # embed detected regions in the same pass instead of a separate perform_indexing task on the regions
+            visual_index, di = indexing.Indexers.get_index_by_name(args['index'])
+        if query_flow:
+            local_path = task_shared.download_and_get_query_path(start)
+            if visual_index is not None:
+                detections_list, features = detection.Detectors.detect_and_index(detector, visual_index, [local_path, ])
+                frame_detections_list.append((None, detections_list[0]))
+            else:
+                frame_detections_list.append((None, detector.detect(local_path)))
+        else:
+            if 'target' not in args:
+                args['target'] = 'frames'
+            dv = models.Video.objects.get(id=video_id)
+            queryset, target = task_shared.build_queryset(args, video_id, start.parent_process_id)
+            task_shared.ensure_files(queryset, target)
+            if target == 'segments':
+                # frameless: segments are decoded in memory and only frames with detections are written
+                decoder = decoding.VideoDecoder(dvideo=dv, media_dir=settings.MEDIA_ROOT,
+                                                rescale=args.get('rescale', 0))
+                frame_detections_list, features = detection.Detectors.detect_segments(
+                    decoder, detector, visual_index, queryset, start.pk,
+                    args.get('batch_size', settings.DEFAULT_SEGMENT_DETECTION_BATCH_SIZE),
+                    materialize=args.get('materialize_frames', False), denominator=args.get('rate', 30),
+                    sampling=args.get('sampling', None), fps=args.get('fps', None))
             else:
-                raise NotImplementedError("Invalid target:{}".format(target))
-            frame_detections_list.append((k, detector.detect(local_path)))
+                objects, paths = [], []
+                for k in queryset:
+                    if target == 'frames':
+                        paths.append(k.path())
+                    elif target == 'regions':
+                        paths.append(k.frame_path())
+                    else:
+                        raise NotImplementedError("Invalid target:{}".format(target))
+                    objects.append(k)
+                if visual_index is not None:
+                    detections_list, features = detection.Detectors.detect_and_index(detector, visual_index, paths)
+                    frame_detections_list = zip(objects, detections_list)
+                else:
+                    for k, (_, detections) in zip(objects, detector.detect_batch(paths)):
+                        frame_detections_list.append((k, detections))
     for df, detections in frame_detections_list:
         for d in detections:
             dd = models.QueryRegion() if query_flow else models.Region()
@@ -138,22 +174,41 @@ def handle_perform_detection(start):
             dd.event_id = start.pk
             dd_list.append(dd)
     if query_flow:
-        _ = models.QueryRegion.objects.bulk_create(dd_list, 1000)
+        dd_list = models.QueryRegion.objects.bulk_create(dd_list, 1000)
     else:
-        _ = models.Region.objects.bulk_create(dd_list, 1000)
+        dd_list = models.Region.objects.bulk_create(dd_list, 1000)
+    if features is not None:
+        store_region_features(start, di, dd_list, features, query_flow)
     return query_flow
 
 
+def store_region_features(start, di, regions, features, query_flow):
+    """
+    Store features of regions created by a detection that embedded them in the same pass, as query region vectors
+    for the query flow and as IndexEntries of the regions otherwise.
+    """
+    if query_flow:
+        for dr, vector in zip(regions, features):
+            s = io.BytesIO()
+            np.save(s, vector)
+            redis_client.hset("query_region_vectors_{}".format(start.pk), dr.pk, s.getvalue())
+    elif regions:
+        entries = [{'frame_index': dr.frame_index,
+                    'detection_primary_key': dr.pk,
+                    'frame_primary_key': dr.frame_id,
+                    'video_primary_key': dr.video_id,
+                    'index': i,
+                    'type': dr.region_type} for i, dr in enumerate(regions)]
+        indexing.Indexers.save_index_entries(di, start, 'regions', entries, features)
+
+
 def handle_perform_analysis(start):
-    task_id = start.pk
     video_id = start.video_id
     args = start.arguments
     analyzer_name = args['analyzer']
-    if analyzer_name not in analysis.Analyzers._analyzers:
-        da = models.TrainedModel.objects.get(name=analyzer_name, model_type=models.TrainedModel.ANALYZER)
-        analysis.Analyzers.load_analyzer(da)
-    analyzer = analysis.Analyzers._analyzers[analyzer_name]
-    regions_batch = []
+    da = models.TrainedModel.objects.get(name=analyzer_name, model_type=models.TrainedModel.ANALYZER)
+    analyzer = analysis.Analyzers.load_analyzer(da)
+    batch = []
     queryset, target = task_shared.build_queryset(args, video_id, start.parent_process_id)
     query_path = None
     query_regions_paths = None
@@ -163,10 +218,11 @@ def handle_perform_analysis(start):
         query_regions_paths = task_shared.download_and_get_query_region_path(start, queryset)
     else:
         task_shared.ensure_files(queryset, target)
+    query_flow = bool(query_regions_paths or query_path)
     image_data = {}
-    source_regions = []
     temp_root = tempfile.mkdtemp()
     for i, f in enumerate(queryset):
+        source_region = None
         if query_regions_paths:
             path = query_regions_paths[i]
             a = models.QueryRegion()
@@ -196,7 +252,7 @@ def handle_perform_analysis(start):
                 a.frame_id = f.frame.id
                 a.frame_index = f.frame_index
                 a.segment_index = f.segment_index
-                source_regions.append(f)
+                source_region = f
                 path = f.crop_and_get_region_path(image_data, temp_root)
             elif target == 'frames':
                 a.full_frame = True
@@ -206,22 +262,38 @@ def handle_perform_analysis(start):
                 path = f.path()
             else:
                 raise NotImplementedError
-        object_name, text, metadata, _ = analyzer.apply(path)
+        batch.append((a, path, source_region))
+        if len(batch) == settings.DEFAULT_ANALYSIS_BATCH_SIZE:
+            apply_analyzer_batch(start, analyzer, batch, query_flow)
+            batch = []
+    if batch:
+        apply_analyzer_batch(start, analyzer, batch, query_flow)
+
+
+def apply_analyzer_batch(start, analyzer, batch, query_flow):
+    """
+    Run the analyzer over a batch of (annotation region, image path, source region) and bulk create annotation
+    regions along with relations to their source regions.
+    """
+    regions_batch = []
+    results = analyzer.apply_batch([path for _, path, _ in batch])
+    for (a, _, _), (object_name, text, metadata, _) in zip(batch, results):
         a.region_type = models.Region.ANNOTATION
         a.object_name = object_name
         a.text = text
         a.metadata = metadata
-        a.event_id = task_id
+        a.event_id = start.pk
         regions_batch.append(a)
-    if query_regions_paths or query_path:
+    if query_flow:
         models.QueryRegion.objects.bulk_create(regions_batch, 1000)
     else:
         region_list = models.Region.objects.bulk_create(regions_batch, 1000)
         relations = []
-        if target == 'regions':
-            for i,k in enumerate(region_list):
-                relations.append(models.RegionRelation(source_region_id=source_regions[i].id,target_region_id=k.id,
+        for (_, _, source_region), k in zip(batch, region_list):
+            if source_region is not None:
+                relations.append(models.RegionRelation(source_region_id=source_region.id, target_region_id=k.id,
                                                        name='analysis', event_id=start.pk, video_id=start.video_id))
+        if relations:
             models.RegionRelation.objects.bulk_create(relations, 1000)
 
 
@@ -6,7 +6,8 @@ from PIL import Image
 from . import serializers
 from dva.in_memory import redis_client
 from .fs import ensure, upload_file_to_remote, upload_video_to_remote, get_path_to_file, \
-    download_video_from_remote_to_local, upload_file_to_path
+    download_video_from_remote_to_local, upload_file_to_path, Downloader
+from .operations.dataset import get_image_size
 from dva.celery import app
 from django.apps import apps
 
@@ -191,33 +192,31 @@ def build_queryset(args, video_id=None, query_id=None, target=None, filters=None
     return queryset, target
 
 
-def load_frame_list(dv, event_id, frame_index__gte=0, frame_index__lt=-1):
+def load_frame_list(dv, event_id, frame_index__gte=0, frame_index__lt=-1, concurrency=1):
     """
     Add ability load frames & regions specified in a JSON file and then automatically
     retrieve them in a distributed manner them through CPU workers.
+    Frames are downloaded to their final path by concurrency threads, which also read their sizes.
+    :return: download stats
     """
     frame_list = dv.get_frame_list()
-    temp_path = "{}.jpg".format(uuid.uuid1()).replace('-', '_')
     video_id = dv.pk
+    selected = list(enumerate(frame_list['frames']))[frame_index__gte:None if frame_index__lt < 0 else frame_index__lt]
+    downloader = Downloader(concurrency, settings.DOWNLOAD_RETRIES, settings.DOWNLOAD_BACKOFF_SECONDS)
+    items = [(f['path'], "{}/{}/frames/{}.jpg".format(settings.MEDIA_ROOT, video_id, i)) for i, f in selected]
+    sizes = downloader.download_all(items, process=get_image_size)
     frame_index_to_regions = {}
     frames = []
-    for i, f in enumerate(frame_list['frames']):
-        if i == frame_index__lt:
-            break
-        elif i >= frame_index__gte:
-            try:
-                get_path_to_file(f['path'], temp_path)
-                im = Image.open(temp_path)
-                w, h = im.size
-                im.close()
-            except:
-                logging.exception("Failed to get {}".format(f['path']))
-                pass
-            else:
-                df, drs = serializers.import_frame_json(f, i, event_id, video_id, w, h)
-                frame_index_to_regions[i] = drs
-                frames.append(df)
-                shutil.move(temp_path, df.path())
+    for (i, f), (_, local_path), size in zip(selected, items, sizes):
+        if size is None:
+            if os.path.isfile(local_path):
+                logging.info("Could not open {} skipping".format(f['path']))
+                os.remove(local_path)
+        else:
+            w, h = size
+            df, drs = serializers.import_frame_json(f, i, event_id, video_id, w, h)
+            frame_index_to_regions[i] = drs
+            frames.append(df)
     fids = Frame.objects.bulk_create(frames, 1000)
     regions = []
     for f in fids:
@@ -226,6 +225,7 @@ def load_frame_list(dv, event_id, frame_index__gte=0, frame_index__lt=-1):
             dr.frame_id = f.id
             regions.append(dr)
     Region.objects.bulk_create(regions, 1000)
+    return downloader.stats
 
 
 def download_and_get_query_path(start):
@@ -12,6 +12,7 @@ from .operations.decoding import VideoDecoder
 from .operations.dataset import DatasetCreator
 from .operations.training import train_lopq, train_faiss
 from .operations.livestreaming import LivestreamCapture
+from .operations.runtime import ModelRuntime
 from .processing import process_next, mark_as_completed
 from . import global_model_retriever
 from . import task_handlers
@@ -42,6 +43,25 @@ def configure_workers(sender, conf, **kwargs):
     W.last_ping = timezone.now()
     W.queue_name = sender.split('@')[1].split('.')[0]
     W.save()
+    if W.queue_name.startswith('q_retriever_'):
+        Retrievers.start_index_update_listener(retriever_pks=[int(W.queue_name.split('_')[-1])])
+    elif W.queue_name == settings.GLOBAL_RETRIEVER:
+        Retrievers.start_index_update_listener()
+    elif settings.PRELOAD_MODELS and W.queue_name.startswith(('q_indexer_', 'q_detector_', 'q_analyzer_')):
+        warmup_worker(W)
+
+
+def warmup_worker(worker):
+    """
+    Load and warm up the model of a model specific worker before it starts consuming tasks and record the time spent.
+    """
+    trained_model = models.TrainedModel.objects.get(pk=int(worker.queue_name.split('_')[-1]))
+    try:
+        worker.warmup_time = ModelRuntime.warmup(trained_model)
+    except:
+        logging.exception("Could not warm up {}".format(trained_model.name))
+    else:
+        worker.save()
 
 
 @task_prerun.connect
@@ -139,9 +159,14 @@ def perform_indexing(task_id):
     dt = get_and_check_task(task_id)
     if dt is None:
         return 0
-    sync = task_handlers.handle_perform_indexing(dt)
+    if dt.queue.startswith(settings.GLOBAL_MODEL):
+        sync = global_model_retriever.run_task_in_model_server(dt)
+    else:
+        sync = task_handlers.handle_perform_indexing(dt)
     next_ids = process_next(dt, sync=sync)
     mark_as_completed(dt)
+    if dt.arguments.get('target', 'frames') not in {'query', 'query_regions'}:
+        Retrievers.publish_index_update()
     return next_ids
 
 
@@ -153,9 +178,29 @@ def perform_index_approximation(task_id):
     sync = task_handlers.handle_perform_index_approximation(dt)
     next_ids = process_next(dt, sync=sync)
     mark_as_completed(dt)
+    if dt.arguments.get('target', 'frames') not in {'query', 'query_regions'}:
+        Retrievers.publish_index_update()
     return next_ids
 
 
+@app.task(track_started=True, name="perform_index_compaction")
+def perform_index_compaction(task_id):
+    """
+    Merge completed IndexEntries of an indexer (and optionally approximator) into large contiguous shards
+    which retrievers load instead of opening each IndexEntries file.
+    :param task_id:
+    :return:
+    """
+    dt = get_and_check_task(task_id)
+    if dt is None:
+        return 0
+    task_handlers.handle_perform_index_compaction(dt)
+    process_next(dt)
+    mark_as_completed(dt)
+    Retrievers.publish_index_update()
+    return 0
+
+
 @app.task(track_started=True, name="perform_transformation")
 def perform_transformation(task_id):
     """
@@ -200,10 +245,11 @@ def perform_retrieval(task_id):
         Retrievers.retrieve(dt, args.get('retriever_pk', 20), vector, args.get('count', 20))
     elif target == 'query_region_index_vectors':
         qr_pk_vector = redis_client.hgetall("query_region_vectors_{}".format(dt.parent_id))
+        region_pks, vectors = [], []
         for query_region_pk, vector in qr_pk_vector.items():
-            vector = np.load(io.BytesIO(vector))
-            Retrievers.retrieve(dt, args.get('retriever_pk', 20), vector, args.get('count', 20),
-                                region_pk=query_region_pk)
+            region_pks.append(query_region_pk)
+            vectors.append(np.load(io.BytesIO(vector)))
+        Retrievers.retrieve_batch(dt, args.get('retriever_pk', 20), vectors, args.get('count', 20), region_pks)
     else:
         raise NotImplementedError(target)
     mark_as_completed(dt)
@@ -244,8 +290,19 @@ def perform_dataset_extraction(task_id):
     task_shared.ensure('/{}/video/{}.zip'.format(video_id, video_id))
     dv.create_directory(create_subdirs=True)
     v = DatasetCreator(dvideo=dv, media_dir=settings.MEDIA_ROOT)
-    v.extract(dt)
-    process_next(dt)
+    batch_size = args.get('batch_size', settings.DEFAULT_FRAMES_BATCH_SIZE)
+    concurrency = args.get('concurrency', settings.DEFAULT_EXTRACTION_CONCURRENCY)
+    if args.get('stream_batches', False) and not settings.MEDIA_BUCKET:
+        # next tasks of each batch start as soon as its Frames exist, with a bucket they would miss the frames which
+        # are only synced at the end
+        def launch_batch(gte, lt):
+            process_next(dt, sync=False, map_filters=[{'frame_index__gte': gte, 'frame_index__lt': lt}],
+                         launch_reduce=False)
+        v.extract(dt, batch_size, concurrency, launch_batch)
+        process_next(dt, launch_next=False)
+    else:
+        v.extract(dt, batch_size, concurrency)
+        process_next(dt)
     mark_as_completed(dt)
     return 0
 
@@ -270,6 +327,9 @@ def perform_video_segmentation(task_id):
     v.segment_video(task_id)
     if args.get('sync', False):
         next_args = {'rescale': args['rescale'], 'rate': args['rate']}
+        for k in ['sampling', 'fps', 'scene_threshold']:
+            if k in args:
+                next_args[k] = args[k]
         next_task = models.TEvent.objects.create(video=dv, operation='perform_video_decode', arguments=next_args,
                                                  parent=dt)
         perform_video_decode(next_task.pk)  # decode it synchronously for testing in Travis
@@ -291,15 +351,16 @@ def perform_video_decode(task_id):
     dv.create_directory()
     kwargs = args.get('filters', {})
     kwargs['video_id'] = video_id
-    v = VideoDecoder(dvideo=dv, media_dir=settings.MEDIA_ROOT)
+    v = VideoDecoder(dvideo=dv, media_dir=settings.MEDIA_ROOT, rescale=args.get('rescale', 0))
     if 'target' not in args:
         args['target'] = 'segments'
     queryset, target = task_shared.build_queryset(args, video_id, dt.parent_process_id)
     if target != 'segments':
         raise NotImplementedError("Cannot decode target:{}".format(target))
     task_shared.ensure_files(queryset, target)
-    for ds in queryset:
-        v.decode_segment(ds=ds, denominator=args.get('rate', 30), event_id=task_id)
+    v.decode_segments(queryset, args.get('concurrency', settings.DEFAULT_DECODE_CONCURRENCY), event_id=task_id,
+                      denominator=args.get('rate', 30), sampling=args.get('sampling', None), fps=args.get('fps', None),
+                      scene_threshold=args.get('scene_threshold', None))
     process_next(dt)
     mark_as_completed(dt)
     return task_id
@@ -312,12 +373,13 @@ def perform_detection(task_id):
         return 0
     query_flow = ('target' in dt.arguments and dt.arguments['target'] == 'query')
     if dt.queue.startswith(settings.GLOBAL_MODEL):
-        logging.info("Running in new process")
-        global_model_retriever.run_task_in_model_specific_flask_server(dt)
+        global_model_retriever.run_task_in_model_server(dt)
     else:
         task_handlers.handle_perform_detection(dt)
-    launched = process_next(dt)
+    launched = process_next(dt, sync=not query_flow)
     mark_as_completed(dt)
+    if 'index' in dt.arguments and not query_flow:
+        Retrievers.publish_index_update()
     if query_flow:
         return launched
     else:
@@ -329,7 +391,10 @@ def perform_analysis(task_id):
     dt = get_and_check_task(task_id)
     if dt is None:
         return 0
-    task_handlers.handle_perform_analysis(dt)
+    if dt.queue.startswith(settings.GLOBAL_MODEL):
+        global_model_retriever.run_task_in_model_server(dt)
+    else:
+        task_handlers.handle_perform_analysis(dt)
     process_next(dt)
     mark_as_completed(dt)
     return 0
@@ -406,6 +471,7 @@ def perform_import(task_id):
         task_shared.import_path(dv, path, export=True)
         logging.info("loading exported file {}".format(path))
         task_shared.load_dva_export_file(dv)
+        Retrievers.publish_index_update()
     # Download and import .mp4 and .zip files which contain raw video / images.
     elif path.startswith('/') and settings.ENABLE_CLOUDFS and not (export_file or framelist_file):
         # TODO handle case when going from s3 ---> gs and gs ---> s3
@@ -456,10 +522,13 @@ def perform_frame_download(task_id):
         fs.ensure('/{}/framelist.json'.format(dv.pk), safe=True, event_id=task_id)
     filters = dt.arguments['filters']
     dv.create_directory(create_subdirs=True)
-    task_shared.load_frame_list(dv, dt.pk, frame_index__gte=filters['frame_index__gte'],
-                                frame_index__lt=filters.get('frame_index__lt', -1))
+    stats = task_shared.load_frame_list(dv, dt.pk, frame_index__gte=filters['frame_index__gte'],
+                                        frame_index__lt=filters.get('frame_index__lt', -1),
+                                        concurrency=dt.arguments.get('concurrency',
+                                                                     settings.DEFAULT_DOWNLOAD_CONCURRENCY))
     process_next(dt)
     mark_as_completed(dt)
+    return stats
 
 
 @app.task(track_started=True, name="perform_sync")
@@ -43,6 +43,10 @@ def inception_preprocess(image, central_fraction=0.875):
     return tf.subtract(image, 1.0)
 
 
+def inception_preprocess_batch(images):
+    return tf.map_fn(lambda image: inception_preprocess(image)[0], images, dtype=tf.float32)
+
+
 class OpenImagesAnnotator(BaseAnnotator):
 
     def __init__(self,model_path,gpu_fraction=None):
@@ -80,20 +84,26 @@ class OpenImagesAnnotator(BaseAnnotator):
             config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
             g = tf.Graph()
             with g.as_default():
-                self.input_image = tf.placeholder(tf.string)
-                processed_image = inception_preprocess(self.input_image)
+                self.input_image = tf.placeholder(tf.string, shape=[None])
+                processed_images = inception_preprocess_batch(self.input_image)
                 with slim.arg_scope(inception.inception_v3_arg_scope()):
-                    logits, end_points = inception.inception_v3(processed_image, num_classes=self.num_classes, is_training=False)
+                    logits, end_points = inception.inception_v3(processed_images, num_classes=self.num_classes, is_training=False)
                 self.predictions = end_points['multi_predictions'] = tf.nn.sigmoid(logits, name='multi_predictions')
                 saver = tf_saver.Saver()
                 self.session = tf.InteractiveSession(config=config)
                 saver.restore(self.session, self.network_path)
 
     def apply(self,image_path):
+        return self.apply_batch([image_path])[0]
+
+    def apply_batch(self,image_paths):
         if self.session is None:
             self.load()
-        img_data = tf.gfile.FastGFile(image_path).read()
-        predictions_eval = np.squeeze(self.session.run(self.predictions, {self.input_image: img_data}))
+        img_data = [tf.gfile.FastGFile(image_path).read() for image_path in image_paths]
+        predictions_eval = self.session.run(self.predictions, {self.input_image: img_data})
+        return [self.get_tags(p) for p in predictions_eval]
+
+    def get_tags(self,predictions_eval):
         results = {self.label_dict.get(self.labelmap[idx], 'unknown'):predictions_eval[idx]
                    for idx in predictions_eval.argsort()[-self.top_n:][::-1]}
         labels = [t for t,v in results.iteritems() if v > 0.1]
@@ -125,21 +135,24 @@ class CRNNAnnotator(BaseAnnotator):
         self.transformer = dataset.resizeNormalize((100, 32))
 
     def apply(self,image_path):
+        return self.apply_batch([image_path])[0]
+
+    def apply_batch(self,image_paths):
         if self.session is None:
             self.load()
-        image = Image.open(image_path).convert('L')
+        images = torch.stack([self.transformer(Image.open(image_path).convert('L')) for image_path in image_paths])
         if self.cuda:
-            image = self.transformer(image).cuda()
-        else:
-            image = self.transformer(image)
-        image = image.view(1, *image.size())
-        image = Variable(image)
-        preds = self.session(image)
+            images = images.cuda()
+        images = Variable(images)
+        preds = self.session(images)
         _, preds = preds.max(2)
+        # preds is (sequence length, batch), decode expects sequences of each image concatenated
+        preds_size = Variable(torch.IntTensor([preds.size(0)] * len(image_paths)))
         preds = preds.transpose(1, 0).contiguous().view(-1)
-        preds_size = Variable(torch.IntTensor([preds.size(0)]))
-        sim_pred = self.converter.decode(preds.data, preds_size.data, raw=False)
-        return self.object_name,sim_pred,{},None
+        sim_preds = self.converter.decode(preds.data, preds_size.data, raw=False)
+        if len(image_paths) == 1:
+            sim_preds = [sim_preds, ]
+        return [(self.object_name,sim_pred,{},None) for sim_pred in sim_preds]
 
 
 class LocationNet(BaseAnnotator):
@@ -154,13 +167,16 @@ class LocationNet(BaseAnnotator):
         self.prefix = "{}/RN101-5k500".format(model_path)
         self.epoch = epoch
         self.grids = []
+        self.bound_batch_size = None
 
     def load(self):
         sym, arg_params, aux_params = mx.model.load_checkpoint(self.prefix, self.epoch)
         self.session = mx.mod.Module(symbol=sym, context=mx.gpu())
         self.session.bind([('data', (1, 3, 224, 224))], for_training=False)
+        self.bound_batch_size = 1
         self.session.set_params(arg_params, aux_params, allow_missing=True)
         self.mean_rgb = np.array([123.68, 116.779, 103.939]).reshape((3, 1, 1))
+        self.grids = []
         with open('{}/grids.txt'.format(self.model_path), 'r') as f:
             for line in f:
                 line = line.strip().split('\t')
@@ -169,10 +185,20 @@ class LocationNet(BaseAnnotator):
                 self.grids.append((lat, lng))
 
     def apply(self,image_path):
+        return self.apply_batch([image_path])[0]
+
+    def apply_batch(self,image_paths):
         if self.session is None:
             self.load()
-        self.session.forward(Batch(self.preprocess(image_path)), is_train=False)
-        prob = self.session.get_outputs()[0].asnumpy()[0]
+        if len(image_paths) != self.bound_batch_size:
+            self.session.reshape([('data', (len(image_paths), 3, 224, 224))])
+            self.bound_batch_size = len(image_paths)
+        samples = np.stack([self.preprocess(image_path) for image_path in image_paths])
+        self.session.forward(Batch([mx.nd.array(samples)]), is_train=False)
+        probs = self.session.get_outputs()[0].asnumpy()
+        return [self.get_locations(prob) for prob in probs]
+
+    def get_locations(self,prob):
         pred = np.argsort(prob)[::-1]
         results = {}
         for i in range(5):
@@ -185,15 +211,18 @@ class LocationNet(BaseAnnotator):
         return self.object_name,"",results,None
 
     def preprocess(self,path):
-        img = Image.load(path)
-        short_side = min(img.shape[:2])
-        yy = int((img.shape[0] - short_side) / 2)
-        xx = int((img.shape[1] - short_side) / 2)
-        crop_img = img[yy: yy + short_side, xx: xx + short_side]
-        resized_img = img.resize(224, 224)
-        sample = np.asarray(resized_img) * 256
+        """
+        Center crop to a square, resize to 224x224 and subtract the mean RGB.
+        :return: (3, 224, 224) array
+        """
+        img = Image.open(path).convert('RGB')
+        width, height = img.size
+        short_side = min(width, height)
+        yy = int((height - short_side) / 2)
+        xx = int((width - short_side) / 2)
+        crop_img = img.crop((xx, yy, xx + short_side, yy + short_side))
+        resized_img = crop_img.resize((224, 224))
+        sample = np.asarray(resized_img, dtype=np.float32)
         sample = np.swapaxes(sample, 0, 2)
         sample = np.swapaxes(sample, 1, 2)
-        normed_img = sample - self.mean_rgb
-        normed_img = normed_img.reshape((1, 3, 224, 224))
-        return [mx.nd.array(normed_img)]
\ No newline at end of file
+        return sample - self.mean_rgb
\ No newline at end of file
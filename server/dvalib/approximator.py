@@ -22,6 +22,9 @@ except ImportError:
     logging.warning("Could not import faiss in approximator.py")
     pass
 
+# Computing LOPQ codes in separate processes only pays off above this many vectors per process.
+MIN_VECTORS_PER_PROCESS = 1000
+
 
 class LOPQApproximator(BaseApproximator):
     """
@@ -58,11 +61,32 @@ class LOPQApproximator(BaseApproximator):
         codes = self.model.predict(vector)
         return codes.coarse, codes.fine
 
+    def approximate_batch(self, vectors, num_procs=4):
+        """
+        :param vectors: (n, d) matrix
+        :param num_procs: processes used to compute codes, small batches are coded in this process
+        :return: (n, coarse splits) uint16 coarse codes and (n, M) uint8 fine codes
+        """
+        vectors = self.get_pca_vectors(vectors)
+        num_procs = min(num_procs, len(vectors) // MIN_VECTORS_PER_PROCESS)
+        if num_procs > 1:
+            codes = list(compute_codes_parallel(vectors, self.model, num_procs))
+        else:
+            codes = [self.model.predict(v) for v in vectors]
+        coarse = np.array([c.coarse for c in codes], dtype=np.uint16).reshape((len(codes), -1))
+        fine = np.array([c.fine for c in codes], dtype=np.uint8).reshape((len(codes), -1))
+        return coarse, fine
+
     def get_pca_vector(self, vector):
         if self.model is None:
             self.load()
         return np.dot((self.pca_reduction.transform(vector) - self.mu), self.P).transpose().squeeze()
 
+    def get_pca_vectors(self, vectors):
+        if self.model is None:
+            self.load()
+        return np.dot((self.pca_reduction.transform(np.atleast_2d(vectors)) - self.mu), self.P)
+
 
 class PCAApproximator(BaseApproximator):
     """
@@ -97,6 +121,14 @@ class PCAApproximator(BaseApproximator):
         feats /= np.sqrt(self.pca_eigenvals + 1e-4)
         return feats
 
+    def approximate_batch(self, vectors):
+        if self.pca_eigenvecs is None:
+            self.load()
+        feats = np.atleast_2d(vectors).reshape((-1, self.source_components)) - self.pca_mean
+        feats = feats.dot(self.pca_eigenvecs)
+        feats /= np.sqrt(self.pca_eigenvals + 1e-4)
+        return feats
+
 
 class FAISSApproximator(BaseApproximator):
 
@@ -6,5 +6,31 @@ class BaseAnnotator(object):
         self.label_set = None
         pass
 
+    def load(self):
+        pass
+
+    def unload(self):
+        """
+        Release the model, the next load rebuilds it.
+        """
+        session = getattr(self, 'session', None)
+        if hasattr(session, 'close'):
+            session.close()
+        self.session = None
+
+    def warmup(self,image_path):
+        """
+        Run image_path through the model once so that the first task does not pay for it.
+        """
+        self.apply_batch([image_path])
+
     def apply(self,image_path):
         pass
+
+    def apply_batch(self,image_paths):
+        """
+        Analyzers that can run several images through the model at once override this.
+        :param image_paths: list of image paths
+        :return: list of (object_name, text, metadata, labels) in the order of image_paths
+        """
+        return [self.apply(image_path) for image_path in image_paths]
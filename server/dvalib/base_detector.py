@@ -7,5 +7,45 @@ class BaseDetector(object):
     def detect(self,path):
         pass
 
+    def detect_image(self,image):
+        """
+        Detect in an already decoded image, required to share the decoded image with an indexer.
+        :param image: (height, width, 3) uint8 RGB array
+        :return: list of detections
+        """
+        raise NotImplementedError
+
+    def detect_arrays(self,images):
+        """
+        Detectors that can run several decoded images through the model at once override this.
+        :param images: list of (height, width, 3) uint8 RGB arrays
+        :return: list of detections in the order of images
+        """
+        return [self.detect_image(image) for image in images]
+
+    def detect_batch(self,paths):
+        """
+        Detectors that can run several images through the model at once override this.
+        :param paths: list of image paths
+        :return: iterator of (path, detections) in the order of paths
+        """
+        for path in paths:
+            yield path, self.detect(path)
+
     def load(self):
         pass
+
+    def warmup(self, path):
+        """
+        Run path through the model once so that the first task does not pay for it.
+        """
+        list(self.detect_batch([path]))
+
+    def unload(self):
+        """
+        Release the model, the next load rebuilds it.
+        """
+        session = getattr(self, 'session', None)
+        if hasattr(session, 'close'):
+            session.close()
+        self.session = None
@@ -1,4 +1,11 @@
 import logging
+import itertools
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+# Maximum number of decoded frames kept in memory while cropping regions
+DEFAULT_DECODED_FRAMES = 16
 
 
 class BaseIndexer(object):
@@ -9,22 +16,132 @@ class BaseIndexer(object):
         self.batch_size = 100
         self.num_parallel_calls = 3
         self.cloud_fs_support = False
+        self.session = None
+        self.graph = None
+        self.graph_def = None
+        self.frame_placeholder = None
+        self.boxes_placeholder = None
+        self.crops = None
+        self.decoded_frames = DEFAULT_DECODED_FRAMES
+
+    def load(self):
+        pass
+
+    def unload(self):
+        """
+        Close the session and drop the graph to release the memory held by the model, the next load rebuilds them.
+        """
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+        self.graph = None
+        self.graph_def = None
+        self.crops = None
+
+    def warmup(self, path):
+        """
+        Run path through the same code path as indexing so that graph optimization and memory allocation happen
+        before the first task.
+        """
+        self.index_paths([path])
 
     def apply(self, path):
         raise NotImplementedError
 
     def apply_batch(self, paths):
+        return dict(self.iter_batch(paths))
+
+    def iter_batch(self, paths):
+        """
+        :return: iterator of (path, features) in the order of paths
+        """
+        raise NotImplementedError
+
+    def apply_arrays(self, images):
+        """
+        :param images: (n, height, width, 3) batch of preprocessed images as expected by the network
+        :return: list of features
+        """
         raise NotImplementedError
 
     def index_paths(self, paths):
+        return list(self.iter_features(paths))
+
+    def iter_features(self, paths):
+        """
+        Yield features of paths in order without keeping them in memory. Batching indexers run all paths through a
+        single initialization of their tf.data pipeline, which decodes the next batch while the current one runs
+        through the network.
+        """
         if self.support_batching:
             logging.info("Using batching")
-            fdict = self.apply_batch(paths)
-            features = [fdict[paths[i]] for i in range(len(paths))]
+            for _, f in self.iter_batch(paths):
+                yield f
         else:
-            features = []
             for path in paths:
-                features.append(self.apply(path))
+                yield self.apply(path)
+
+    def index_crops(self, crops):
+        """
+        Index regions without writing them to disk. Each frame is decoded once, all of its regions are cropped and
+        resized in memory by self.crops and fed to the network self.batch_size at a time. Regions of the same frame
+        should be adjacent, the last self.decoded_frames decoded frames are kept in case they are not.
+        :param crops: list of (frame path, (x, y, w, h))
+        :return: list of features in the order of crops
+        """
+        frames = OrderedDict()
+        return self.index_frame_boxes((self.get_decoded_frame(frame_path, frames), [box for _, box in frame_crops])
+                                      for frame_path, frame_crops in itertools.groupby(crops, key=lambda c: c[0]))
+
+    def index_frame_boxes(self, frame_boxes):
+        """
+        :param frame_boxes: iterable of (decoded frame as (height, width, 3) uint8 array, list of (x, y, w, h))
+        :return: list of features in the order of the boxes
+        """
+        if self.crops is None or self.session is None:
+            self.load()
+        features, batch = [], []
+        for frame, boxes in frame_boxes:
+            if boxes:
+                batch.extend(self.crop(frame, boxes))
+            while len(batch) >= self.batch_size:
+                features.extend(self.apply_arrays(np.stack(batch[:self.batch_size])))
+                batch = batch[self.batch_size:]
+        if batch:
+            features.extend(self.apply_arrays(np.stack(batch)))
         return features
 
+    def crop(self, frame, boxes):
+        """
+        :return: boxes of frame cropped and resized by self.crops as expected by apply_arrays
+        """
+        return self.session.run(self.crops, feed_dict={self.frame_placeholder: frame,
+                                                       self.boxes_placeholder: normalized_boxes(boxes, frame.shape)})
+
+    def get_decoded_frame(self, frame_path, frames):
+        if frame_path in frames:
+            frame = frames.pop(frame_path)
+        else:
+            frame = decode_image(frame_path)
+            if len(frames) >= self.decoded_frames:
+                frames.popitem(last=False)
+        frames[frame_path] = frame
+        return frame
+
+
+def decode_image(path):
+    """
+    :return: (height, width, 3) uint8 RGB array
+    """
+    return np.asarray(Image.open(path).convert('RGB'))
+
 
+def normalized_boxes(boxes, shape):
+    """
+    :param boxes: list of (x, y, w, h) boxes in pixels
+    :param shape: (height, width, channels) of the frame
+    :return: (n, 4) array of [y1, x1, y2, x2] boxes normalized as expected by tf.image.crop_and_resize
+    """
+    height, width = float(max(shape[0] - 1, 1)), float(max(shape[1] - 1, 1))
+    return np.array([[y / height, x / width, (y + h - 1) / height, (x + w - 1) / width] for x, y, w, h in boxes],
+                    dtype=np.float32)
@@ -27,10 +27,15 @@ else:
         from lib.text_connector.text_connect_cfg import Config as TextLineCfg
 
 
+# Number of images run through a TFDetector graph per session.run call in detect_batch
+DEFAULT_DETECTION_BATCH_SIZE = 8
+
+
 def _parse_function(filename):
     image_string = tf.read_file(filename)
     image_decoded = tf.image.decode_image(image_string, channels=3)
-    return tf.expand_dims(image_decoded, 0), filename
+    image_decoded.set_shape([None, None, 3])
+    return image_decoded, tf.shape(image_decoded)[:2], filename
 
 
 def pil_to_array(pilImage):
@@ -87,14 +92,19 @@ def pil_to_array(pilImage):
 
 class TFDetector(BaseDetector):
 
-    def __init__(self, model_path, class_index_to_string, gpu_fraction=None):
+    def __init__(self, model_path, class_index_to_string, gpu_fraction=None,
+                 batch_size=DEFAULT_DETECTION_BATCH_SIZE):
         super(TFDetector, self).__init__()
         self.model_path = model_path
         self.class_index_to_string = {int(k): v for k, v in class_index_to_string.items()}
         self.session = None
         self.dataset = None
         self.filenames_placeholder = None
+        self.batch_size_placeholder = None
+        self.batch_size = batch_size
         self.image = None
+        self.image_size = None
+        self.batch_image_size = None
         self.fname = None
         if gpu_fraction:
             self.gpu_fraction = gpu_fraction
@@ -102,24 +112,63 @@ class TFDetector(BaseDetector):
             self.gpu_fraction = float(os.environ.get('GPU_MEMORY', 0.20))
 
     def detect(self, image_path, min_score=0.20):
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
-        (fname, boxes, scores, classes, num_detections) = self.session.run(
-            [self.fname, self.boxes, self.scores, self.classes, self.num_detections])
+        for _, detections in self.detect_batch([image_path, ], min_score=min_score, batch_size=1):
+            return detections
+        return []
+
+    def detect_batch(self, image_paths, min_score=0.20, batch_size=None):
+        """
+        Stream images through the graph batch_size at a time, decoding of the following batches is pipelined with
+        inference. Images of different sizes in a batch are zero padded at the bottom / right, boxes are converted
+        to pixels using the padded size and clipped to the image size returned by the decode step.
+        :return: iterator of (path, detections) in the order of image_paths
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths,
+                                                               self.batch_size_placeholder: batch_size})
+        offset = 0
+        while True:
+            try:
+                (image_sizes, batch_image_size, boxes, scores, classes) = self.session.run(
+                    [self.image_size, self.batch_image_size, self.boxes, self.scores, self.classes])
+            except tf.errors.OutOfRangeError:
+                break
+            for j, image_size in enumerate(image_sizes):
+                yield image_paths[offset + j], self.get_detections(boxes[j], scores[j], classes[j], image_size,
+                                                                   batch_image_size, min_score)
+            offset += len(image_sizes)
+
+    def detect_image(self, image, min_score=0.20):
+        return self.detect_arrays([image, ], min_score=min_score)[0]
+
+    def detect_arrays(self, images, min_score=0.20):
+        """
+        Run decoded images of the same size through the graph as one batch, the decoded images are fed in place of
+        the batches produced by the file pipeline.
+        """
+        batch = np.stack(images)
+        boxes, scores, classes = self.session.run([self.boxes, self.scores, self.classes],
+                                                  feed_dict={self.image: batch})
+        image_size = batch.shape[1:3]
+        return [self.get_detections(boxes[j], scores[j], classes[j], image_size, image_size, min_score)
+                for j in range(len(images))]
+
+    def get_detections(self, boxes, scores, classes, image_size, batch_image_size, min_score):
         detections = []
-        for i, _ in enumerate(boxes[0]):
-            plimg = PIL.Image.open(image_path)
-            frame_width, frame_height = plimg.size
-            shape = (frame_height, frame_width)
-            if scores[0][i] > min_score:
-                top, left = (int(boxes[0][i][0] * shape[0]), int(boxes[0][i][1] * shape[1]))
-                bot, right = (int(boxes[0][i][2] * shape[0]), int(boxes[0][i][3] * shape[1]))
+        height, width = image_size
+        batch_height, batch_width = batch_image_size
+        for i, _ in enumerate(boxes):
+            if scores[i] > min_score:
+                top, left = (min(int(boxes[i][0] * batch_height), height), min(int(boxes[i][1] * batch_width), width))
+                bot, right = (min(int(boxes[i][2] * batch_height), height), min(int(boxes[i][3] * batch_width), width))
                 detections.append({
                     'x': left,
                     'y': top,
                     'w': right - left,
                     'h': bot - top,
-                    'score': scores[0][i],
-                    'object_name': self.class_index_to_string[int(classes[0][i])]
+                    'score': scores[i],
+                    'object_name': self.class_index_to_string[int(classes[i])]
                 })
         return detections
 
@@ -127,14 +176,18 @@ class TFDetector(BaseDetector):
         self.detection_graph = tf.Graph()
         with self.detection_graph.as_default():
             self.filenames_placeholder = tf.placeholder("string")
+            self.batch_size_placeholder = tf.placeholder(tf.int64, shape=[])
             dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-            dataset = dataset.map(_parse_function)
+            dataset = dataset.map(_parse_function, num_parallel_calls=4)
+            dataset = dataset.padded_batch(self.batch_size_placeholder, padded_shapes=([None, None, 3], [2], []))
+            dataset = dataset.prefetch(2)
             self.iterator = dataset.make_initializable_iterator()
             self.od_graph_def = tf.GraphDef()
             with tf.gfile.GFile(self.model_path, 'rb') as fid:
                 serialized_graph = fid.read()
                 self.od_graph_def.ParseFromString(serialized_graph)
-                self.image, self.fname = self.iterator.get_next()
+                self.image, self.image_size, self.fname = self.iterator.get_next()
+                self.batch_image_size = tf.shape(self.image)[1:3]
                 tf.import_graph_def(self.od_graph_def, name='', input_map={'image_tensor': self.image})
             config = tf.ConfigProto()
             config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
@@ -145,7 +198,7 @@ class TFDetector(BaseDetector):
             self.num_detections = self.detection_graph.get_tensor_by_name('num_detections:0')
 
 
-class FaceDetector():
+class FaceDetector(BaseDetector):
 
     def __init__(self, session=None, gpu_fraction=None):
         self.image_size = 182
@@ -168,7 +221,6 @@ class FaceDetector():
                 self.pnet, self.rnet, self.onet = detect_face.create_mtcnn(self.session, None)
 
     def detect(self, image_path):
-        aligned = []
         try:
             img = misc.imread(image_path)
         except (IOError, ValueError, IndexError) as e:
@@ -180,26 +232,29 @@ class FaceDetector():
                 return []
             if img.ndim == 2:
                 img = facenet.to_rgb(img)
-            img = img[:, :, 0:3]
-            bounding_boxes, _ = detect_face.detect_face(img, self.minsize, self.pnet, self.rnet, self.onet,
-                                                        self.threshold, self.factor)
-            nrof_faces = bounding_boxes.shape[0]
-            if nrof_faces > 0:
-                det_all = bounding_boxes[:, 0:4]
-                img_size = np.asarray(img.shape)[0:2]
-                for boxindex in range(nrof_faces):
-                    det = np.squeeze(det_all[boxindex, :])
-                    bb = np.zeros(4, dtype=np.int32)
-                    bb[0] = np.maximum(det[0] - self.margin / 2, 0)
-                    bb[1] = np.maximum(det[1] - self.margin / 2, 0)
-                    bb[2] = np.minimum(det[2] + self.margin / 2, img_size[1])
-                    bb[3] = np.minimum(det[3] + self.margin / 2, img_size[0])
-                    left, top, right, bottom = bb[0], bb[1], bb[2], bb[3]
-                    aligned.append({'x': left, 'y': top, 'w': right - left, 'h': bottom - top})
-            return aligned
-
-
-class TextBoxDetector():
+            return self.detect_image(img[:, :, 0:3])
+
+    def detect_image(self, img):
+        aligned = []
+        bounding_boxes, _ = detect_face.detect_face(img, self.minsize, self.pnet, self.rnet, self.onet,
+                                                    self.threshold, self.factor)
+        nrof_faces = bounding_boxes.shape[0]
+        if nrof_faces > 0:
+            det_all = bounding_boxes[:, 0:4]
+            img_size = np.asarray(img.shape)[0:2]
+            for boxindex in range(nrof_faces):
+                det = np.squeeze(det_all[boxindex, :])
+                bb = np.zeros(4, dtype=np.int32)
+                bb[0] = np.maximum(det[0] - self.margin / 2, 0)
+                bb[1] = np.maximum(det[1] - self.margin / 2, 0)
+                bb[2] = np.minimum(det[2] + self.margin / 2, img_size[1])
+                bb[3] = np.minimum(det[3] + self.margin / 2, img_size[0])
+                left, top, right, bottom = bb[0], bb[1], bb[2], bb[3]
+                aligned.append({'x': left, 'y': top, 'w': right - left, 'h': bottom - top})
+        return aligned
+
+
+class TextBoxDetector(BaseDetector):
 
     def __init__(self, model_path, gpu_fraction=None):
         self.session = None
@@ -214,18 +269,28 @@ class TextBoxDetector():
         cfg_from_file(os.path.join(os.path.dirname(__file__), 'text.yml'))
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=self.gpu_fraction)
         config = tf.ConfigProto(allow_soft_placement=True, gpu_options=gpu_options)
-        self.session = tf.Session(config=config)
-        self.net = get_network("VGGnet_test")
-        self.textdetector = TextDetector()
-        saver = tf.train.Saver()
-        ckpt = tf.train.get_checkpoint_state(self.model_path)
-        saver.restore(self.session, ckpt.model_checkpoint_path)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.session = tf.Session(graph=self.graph, config=config)
+            self.net = get_network("VGGnet_test")
+            self.textdetector = TextDetector()
+            saver = tf.train.Saver()
+            ckpt = tf.train.get_checkpoint_state(self.model_path)
+            saver.restore(self.session, ckpt.model_checkpoint_path)
 
     def detect(self, image_path):
+        return self.detect_bgr(cv2.imread(image_path))
+
+    def detect_image(self, img):
+        return self.detect_bgr(np.ascontiguousarray(img[:, :, ::-1]))
+
+    def detect_bgr(self, img):
+        """
+        :param img: (height, width, 3) uint8 BGR array as read by cv2, which the network was trained on
+        """
         if self.session is None:
             self.load()
         regions = []
-        img = cv2.imread(image_path)
         old_h, old_w, channels = img.shape
         img, scale = self.resize_im(img, scale=TextLineCfg.SCALE, max_scale=TextLineCfg.MAX_SCALE)
         new_h, new_w, channels = img.shape
@@ -21,12 +21,6 @@ else:
 IndexRange = namedtuple('IndexRange', ['start', 'end'])
 
 
-def _parse_function(filename):
-    image_string = tf.read_file(filename)
-    image_decoded = tf.image.decode_image(image_string, channels=3)
-    return image_decoded, filename
-
-
 def _parse_resize_inception_function(filename):
     image_string = tf.read_file(filename)
     image_decoded = tf.image.decode_png(image_string, channels=3)
@@ -61,6 +55,27 @@ def _parse_scale_standardize_function(filename):
     return image_standardized, filename
 
 
+def _parse_resize_function(filename, size=None):
+    """
+    :return: float32 image resized to size x size, or at its original size when size is None
+    """
+    image_string = tf.read_file(filename)
+    image_decoded = tf.image.decode_png(image_string, channels=3)
+    if size is None:
+        return tf.to_float(image_decoded), filename
+    return tf.image.resize_images(image_decoded, [size, size]), filename
+
+
+def _crop_and_resize_function(frame, boxes, size):
+    """
+    Crop all boxes from a decoded uint8 frame and bilinearly resize them to size x size float32 images
+    :param frame: (height, width, 3) uint8 frame
+    :param boxes: (n, 4) normalized [y1, x1, y2, x2] boxes
+    """
+    box_ind = tf.zeros(tf.shape(boxes)[:1], dtype=tf.int32)
+    return tf.image.crop_and_resize(tf.expand_dims(frame, 0), boxes, box_ind, [size, size])
+
+
 
 
 class InceptionIndexer(BaseIndexer):
@@ -93,23 +108,29 @@ class InceptionIndexer(BaseIndexer):
     def load(self):
         if self.graph_def is None:
             logging.warning("Loading the network {} , first apply / query will be slower".format(self.name))
-            with tf.variable_scope("inception_pre"):
-                self.filenames_placeholder = tf.placeholder("string", name="inception_filename")
-                dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-                dataset = dataset.map(_parse_resize_inception_function, num_parallel_calls=self.num_parallel_calls)
-                dataset = dataset.batch(self.batch_size)
-                self.iterator = dataset.make_initializable_iterator()
-            with gfile.FastGFile(self.network_path, 'rb') as f:
-                self.graph_def = tf.GraphDef()
-                self.graph_def.ParseFromString(f.read())
-                self.image, self.fname = self.iterator.get_next()
-                _ = tf.import_graph_def(self.graph_def, name='incept', input_map={'ResizeBilinear': self.image})
-                self.pool3 = tf.get_default_graph().get_tensor_by_name('incept/pool_3:0')
+            self.graph = tf.Graph() if self.session is None else self.session.graph
+            with self.graph.as_default():
+                with tf.variable_scope("inception_pre"):
+                    self.filenames_placeholder = tf.placeholder("string", name="inception_filename")
+                    dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
+                    dataset = dataset.map(_parse_resize_inception_function, num_parallel_calls=self.num_parallel_calls)
+                    dataset = dataset.batch(self.batch_size)
+                    dataset = dataset.prefetch(1)
+                    self.iterator = dataset.make_initializable_iterator()
+                    self.frame_placeholder = tf.placeholder(tf.uint8, shape=[None, None, 3], name="inception_frame")
+                    self.boxes_placeholder = tf.placeholder(tf.float32, shape=[None, 4], name="inception_boxes")
+                    self.crops = _crop_and_resize_function(self.frame_placeholder, self.boxes_placeholder, 299)
+                with gfile.FastGFile(self.network_path, 'rb') as f:
+                    self.graph_def = tf.GraphDef()
+                    self.graph_def.ParseFromString(f.read())
+                    self.image, self.fname = self.iterator.get_next()
+                    _ = tf.import_graph_def(self.graph_def, name='incept', input_map={'ResizeBilinear': self.image})
+                    self.pool3 = tf.get_default_graph().get_tensor_by_name('incept/pool_3:0')
         if self.session is None:
             logging.warning("Creating a session {} , first apply / query will be slower".format(self.name))
             config = tf.ConfigProto()
             config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
-            self.session = tf.InteractiveSession(config=config)
+            self.session = tf.Session(graph=self.graph, config=config)
 
     def apply(self, image_path):
         if self.graph_def is None or self.session is None:
@@ -118,24 +139,26 @@ class InceptionIndexer(BaseIndexer):
         f, pool3_features = self.session.run([self.fname, self.pool3])
         return np.atleast_2d(np.squeeze(pool3_features))
 
-    def apply_batch(self, image_paths):
+    def iter_batch(self, image_paths):
         if self.graph_def is None or self.session is None:
             self.load()
         self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
-        embeddings = {}
         batch_count = 0
         while True:
             try:
                 f, emb = self.session.run([self.fname, self.pool3])
-                for i, fname in enumerate(f):
-                    embeddings[fname] = np.atleast_2d(np.squeeze(emb[i, :, :, :]))
-                batch_count += 1
-                if batch_count % 100 == 0:
-                    logging.info(
-                        "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
             except tf.errors.OutOfRangeError:
                 break
-        return embeddings
+            for i, fname in enumerate(f):
+                yield fname, np.atleast_2d(np.squeeze(emb[i, :, :, :]))
+            batch_count += 1
+            if batch_count % 100 == 0:
+                logging.info(
+                    "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
+
+    def apply_arrays(self, images):
+        emb = self.session.run(self.pool3, feed_dict={self.image: images})
+        return [np.atleast_2d(np.squeeze(emb[i, :, :, :])) for i in range(emb.shape[0])]
 
 
 class VGGIndexer(BaseIndexer):
@@ -168,24 +191,31 @@ class VGGIndexer(BaseIndexer):
     def load(self):
         if self.graph_def is None:
             logging.warning("Loading the network {} , first apply / query will be slower".format(self.name))
-            network_path = self.model_path
-            with tf.variable_scope("vgg_pre"):
-                self.filenames_placeholder = tf.placeholder("string", name="vgg_filenames")
-                dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-                dataset = dataset.map(_parse_resize_vgg_function, num_parallel_calls=self.num_parallel_calls)
-                dataset = dataset.batch(self.batch_size)
-                self.iterator = dataset.make_initializable_iterator()
-            with gfile.FastGFile(network_path, 'rb') as f:
-                self.graph_def = tf.GraphDef()
-                self.graph_def.ParseFromString(f.read())
-                self.image, self.fname = self.iterator.get_next()
-                _ = tf.import_graph_def(self.graph_def, name='vgg', input_map={'images:0': self.image})
-            self.conv = tf.get_default_graph().get_tensor_by_name('vgg/pool5:0')
+            self.graph = tf.Graph() if self.session is None else self.session.graph
+            with self.graph.as_default():
+                network_path = self.model_path
+                with tf.variable_scope("vgg_pre"):
+                    self.filenames_placeholder = tf.placeholder("string", name="vgg_filenames")
+                    dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
+                    dataset = dataset.map(_parse_resize_vgg_function, num_parallel_calls=self.num_parallel_calls)
+                    dataset = dataset.batch(self.batch_size)
+                    dataset = dataset.prefetch(1)
+                    self.iterator = dataset.make_initializable_iterator()
+                    self.frame_placeholder = tf.placeholder(tf.uint8, shape=[None, None, 3], name="vgg_frame")
+                    self.boxes_placeholder = tf.placeholder(tf.float32, shape=[None, 4], name="vgg_boxes")
+                    # same 0-1 range as _parse_resize_vgg_function
+                    self.crops = _crop_and_resize_function(self.frame_placeholder, self.boxes_placeholder, 224) / 255.0
+                with gfile.FastGFile(network_path, 'rb') as f:
+                    self.graph_def = tf.GraphDef()
+                    self.graph_def.ParseFromString(f.read())
+                    self.image, self.fname = self.iterator.get_next()
+                    _ = tf.import_graph_def(self.graph_def, name='vgg', input_map={'images:0': self.image})
+                self.conv = tf.get_default_graph().get_tensor_by_name('vgg/pool5:0')
         if self.session is None:
             logging.warning("Creating a session {} , first apply / query will be slower".format(self.name))
             config = tf.ConfigProto()
             config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
-            self.session = tf.InteractiveSession(config=config)
+            self.session = tf.Session(graph=self.graph, config=config)
 
     def apply(self, image_path):
         if self.graph_def is None or self.session is None:
@@ -194,24 +224,26 @@ class VGGIndexer(BaseIndexer):
         f, features = self.session.run([self.fname, self.conv])
         return np.atleast_2d(np.squeeze(features).sum(axis=(0, 1)))
 
-    def apply_batch(self, image_paths):
+    def iter_batch(self, image_paths):
         if self.graph_def is None or self.session is None:
             self.load()
         self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
-        embeddings = {}
         batch_count = 0
         while True:
             try:
                 f, emb = self.session.run([self.fname, self.conv])
-                for i, fname in enumerate(f):
-                    embeddings[fname] = np.atleast_2d(np.squeeze(emb[i, :, :, :]).sum(axis=(0, 1)))
-                batch_count += 1
-                if batch_count % 100 == 0:
-                    logging.info(
-                        "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
             except tf.errors.OutOfRangeError:
                 break
-        return embeddings
+            for i, fname in enumerate(f):
+                yield fname, np.atleast_2d(np.squeeze(emb[i, :, :, :]).sum(axis=(0, 1)))
+            batch_count += 1
+            if batch_count % 100 == 0:
+                logging.info(
+                    "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
+
+    def apply_arrays(self, images):
+        emb = self.session.run(self.conv, feed_dict={self.image: images})
+        return [np.atleast_2d(np.squeeze(emb[i, :, :, :]).sum(axis=(0, 1))) for i in range(emb.shape[0])]
 
 
 class FacenetIndexer(BaseIndexer):
@@ -239,24 +271,30 @@ class FacenetIndexer(BaseIndexer):
     def load(self):
         if self.graph_def is None:
             logging.warning("Loading {} , first apply / query will be slower".format(self.name))
-            self.filenames_placeholder = tf.placeholder("string")
-            dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-            dataset = dataset.map(_parse_scale_standardize_function, num_parallel_calls=self.num_parallel_calls)
-            batched_dataset = dataset.batch(self.batch_size)
-            self.iterator = batched_dataset.make_initializable_iterator()
-            false_phase_train = tf.constant(False)
-            with gfile.FastGFile(self.network_path, 'rb') as f:
-                self.graph_def = tf.GraphDef()
-                self.graph_def.ParseFromString(f.read())
-                self.image, self.fname = self.iterator.get_next()
-                _ = tf.import_graph_def(self.graph_def, input_map={'{}:0'.format(self.input_op): self.image,
-                                                                   'phase_train:0': false_phase_train})
-                self.emb = tf.get_default_graph().get_tensor_by_name('import/{}:0'.format(self.embedding_op))
+            self.graph = tf.Graph() if self.session is None else self.session.graph
+            with self.graph.as_default():
+                self.filenames_placeholder = tf.placeholder("string")
+                dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
+                dataset = dataset.map(_parse_scale_standardize_function, num_parallel_calls=self.num_parallel_calls)
+                batched_dataset = dataset.batch(self.batch_size).prefetch(1)
+                self.iterator = batched_dataset.make_initializable_iterator()
+                self.frame_placeholder = tf.placeholder(tf.uint8, shape=[None, None, 3])
+                self.boxes_placeholder = tf.placeholder(tf.float32, shape=[None, 4])
+                self.crops = tf.map_fn(tf.image.per_image_standardization,
+                                       _crop_and_resize_function(self.frame_placeholder, self.boxes_placeholder, 160))
+                false_phase_train = tf.constant(False)
+                with gfile.FastGFile(self.network_path, 'rb') as f:
+                    self.graph_def = tf.GraphDef()
+                    self.graph_def.ParseFromString(f.read())
+                    self.image, self.fname = self.iterator.get_next()
+                    _ = tf.import_graph_def(self.graph_def, input_map={'{}:0'.format(self.input_op): self.image,
+                                                                       'phase_train:0': false_phase_train})
+                    self.emb = tf.get_default_graph().get_tensor_by_name('import/{}:0'.format(self.embedding_op))
         if self.session is None:
             logging.warning("Creating a session {} , first apply / query will be slower".format(self.name))
             config = tf.ConfigProto()
             config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
-            self.session = tf.InteractiveSession(config=config)
+            self.session = tf.Session(graph=self.graph, config=config)
 
     def apply(self, image_path):
         if self.graph_def is None or self.session is None:
@@ -265,66 +303,41 @@ class FacenetIndexer(BaseIndexer):
         f, features = self.session.run([self.fname, self.emb])
         return np.atleast_2d(np.squeeze(features))
 
-    def apply_batch(self, image_paths):
+    def iter_batch(self, image_paths):
         if self.graph_def is None or self.session is None:
             self.load()
         self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
-        embeddings = {}
         batch_count = 0
         while True:
             try:
                 f, emb = self.session.run([self.fname, self.emb])
-                for i, fname in enumerate(f):
-                    embeddings[fname] = np.atleast_2d(np.squeeze(emb[i, :, :, :]).sum(axis=(0, 1)))
-                batch_count += 1
-                if batch_count % 100 == 0:
-                    logging.info(
-                        "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
             except tf.errors.OutOfRangeError:
                 break
-        return embeddings
-
+            for i, fname in enumerate(f):
+                yield fname, np.atleast_2d(np.squeeze(emb[i, :]))
+            batch_count += 1
+            if batch_count % 100 == 0:
+                logging.info(
+                    "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
 
-class BaseCustomIndexer(object):
-    def __init__(self):
-        self.name = "base"
-        self.net = None
-        self.support_batching = False
-        self.batch_size = 100
-        self.num_parallel_calls = 3
-
-    def apply(self, path):
-        raise NotImplementedError
+    def apply_arrays(self, images):
+        emb = self.session.run(self.emb, feed_dict={self.image: images})
+        return [np.atleast_2d(np.squeeze(emb[i, :])) for i in range(emb.shape[0])]
 
-    def apply_batch(self, paths):
-        raise NotImplementedError
 
-    def index_paths(self, paths):
-        batch_count = 0
-        if self.support_batching:
-            logging.info("Using batching")
-            path_buffer = []
-            fdict = {}
-            for path in paths:
-                path_buffer.append(path)
-                if len(path_buffer) > self.batch_size:
-                    fdict.update(self.apply_batch(path_buffer))
-                    path_buffer = []
-                    batch_count += 1
-                    if batch_count % 100 == 0:
-                        logging.info("{} batches containing {} images indexed".format(batch_count,
-                                                                                      batch_count * self.batch_size))
-            fdict.update(self.apply_batch(path_buffer))
-            features = [fdict[paths[i]] for i in range(len(paths))]
-        else:
-            features = []
-            for path in paths:
-                features.append(self.apply(path))
-        return features
+class BaseCustomIndexer(BaseIndexer):
+    def __init__(self):
+        super(BaseCustomIndexer, self).__init__()
 
 
 class CustomTFIndexer(BaseCustomIndexer):
-    def __init__(self, name, network_path, input_op, embedding_op, gpu_fraction=None):
+    """
+    Indexer for a frozen graph mapping a batch of images fed to input_op to embedding_op. When image_size is not
+    given it is read from the shape of input_op, images of a model without a fixed input size are fed one at a time
+    and it cannot index regions.
+    """
+
+    def __init__(self, name, network_path, input_op, embedding_op, gpu_fraction=None, image_size=None, batch_size=8):
         super(CustomTFIndexer, self).__init__()
         self.name = name
         self.network_path = network_path
@@ -338,36 +351,84 @@ class CustomTFIndexer(BaseCustomIndexer):
         self.image = None
         self.filenames_placeholder = None
         self.emb = None
+        self.image_size = image_size
+        self.batch_size = batch_size
+        self.cloud_fs_support = True
         if gpu_fraction:
             self.gpu_fraction = gpu_fraction
         else:
             self.gpu_fraction = float(os.environ.get('GPU_MEMORY', 0.15))
 
+    def get_input_size(self):
+        for node in self.graph_def.node:
+            if node.name == self.input_op and 'shape' in node.attr:
+                dims = [d.size for d in node.attr['shape'].shape.dim]
+                if len(dims) == 4 and dims[1] > 0 and dims[1] == dims[2]:
+                    return dims[1]
+        return None
+
     def load(self):
-        if self.session is None:
+        if self.graph_def is None:
             logging.warning("Loading the network {} , first apply / query will be slower".format(self.name))
-            config = tf.ConfigProto()
-            config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
-            self.session = tf.InteractiveSession(config=config)
-            self.filenames_placeholder = tf.placeholder("string")
-            dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-            dataset = dataset.map(_parse_function, num_parallel_calls=self.num_parallel_calls)
-            self.iterator = dataset.make_initializable_iterator()
-            false_phase_train = tf.constant(False)
+            self.graph = tf.Graph()
             with gfile.FastGFile(self.network_path, 'rb') as f:
-                graph_def = tf.GraphDef()
-                graph_def.ParseFromString(f.read())
+                self.graph_def = tf.GraphDef()
+                self.graph_def.ParseFromString(f.read())
+            if self.image_size is None:
+                self.image_size = self.get_input_size()
+            self.support_batching = self.image_size is not None
+            with self.graph.as_default():
+                self.filenames_placeholder = tf.placeholder("string")
+                dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
+                if self.support_batching:
+                    dataset = dataset.map(lambda filename: _parse_resize_function(filename, self.image_size),
+                                          num_parallel_calls=self.num_parallel_calls)
+                    dataset = dataset.batch(self.batch_size)
+                    self.frame_placeholder = tf.placeholder(tf.uint8, shape=[None, None, 3])
+                    self.boxes_placeholder = tf.placeholder(tf.float32, shape=[None, 4])
+                    self.crops = _crop_and_resize_function(self.frame_placeholder, self.boxes_placeholder,
+                                                           self.image_size)
+                else:
+                    dataset = dataset.map(_parse_resize_function, num_parallel_calls=self.num_parallel_calls)
+                    dataset = dataset.batch(1)
+                self.iterator = dataset.prefetch(1).make_initializable_iterator()
                 self.image, self.fname = self.iterator.get_next()
-                _ = tf.import_graph_def(graph_def, input_map={'{}:0'.format(self.input_op): self.image})
-                self.emb = self.session.graph.get_tensor_by_name('import/{}:0'.format(self.embedding_op))
+                _ = tf.import_graph_def(self.graph_def, input_map={'{}:0'.format(self.input_op): self.image})
+                self.emb = tf.get_default_graph().get_tensor_by_name('import/{}:0'.format(self.embedding_op))
+        if self.session is None:
+            logging.warning("Creating a session {} , first apply / query will be slower".format(self.name))
+            config = tf.ConfigProto()
+            config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
+            self.session = tf.Session(graph=self.graph, config=config)
 
     def apply(self, image_path):
-        if self.session is None:
+        if self.graph_def is None or self.session is None:
             self.load()
         self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
         f, features = self.session.run([self.fname, self.emb])
         return np.atleast_2d(np.squeeze(features))
 
+    def iter_batch(self, image_paths):
+        if self.graph_def is None or self.session is None:
+            self.load()
+        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
+        while True:
+            try:
+                f, emb = self.session.run([self.fname, self.emb])
+            except tf.errors.OutOfRangeError:
+                break
+            for i, fname in enumerate(f):
+                yield fname, np.atleast_2d(np.squeeze(emb[i]))
+
+    def apply_arrays(self, images):
+        emb = self.session.run(self.emb, feed_dict={self.image: images})
+        return [np.atleast_2d(np.squeeze(emb[i])) for i in range(emb.shape[0])]
+
+    def crop(self, frame, boxes):
+        if self.crops is None:
+            raise ValueError("{} has no fixed input size, set image_size to index regions".format(self.name))
+        return super(CustomTFIndexer, self).crop(frame, boxes)
+
 
 class CaffeIndexer(BaseCustomIndexer):
     def __init__(self, name, network_path, input_op, embedding_op, gpu_fraction=None):
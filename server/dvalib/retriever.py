@@ -1,14 +1,15 @@
 import numpy as np
-from scipy import spatial
 from collections import namedtuple, defaultdict
 import uuid
 import sys
+import bisect
 
 import logging
 
 try:
     from sklearn.decomposition import PCA
     from lopq import LOPQModel, LOPQSearcher
+    from lopq.search import multisequence
     from lopq.eval import compute_all_neighbors, get_recall
     from lopq.model import eigenvalue_allocation
     from lopq.utils import compute_codes_parallel
@@ -22,6 +23,258 @@ except ImportError:
     logging.warning("could not import FAISS")
 
 IndexRange = namedtuple('IndexRange', ['start', 'end'])
+LOPQResult = namedtuple('LOPQResult', ['id', 'dist'])
+
+# Number of index rows scored per BLAS call, bounds the size of the temporary (queries x block) distance matrix.
+EXACT_SEARCH_BLOCK_SIZE = 65536
+# Memory mapped matrices with fewer rows than this are copied into the growable store instead of being kept mapped.
+MAPPED_SEGMENT_MIN_ROWS = 4096
+
+
+def exact_search(queries, blocks, n):
+    """
+    Exact L2 k-NN search, distances are computed block by block as ||a||^2 - 2ab + ||b||^2 using cached
+    index norms and only the top n candidates of each block are kept using argpartition.
+    :param queries: (q, d) matrix
+    :param blocks: iterable of (start, block, block_norms) where block is a (m, d) slice of the index starting at
+    row id start and block_norms is the (m,) vector of its squared L2 norms
+    :param n: number of nearest neighbors
+    :return: (q, n) distances and (q, n) row ids, sorted by increasing distance
+    """
+    queries = np.atleast_2d(queries)
+    query_count = queries.shape[0]
+    query_norms = (queries ** 2).sum(axis=1)[:, np.newaxis]
+    rows = np.arange(query_count)[:, np.newaxis]
+    best_dist = np.empty((query_count, 0), dtype=np.float32)
+    best_ids = np.empty((query_count, 0), dtype=np.int64)
+    for start, block, block_norms in blocks:
+        dist = np.dot(queries.astype(block.dtype), block.T)
+        dist *= -2.0
+        dist += query_norms
+        dist += block_norms[np.newaxis, :]
+        if n < dist.shape[1]:
+            ids = np.argpartition(dist, n - 1, axis=1)[:, :n]
+            dist = dist[rows, ids]
+        else:
+            ids = np.tile(np.arange(dist.shape[1]), (query_count, 1))
+        best_dist = np.concatenate([best_dist, dist], axis=1)
+        best_ids = np.concatenate([best_ids, ids + start], axis=1)
+        if best_dist.shape[1] > n:
+            keep = np.argpartition(best_dist, n - 1, axis=1)[:, :n]
+            best_dist = best_dist[rows, keep]
+            best_ids = best_ids[rows, keep]
+    order = np.argsort(best_dist, axis=1)
+    best_dist = np.sqrt(np.maximum(best_dist[rows, order], 0))
+    return best_dist, best_ids[rows, order]
+
+
+class VectorStore(object):
+    """
+    Growable float32 matrix with cached squared norms and a row id -> entry array.
+    Capacity is doubled whenever it is exhausted, so appending m rows costs amortized O(m) copies.
+    Large memory mapped matrices are kept as read-only segments instead of being copied, so that retriever
+    processes on the same host share the page cache. Row ids are assigned segments first followed by the
+    growable matrix and are only stable between two appends.
+    """
+
+    def __init__(self, dtype=np.float32, initial_capacity=1024, mapped_min_rows=MAPPED_SEGMENT_MIN_ROWS):
+        self.dtype = dtype
+        self.initial_capacity = initial_capacity
+        self.mapped_min_rows = mapped_min_rows
+        self.components = None
+        self.matrix = None
+        self.row_norms = None
+        self.tail_count = 0
+        self.tail_entries = []
+        self.segments = []
+        self.segment_offsets = []
+        self.segment_rows = 0
+        self.count = 0
+
+    @property
+    def capacity(self):
+        return 0 if self.matrix is None else self.matrix.shape[0]
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of private memory, mapped segments only contribute their cached norms.
+        """
+        total = sum(norms.nbytes for _, norms, _ in self.segments)
+        if self.matrix is not None:
+            total += self.matrix.nbytes + self.row_norms.nbytes
+        return total
+
+    @property
+    def mapped_nbytes(self):
+        return sum(matrix.nbytes for matrix, _, _ in self.segments)
+
+    def reserve(self, capacity):
+        if self.matrix is None:
+            self.matrix = np.empty((capacity, self.components), dtype=self.dtype)
+            self.row_norms = np.empty(capacity, dtype=self.dtype)
+        elif capacity > self.capacity:
+            matrix = np.empty((capacity, self.components), dtype=self.dtype)
+            matrix[:self.tail_count] = self.matrix[:self.tail_count]
+            row_norms = np.empty(capacity, dtype=self.dtype)
+            row_norms[:self.tail_count] = self.row_norms[:self.tail_count]
+            self.matrix, self.row_norms = matrix, row_norms
+
+    def append(self, vectors, entries):
+        mapped = isinstance(vectors, np.memmap)
+        # squeeze and atleast_2d return views, so memory mapped matrices are not read here.
+        vectors = np.atleast_2d(vectors.squeeze())
+        if vectors.shape[0] != len(entries):
+            raise ValueError("{} vectors but {} entries".format(vectors.shape[0], len(entries)))
+        if self.components is None:
+            self.components = vectors.shape[1]
+        elif vectors.shape[1] != self.components:
+            raise ValueError("Vector shape {} does not match store components {}".format(vectors.shape,
+                                                                                        self.components))
+        if mapped and vectors.shape[0] >= self.mapped_min_rows:
+            norms = np.empty(vectors.shape[0], dtype=self.dtype)
+            for start in range(0, vectors.shape[0], EXACT_SEARCH_BLOCK_SIZE):
+                block = vectors[start:start + EXACT_SEARCH_BLOCK_SIZE]
+                norms[start:start + EXACT_SEARCH_BLOCK_SIZE] = (block ** 2).sum(axis=1)
+            self.segment_offsets.append(self.segment_rows)
+            self.segments.append((vectors, norms, list(entries)))
+            self.segment_rows += vectors.shape[0]
+        else:
+            required = self.tail_count + vectors.shape[0]
+            if required > self.capacity:
+                self.reserve(max(required, 2 * self.capacity, self.initial_capacity))
+            self.matrix[self.tail_count:required] = vectors
+            block = self.matrix[self.tail_count:required]
+            self.row_norms[self.tail_count:required] = (block ** 2).sum(axis=1)
+            self.tail_entries.extend(entries)
+            self.tail_count = required
+        self.count += vectors.shape[0]
+
+    def blocks(self, block_size=EXACT_SEARCH_BLOCK_SIZE):
+        for offset, (matrix, norms, _) in zip(self.segment_offsets, self.segments):
+            for start in range(0, matrix.shape[0], block_size):
+                yield offset + start, matrix[start:start + block_size], norms[start:start + block_size]
+        for start in range(0, self.tail_count, block_size):
+            end = min(start + block_size, self.tail_count)
+            yield self.segment_rows + start, self.matrix[start:end], self.row_norms[start:end]
+
+    def entry(self, row_id):
+        if row_id >= self.segment_rows:
+            return self.tail_entries[row_id - self.segment_rows]
+        segment_index = bisect.bisect_right(self.segment_offsets, row_id) - 1
+        return self.segments[segment_index][2][row_id - self.segment_offsets[segment_index]]
+
+
+class NumpyLOPQSearcher(object):
+    """
+    Drop-in replacement for lopq.LOPQSearcher backed by NumPy arrays. Every multi-index cell holds a contiguous
+    (items, M) uint8 array of fine codes and an int64 array of ids, distances to all items of a cell are computed
+    at once by indexing the (M, clusters) subquantizer distance lookup table with the fine codes.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.count = 0
+        self.cells = {}
+        # fine codes / ids appended since the cell arrays were last concatenated
+        self.pending = defaultdict(list)
+        # (num_coarse_splits) arrays of shape (fine splits per coarse split, clusters, subvector size)
+        self.subquantizers = [np.array(subC) for subC in model.subquantizers]
+        self.fine_splits = model.num_fine_splits * model.num_coarse_splits
+        self.code_columns = np.arange(self.fine_splits)[np.newaxis, :]
+
+    @property
+    def nbytes(self):
+        self.consolidate()
+        return sum(codes.nbytes + ids.nbytes for codes, ids in self.cells.values())
+
+    def add_codes(self, codes, ids=None):
+        """
+        :param codes: iterable of ((coarse codes), (fine codes)) tuples as returned by LOPQModel.predict
+        :param ids: iterable of ids for each code, defaults to consecutive ids following the last added code
+        """
+        codes = list(codes)
+        if len(codes) == 0:
+            return
+        coarse = np.array([c[0] for c in codes], dtype=np.int64)
+        fine = np.array([c[1] for c in codes], dtype=np.uint8)
+        self.add_code_arrays(coarse, fine, ids)
+
+    def add_code_arrays(self, coarse, fine, ids=None):
+        """
+        :param coarse: (items, 2) array of coarse codes
+        :param fine: (items, M) uint8 array of fine codes
+        :param ids: (items,) array of ids
+        """
+        if ids is None:
+            ids = np.arange(self.count, self.count + coarse.shape[0])
+        ids = np.asarray(ids, dtype=np.int64)
+        cell_keys = coarse[:, 0] * self.model.V + coarse[:, 1]
+        order = np.argsort(cell_keys, kind='mergesort')
+        cell_keys, starts = np.unique(cell_keys[order], return_index=True)
+        for key, selected in zip(cell_keys, np.split(order, starts[1:])):
+            cell = (int(key) // self.model.V, int(key) % self.model.V)
+            self.pending[cell].append((fine[selected], ids[selected]))
+        self.count += coarse.shape[0]
+
+    def consolidate(self):
+        for cell, parts in self.pending.items():
+            if cell in self.cells:
+                parts.insert(0, self.cells[cell])
+            self.cells[cell] = (np.concatenate([codes for codes, _ in parts]),
+                                np.concatenate([ids for _, ids in parts]))
+        self.pending.clear()
+
+    def get_cell(self, cell):
+        return self.cells.get(cell, None)
+
+    def subquantizer_distances(self, x, split, cluster):
+        """
+        :return: (fine splits per coarse split, clusters) squared distances of the projected query subvectors in
+        the local space of the given coarse cluster to every subquantizer centroid.
+        """
+        C, R, mu, _ = self.model.get_split_parameters(split)
+        cx = np.split(x, self.model.num_coarse_splits)[split]
+        px = np.dot(R[cluster], cx - C[cluster] - mu[cluster])
+        subC = self.subquantizers[split]
+        px = px.reshape((subC.shape[0], 1, subC.shape[2]))
+        return ((px - subC) ** 2).sum(axis=2)
+
+    def search(self, x, quota=10, limit=None):
+        """
+        Visit cells in multi-sequence order until quota items are retrieved and rank them by approximate distance.
+        :return: list of LOPQResult(id, dist) sorted by increasing distance and the number of visited cells
+        """
+        self.consolidate()
+        if limit is None:
+            limit = quota
+        x = np.asarray(x).squeeze()
+        luts = [{} for _ in range(self.model.num_coarse_splits)]
+        dists, ids = [], []
+        retrieved, visited = 0, 0
+        for _, cell in multisequence(x, self.model.Cs):
+            visited += 1
+            items = self.get_cell(cell)
+            if items is not None:
+                codes, cell_ids = items
+                for split, cluster in enumerate(cell):
+                    if cluster not in luts[split]:
+                        luts[split][cluster] = self.subquantizer_distances(x, split, cluster)
+                lut = np.concatenate([luts[split][cluster] for split, cluster in enumerate(cell)])
+                dists.append(lut[self.code_columns, codes].sum(axis=1))
+                ids.append(cell_ids)
+                retrieved += cell_ids.shape[0]
+            if retrieved >= quota:
+                break
+        if retrieved == 0:
+            return [], visited
+        dists = np.concatenate(dists)
+        ids = np.concatenate(ids)
+        if limit < dists.shape[0]:
+            top = np.argpartition(dists, limit - 1)[:limit]
+            dists, ids = dists[top], ids[top]
+        order = np.argsort(dists)
+        return [LOPQResult(int(ids[i]), float(dists[i])) for i in order], visited
 
 
 class BaseRetriever(object):
@@ -34,38 +287,42 @@ class BaseRetriever(object):
         self.net = None
         self.loaded_entries = {}
         self.index, self.files, self.findex = None, {}, 0
-        self.support_batching = False
+        self.store = VectorStore()
+        self.support_batching = True
 
     def load_index(self, numpy_matrix, entries):
-        temp_index = [numpy_matrix, ]
-        for i, e in enumerate(entries):
-            self.files[self.findex] = e
-            self.findex += 1
-        if self.index is None:
-            self.index = np.atleast_2d(np.concatenate(temp_index).squeeze())
-            logging.info(self.index.shape)
-        else:
-            self.index = np.concatenate([self.index, np.atleast_2d(np.concatenate(temp_index).squeeze())])
-            logging.info(self.index.shape)
+        self.store.append(numpy_matrix, entries)
+        self.findex = self.store.count
+        logging.info("{} vectors using {} bytes ({} bytes mapped) in {}".format(self.store.count,
+                                                                                 self.memory_usage(),
+                                                                                 self.store.mapped_nbytes,
+                                                                                 self.name))
+
+    def memory_usage(self):
+        """
+        :return: bytes of private memory held by the vectors loaded in this retriever
+        """
+        return self.store.nbytes
 
     def nearest(self, vector=None, n=12):
-        dist = None
-        results = []
+        return self.nearest_batch(vectors=vector, n=n).get(0, [])  # Next also return computed query_vector
+
+    def nearest_batch(self, vectors=None, n=12):
+        results = defaultdict(list)
         if self.approximator:
-            vector = np.atleast_2d(self.approximator.approximate(vector))
-        if self.index is not None:
-            try:
-                dist = spatial.distance.cdist(vector, self.index)
-            except:
-                raise ValueError("Could not compute distance Vector shape {} and index shape {}".format(vector.shape,
-                                                                                                        self.index.shape))
-        if dist is not None:
-            ranked = np.squeeze(dist.argsort())
-            for i, k in enumerate(ranked[:n]):
-                temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[0, k])}
-                temp.update(self.files[k])
-                results.append(temp)
-        return results  # Next also return computed query_vector
+            vectors = self.approximator.approximate_batch(np.atleast_2d(vectors))
+        vectors = np.atleast_2d(vectors)
+        if self.store.count:
+            if vectors.shape[-1] != self.store.components:
+                raise ValueError("Could not compute distance Vector shape {} and index components {}".format(
+                    vectors.shape, self.store.components))
+            dist, ids = exact_search(vectors, self.store.blocks(), n)
+            for vindex in range(ids.shape[0]):
+                for i, k in enumerate(ids[vindex]):
+                    temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[vindex, i])}
+                    temp.update(self.store.entry(k))
+                    results[vindex].append(temp)
+        return results
 
 
 class LOPQRetriever(BaseRetriever):
@@ -76,27 +333,50 @@ class LOPQRetriever(BaseRetriever):
         self.name = name
         self.loaded_entries = {}
         self.entries = []
-        self.support_batching = False
         self.approximator = approximator
         self.approximator.load()
-        self.searcher = LOPQSearcher(model=self.approximator.model)
+        self.searcher = NumpyLOPQSearcher(model=self.approximator.model)
 
     def load_index(self, numpy_matrix=None, entries=None):
-        codes = []
-        ids = []
+        """
+        :param numpy_matrix: dict with 'coarse' and 'fine' code arrays, None for older entries with codes in entries
+        :param entries:
+        """
+        if not len(entries):
+            return
         last_index = len(self.entries)
-        for i, e in enumerate(entries):
-            codes.append((tuple(e['codes'][0]), tuple(e['codes'][1])))
-            ids.append(i + last_index)
-            self.entries.append(e)
-        self.searcher.add_codes(codes, ids)
+        if numpy_matrix is None:
+            coarse = np.array([e['codes'][0] for e in entries], dtype=np.int64)
+            fine = np.array([e['codes'][1] for e in entries], dtype=np.uint8)
+        else:
+            coarse = numpy_matrix['coarse'].astype(np.int64)
+            fine = numpy_matrix['fine']
+        self.entries.extend(entries)
+        self.searcher.add_code_arrays(coarse, fine, np.arange(last_index, last_index + len(entries)))
+        self.findex = len(self.entries)
+
+    def memory_usage(self):
+        return self.searcher.nbytes
 
     def nearest(self, vector=None, n=12):
         results = []
         pca_vec = self.approximator.get_pca_vector(vector)
         results_indexes, visited = self.searcher.search(pca_vec, quota=n)
-        for r in results_indexes:
-            results.append(self.entries[r.id])
+        for i, r in enumerate(results_indexes):
+            temp = {'rank': i + 1, 'algo': self.name, 'dist': r.dist}
+            temp.update(self.entries[r.id])
+            results.append(temp)
+        return results
+
+    def nearest_batch(self, vectors=None, n=12):
+        results = defaultdict(list)
+        for vindex, vector in enumerate(np.atleast_2d(vectors)):
+            pca_vec = self.approximator.get_pca_vector(np.atleast_2d(vector))
+            results_indexes, visited = self.searcher.search(pca_vec, quota=n)
+            for i, r in enumerate(results_indexes):
+                temp = {'rank': i + 1, 'algo': self.name, 'dist': r.dist}
+                temp.update(self.entries[r.id])
+                results[vindex].append(temp)
         return results
 
 
@@ -173,6 +453,9 @@ class FaissFlatRetriever(BaseRetriever):
             self.faiss_index.add(numpy_matrix)
             logging.info("Index size {}".format(self.faiss_index.ntotal))
 
+    def memory_usage(self):
+        return self.faiss_index.ntotal * self.components * np.dtype(np.float32).itemsize
+
     def nearest(self, vector=None, n=12):
         vector = np.atleast_2d(vector)
         if vector.shape[-1] != self.components:
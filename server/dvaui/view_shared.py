@@ -346,22 +346,18 @@ def create_query_from_request(p, request):
                     dr = dvaapp.models.Retriever.objects.get(name='facenet', algorithm=dvaapp.models.Retriever.FAISS)
                 else:
                     dr = dvaapp.models.Retriever.objects.get(name='facenet', algorithm=dvaapp.models.Retriever.EXACT)
+                # faces are detected and embedded by facenet in the same task
                 query_json['map'].append({'operation': 'perform_detection',
                                           'arguments': {'detector_pk': int(d),
+                                                        'index': 'facenet',
                                                         'target': 'query',
                                                         'map': [{
-                                                            'operation': 'perform_indexing',
-                                                            'arguments': {'target': 'query_regions',
-                                                                          'index': 'facenet',
-                                                                          'filters': {'event_id': '__parent_event__'},
-                                                                          'map': [{
-                                                                              'operation': 'perform_retrieval',
-                                                                              'arguments': {'retriever_pk': dr.pk,
-                                                                                            'filters': {
-                                                                                                'event_id': '__parent_event__'},
-                                                                                            'target': 'query_region_index_vectors',
-                                                                                            'count': 10}
-                                                                          }]}
+                                                            'operation': 'perform_retrieval',
+                                                            'arguments': {'retriever_pk': dr.pk,
+                                                                          'filters': {
+                                                                              'event_id': '__parent_event__'},
+                                                                          'target': 'query_region_index_vectors',
+                                                                          'count': 10}
                                                         }]
                                                         }
                                           })
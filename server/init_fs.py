@@ -94,7 +94,7 @@ if __name__ == "__main__":
             logging.warning("Could not create Superuser, might be because one already exists in which "
                             "case please ignore.")
             pass
-    for create_dirname in ['queries', 'exports', 'external', 'retrievers', 'ingest', 'training_sets']:
+    for create_dirname in ['queries', 'exports', 'external', 'retrievers', 'ingest', 'training_sets', 'shards']:
         if not os.path.isdir("{}/{}".format(settings.MEDIA_ROOT, create_dirname)):
             try:
                 os.mkdir("{}/{}".format(settings.MEDIA_ROOT, create_dirname))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import django
+import sys, os, logging, threading, time, traceback
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                    datefmt='%m-%d %H:%M',
+                    filename='../logs/model_server.log',
+                    filemode='a')
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+django.setup()
+from multiprocessing.connection import Listener, AuthenticationError
+from django.conf import settings
+from django.db import close_old_connections
+from dvaapp.models import TEvent, TrainedModel
+from dvaapp.operations.runtime import ModelRuntime
+from dvaapp.task_handlers import handle_perform_analysis, handle_perform_indexing, handle_perform_detection
+
+
+def process_task(pk):
+    start = TEvent.objects.get(pk=pk)
+    logging.info("Executing {} {}".format(start.operation,pk))
+    if start.operation == 'perform_indexing':
+        return handle_perform_indexing(start)
+    elif start.operation == 'perform_detection':
+        return handle_perform_detection(start)
+    elif start.operation == 'perform_analysis':
+        return handle_perform_analysis(start)
+    else:
+        raise ValueError("Unknown task name {}".format(start.operation))
+
+
+def exit_with_parent(parent_pid):
+    """
+    The server is owned by the worker that launched it, exit once that worker is gone.
+    """
+    while os.getppid() == parent_pid:
+        time.sleep(5)
+    logging.info("Parent worker {} exited, stopping model server".format(parent_pid))
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    socket_path = sys.argv[-2]
+    model_pk = int(sys.argv[-1])
+    watcher = threading.Thread(target=exit_with_parent, args=(os.getppid(),))
+    watcher.daemon = True
+    watcher.start()
+    # warm up before accepting connections so that the first task routed to this server finds the model ready
+    ModelRuntime.warmup(TrainedModel.objects.get(pk=model_pk))
+    close_old_connections()
+    listener = Listener(socket_path, family='AF_UNIX', authkey=settings.SECRET_KEY)
+    logging.info("Model server for {} listening on {}".format(model_pk,socket_path))
+    while True:
+        try:
+            conn = listener.accept()
+        except (AuthenticationError, EOFError):
+            logging.exception("Rejected connection")
+            continue
+        try:
+            try:
+                pk = conn.recv()
+            except EOFError:
+                continue  # readiness check, the client closed without sending a task
+            try:
+                result = process_task(pk)
+            except:
+                logging.exception("Could not process {}".format(pk))
+                conn.send(('error', traceback.format_exc()))
+            else:
+                conn.send(('ok', result))
+        finally:
+            conn.close()
+            close_old_connections()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Unit tests of dvaapp.operations.compaction, requires the database configured in dva.settings.
+Run with: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os, sys, shutil, tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+import django
+django.setup()
+import numpy as np
+from django.test import TestCase, override_settings
+from dvaapp.models import Video, TEvent, IndexEntries, IndexShard
+from dvaapp.operations import compaction
+
+SHASUM = 'a' * 40
+
+
+class CompactionTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        self.event = TEvent.objects.create(completed=True)
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root)
+
+    def create_index_entries(self, vectors):
+        video = Video.objects.create(name='video')
+        entries = [{'frame_index': i} for i in range(len(vectors))]
+        di = IndexEntries.objects.create(video=video, features_file_name='{}.npy'.format(video.pk), entries=entries,
+                                         algorithm='inception', indexer_shasum=SHASUM, detection_name='Frame',
+                                         count=len(vectors), contains_frames=True, event=self.event)
+        os.makedirs("{}/{}/indexes".format(self.media_root, video.pk))
+        np.save(di.npy_path(), vectors)
+        return di
+
+    def test_build_shard_keeps_order_and_dtype(self):
+        rs = np.random.RandomState(0)
+        parts = [rs.randn(n, 4).astype(np.float16) for n in (3, 1, 5)]
+        index_entries = [self.create_index_entries(v) for v in parts]
+        shard = compaction.build_shard(index_entries, self.event)
+        vectors, entries = shard.load_index()
+        self.assertEqual(vectors.dtype, np.float16)
+        np.testing.assert_array_equal(vectors, np.concatenate(parts))
+        self.assertEqual(len(entries), 9)
+        self.assertEqual((shard.count, shard.index_entries_count), (9, 3))
+        self.assertEqual(IndexEntries.objects.filter(shard=shard).count(), 3)
+
+    def test_build_shard_refuses_mixed_dtypes(self):
+        index_entries = [self.create_index_entries(np.zeros((2, 4), dtype=np.float32)),
+                         self.create_index_entries(np.zeros((2, 4), dtype=np.float64))]
+        self.assertRaises(ValueError, compaction.build_shard, index_entries, self.event)
+        self.assertFalse(IndexShard.objects.exists())
+        self.assertFalse(IndexEntries.objects.filter(shard__isnull=False).exists())
+
+    def test_compact_index_entries_groups(self):
+        for n in (4, 4, 4, 4, 4):
+            self.create_index_entries(np.ones((n, 2), dtype=np.float32))
+        shards = compaction.compact_index_entries(self.event, SHASUM, max_shard_rows=8)
+        self.assertEqual([s.count for s in shards], [8, 8])
+        # The last entry forms a group of one which is left as it is.
+        self.assertEqual(compaction.get_compactable_queryset(SHASUM).count(), 1)
+        self.assertEqual(compaction.compact_index_entries(self.event, SHASUM, max_shard_rows=8), [])
+
+    def test_deleting_video_invalidates_shard(self):
+        index_entries = [self.create_index_entries(np.ones((2, 2), dtype=np.float32)) for _ in range(3)]
+        shard = compaction.build_shard(index_entries, self.event)
+        index_entries[1].video.delete()
+        self.assertFalse(IndexShard.objects.filter(pk=shard.pk).exists())
+        self.assertFalse(os.path.isfile(shard.npy_path()))
+        self.assertFalse(os.path.isfile(shard.entries_path()))
+        self.assertEqual(compaction.get_compactable_queryset(SHASUM).count(), 2)
+        shards = compaction.compact_index_entries(self.event, SHASUM)
+        self.assertEqual([s.count for s in shards], [4])
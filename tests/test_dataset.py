@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Unit tests of dvaapp.operations.dataset.get_image_size on the images shipped with the static files.
+Run with: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+import django
+django.setup()
+from dvaapp.operations.dataset import get_image_size
+
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/dvaapp/static/dist/img/')
+
+
+class GetImageSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_jpeg(self):
+        # photo3.jpg has an Exif segment before its start of frame, user4-128x128.jpg is grayscale
+        for name, size in [('photo3.jpg', (2000, 1333)), ('photo4.jpg', (2000, 1320)),
+                           ('user2-160x160.jpg', (160, 160)), ('user4-128x128.jpg', (128, 128)),
+                           ('boxed-bg.jpg', (600, 600))]:
+            self.assertEqual(get_image_size(os.path.join(IMG_DIR, name)), size)
+
+    def test_other_formats(self):
+        self.assertEqual(get_image_size(os.path.join(IMG_DIR, 'photo1.png')), (1250, 835))
+        self.assertEqual(get_image_size(os.path.join(IMG_DIR, 'default-50x50.gif')), (50, 50))
+
+    def test_not_an_image(self):
+        path = os.path.join(self.dirname, 'labels.txt')
+        with open(path, 'w') as fh:
+            fh.write('not an image\n')
+        self.assertIsNone(get_image_size(path))
+        self.assertIsNone(get_image_size(os.path.join(self.dirname, 'missing.jpg')))
+
+    def test_truncated_jpeg(self):
+        path = os.path.join(self.dirname, 'truncated.jpg')
+        with open(os.path.join(IMG_DIR, 'photo3.jpg'), 'rb') as fh:
+            data = fh.read(64)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        self.assertIsNone(get_image_size(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Unit tests of the frame selection and matching functions of dvaapp.operations.decoding.
+Run with: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+import django
+django.setup()
+from dvaapp.operations import decoding
+
+
+class FakeVideo(object):
+    pk = 1
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def path(self):
+        return '/tmp/1/video/1.mp4'
+
+
+def synthetic_segment(start_time, count=30, fps=30.0, gop=10):
+    """
+    :return: framelist of a segment starting at start_time, as stored in Segment.framelist
+    """
+    return [(i, ('I' if i % gop == 0 else 'P', start_time + i / fps)) for i in range(count)]
+
+
+class MatchFrameTimesTest(unittest.TestCase):
+
+    def test_times_of_later_segment(self):
+        segment_frames = synthetic_segment(12.0)
+        times = [12.0, 12.0 + 10 / 30.0, 12.0 + 20 / 30.0]
+        self.assertEqual(decoding.match_frame_times(segment_frames, times),
+                         [(1, segment_frames[0]), (2, segment_frames[10]), (3, segment_frames[20])])
+
+    def test_nearest_frame(self):
+        segment_frames = synthetic_segment(5.0)
+        times = [5.0 + 3 / 30.0 + 0.01, 5.0 + 7 / 30.0 - 0.01, 10.0]
+        self.assertEqual(decoding.match_frame_times(segment_frames, times),
+                         [(1, segment_frames[3]), (2, segment_frames[7]), (3, segment_frames[29])])
+
+    def test_duplicates_are_removed(self):
+        segment_frames = synthetic_segment(1.0)
+        times = [1.0, 1.001, 1.0 + 1 / 30.0]
+        self.assertEqual(decoding.match_frame_times(segment_frames, times),
+                         [(1, segment_frames[0]), (3, segment_frames[1])])
+
+
+class SelectFramesTest(unittest.TestCase):
+
+    def test_denominator(self):
+        segment_frames = synthetic_segment(7.0, gop=12)
+        selected = decoding.select_frames(segment_frames, denominator=5)
+        self.assertEqual([k for k, _ in selected], [0, 5, 10, 12, 15, 20, 24, 25])
+
+    def test_frame_indexes(self):
+        segment_frames = synthetic_segment(3.0)
+        selected = decoding.select_frames(segment_frames, frame_indexes={89, 90, 95, 120}, start_index=90)
+        self.assertEqual([k for k, _ in selected], [0, 5])
+
+    def test_fps_is_continuous_across_segments(self):
+        frames = synthetic_segment(0.0, count=90)
+        first = [(k, v) for k, v in frames[:45]]
+        second = [(k - 45, v) for k, v in frames[45:]]
+        selected = decoding.select_frames(first, sampling=decoding.SAMPLE_FPS, fps=2)
+        selected += decoding.select_frames(second, sampling=decoding.SAMPLE_FPS, fps=2)
+        self.assertEqual([v[1] for _, v in selected], [frames[i][1][1] for i in range(0, 90, 15)])
+
+    def test_fps_of_later_segment(self):
+        segment_frames = synthetic_segment(10.5, count=30)
+        selected = decoding.select_frames(segment_frames, sampling=decoding.SAMPLE_FPS, fps=1)
+        self.assertEqual([k for k, _ in selected], [15])
+
+    def test_decoder_sampling_is_rejected(self):
+        segment_frames = synthetic_segment(2.0)
+        for sampling in (decoding.SAMPLE_KEYFRAMES, decoding.SAMPLE_SCENE):
+            self.assertRaises(ValueError, decoding.select_frames, segment_frames, sampling=sampling)
+        self.assertRaises(ValueError, decoding.select_frames, segment_frames, sampling=decoding.SAMPLE_FPS)
+
+
+class FrameSizeTest(unittest.TestCase):
+
+    def test_scale(self):
+        self.assertEqual(decoding.VideoDecoder(FakeVideo(1920, 1080), '/tmp').get_scale(), 1.0)
+        self.assertEqual(decoding.VideoDecoder(FakeVideo(1920, 1080), '/tmp', rescale=480).get_scale(), 0.25)
+        self.assertEqual(decoding.VideoDecoder(FakeVideo(1080, 1920), '/tmp', rescale='960').get_scale(), 0.5)
+        # frames are never upscaled
+        self.assertEqual(decoding.VideoDecoder(FakeVideo(320, 240), '/tmp', rescale=640).get_scale(), 1.0)
+        self.assertEqual(decoding.VideoDecoder(FakeVideo(0, 0), '/tmp', rescale=640).get_scale(), 1.0)
+
+    def test_filters(self):
+        decoder = decoding.VideoDecoder(FakeVideo(1280, 720), '/tmp', rescale=320)
+        self.assertEqual(decoder.get_frame_size(), (320, 180))
+        self.assertEqual(decoder.get_filters(), ['scale=320:180'])
+        self.assertEqual(decoder.get_filters('gt(scene\\,0.3)'), ['select=gt(scene\\,0.3)', 'scale=320:180'])
+        self.assertEqual(decoding.VideoDecoder(FakeVideo(1280, 720), '/tmp', rescale=2000).get_filters(), [])
+
+    def test_frame_size_is_at_least_one_pixel(self):
+        decoder = decoding.VideoDecoder(FakeVideo(4000, 10), '/tmp', rescale=100)
+        self.assertEqual(decoder.get_frame_size(), (100, 1))
+
+    def test_forced_size(self):
+        decoder = decoding.VideoDecoder(FakeVideo(1920, 1080), '/tmp')
+        self.assertEqual(decoder.get_filters('eq(n\\,0)'), ['select=eq(n\\,0)'])
+        self.assertEqual(decoder.get_filters('eq(n\\,0)', force_size=True), ['select=eq(n\\,0)', 'scale=1920:1080'])
+
+    def test_rotated_display_size(self):
+        decoder = decoding.VideoDecoder(FakeVideo(1920, 1080), '/tmp', rescale=480)
+        decoder.display_size = (1080, 1920)
+        self.assertEqual(decoder.get_frame_size(), (270, 480))
+        self.assertEqual(decoder.get_filters(force_size=True), ['scale=270:480'])
+
+
+def open_gop_framelist(gop=12, gops=3, fps=25.0):
+    """
+    :return: framelist as returned by VideoDecoder.get_framelist of a video with open GOPs, the two B-frames before
+    each keyframe are stored after it and the packet position of a frame is 100 x its position in decoding order
+    """
+    decoding_order = []
+    for g in range(0, gop * gops, gop):
+        decoding_order.append(g)
+        if g > 0:
+            decoding_order.extend([g - 2, g - 1])
+        for p in range(g + 3, g + gop, 3):
+            decoding_order.extend([p, p - 2, p - 1])
+    decoding_order.extend([gop * gops - 2, gop * gops - 1])
+    positions = {k: 100 * i for i, k in enumerate(decoding_order)}
+    return [('I' if k % gop == 0 else ('P' if k % 3 == 0 else 'B'), k / fps, k % gop == 0, positions[k])
+            for k in range(gop * gops)]
+
+
+class SegmentFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'segments.csv')
+        with open(self.path, 'w') as segment_list:
+            segment_list.write('1.mp4,0.480000,0.960000\n0.mp4,0.000000,0.480000\n2.mp4,0.960000,1.440000\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def assign(self, frames):
+        segments = decoding.read_segment_list(self.path)
+        self.assertEqual([i for i, _, _ in segments], [0, 1, 2])
+        return decoding.assign_segment_frames(frames, [start_time for _, start_time, _ in segments])
+
+    def test_open_gop_frames_follow_their_packets(self):
+        frames = open_gop_framelist()
+        segment_frames = self.assign(frames)
+        self.assertEqual([[int(round(t * 25)) for _, t in f] for f in segment_frames],
+                         [list(range(0, 10)), list(range(10, 22)), list(range(22, 36))])
+        self.assertEqual(segment_frames[1][2], ('I', 0.48))
+
+    def test_frames_without_positions_are_assigned_by_time(self):
+        frames = [(pict_type, t, key_frame, None) for pict_type, t, key_frame, _ in open_gop_framelist()]
+        segment_frames = self.assign(frames)
+        self.assertEqual([[int(round(t * 25)) for _, t in f] for f in segment_frames],
+                         [list(range(0, 12)), list(range(12, 24)), list(range(24, 36))])
+
+    def test_missing_keyframe_falls_back_to_time(self):
+        frames = [(pict_type, t, key_frame and t < 0.9, pkt_pos)
+                  for pict_type, t, key_frame, pkt_pos in open_gop_framelist()]
+        segment_frames = self.assign(frames)
+        self.assertEqual([len(f) for f in segment_frames], [12, 12, 12])
+
+
+if __name__ == '__main__':
+    unittest.main()
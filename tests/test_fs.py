@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Unit tests of dvaapp.fs.Downloader and is_transient_error, downloads are replaced by a fake get_path_to_file.
+Run with: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os, sys, shutil, tempfile, threading, unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+import django
+django.setup()
+import requests
+import botocore.exceptions
+from dvaapp import fs
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+def client_error(status_code, code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code},
+                                            'ResponseMetadata': {'HTTPStatusCode': status_code}}, 'GetObject')
+
+
+class FakeGetPathToFile(object):
+    """
+    Raises the errors listed for a path one after the other, then writes the path to local_path.
+    """
+
+    def __init__(self, errors):
+        self.errors = {path: list(path_errors) for path, path_errors in errors.items()}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, path, local_path, session=None):
+        with self.lock:
+            self.calls.append(path)
+            path_errors = self.errors.get(path)
+            error = path_errors.pop(0) if path_errors else None
+        if error is not None:
+            raise error
+        with open(local_path, 'w') as fh:
+            fh.write(path)
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.get_path_to_file = fs.get_path_to_file
+
+    def tearDown(self):
+        fs.get_path_to_file = self.get_path_to_file
+        shutil.rmtree(self.dirname)
+
+    def fake(self, errors=None):
+        fs.get_path_to_file = FakeGetPathToFile(errors or {})
+        return fs.get_path_to_file
+
+    def local_path(self, name):
+        return os.path.join(self.dirname, name)
+
+    def test_transient_errors_are_retried(self):
+        fake = self.fake({'http://a/1.jpg': [http_error(503), requests.ConnectionError()]})
+        downloader = fs.Downloader(concurrency=1, retries=2, backoff=0)
+        self.assertEqual(downloader.download('http://a/1.jpg', self.local_path('1.jpg')), self.local_path('1.jpg'))
+        self.assertEqual(len(fake.calls), 3)
+        self.assertEqual((downloader.stats['downloaded'], downloader.stats['retries']), (1, 2))
+        self.assertEqual(downloader.stats['bytes'], len('http://a/1.jpg'))
+
+    def test_retries_are_limited(self):
+        fake = self.fake({'http://a/1.jpg': [http_error(500)] * 3})
+        downloader = fs.Downloader(concurrency=1, retries=2, backoff=0)
+        self.assertRaises(requests.HTTPError, downloader.download, 'http://a/1.jpg', self.local_path('1.jpg'))
+        self.assertEqual(len(fake.calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        fake = self.fake({'http://a/1.jpg': [http_error(404)]})
+        downloader = fs.Downloader(concurrency=1, retries=2, backoff=0)
+        self.assertRaises(requests.HTTPError, downloader.download, 'http://a/1.jpg', self.local_path('1.jpg'))
+        self.assertEqual(len(fake.calls), 1)
+        self.assertEqual(downloader.stats['retries'], 0)
+
+    def test_download_all_keeps_order(self):
+        self.fake({'http://a/3.jpg': [client_error(403, 'AccessDenied')], 'http://a/5.jpg': [requests.Timeout()]})
+        items = [('http://a/{}.jpg'.format(i), self.local_path('{}.jpg'.format(i))) for i in range(10)]
+        downloader = fs.Downloader(concurrency=4, retries=1, backoff=0)
+        results = downloader.download_all(items, process=lambda local_path: os.path.basename(local_path))
+        self.assertEqual(results, [None if i == 3 else '{}.jpg'.format(i) for i in range(10)])
+        self.assertEqual(downloader.stats['downloaded'], 9)
+        self.assertEqual(downloader.stats['failed'], 1)
+        self.assertEqual(downloader.stats['retries'], 1)
+
+
+class IsTransientErrorTest(unittest.TestCase):
+
+    def test_http(self):
+        for status_code, transient in [(429, True), (500, True), (503, True), (403, False), (404, False)]:
+            self.assertEqual(fs.is_transient_error(http_error(status_code)), transient)
+        self.assertFalse(fs.is_transient_error(requests.HTTPError()))
+        for e in [requests.ConnectionError(), requests.Timeout(), requests.exceptions.ChunkedEncodingError()]:
+            self.assertTrue(fs.is_transient_error(e))
+
+    def test_s3(self):
+        self.assertTrue(fs.is_transient_error(client_error(503, 'SlowDown')))
+        self.assertTrue(fs.is_transient_error(client_error(400, 'Throttling')))
+        self.assertFalse(fs.is_transient_error(client_error(404, 'NoSuchKey')))
+        self.assertTrue(fs.is_transient_error(botocore.exceptions.EndpointConnectionError(endpoint_url='http://s3')))
+        self.assertTrue(fs.is_transient_error(botocore.exceptions.ReadTimeoutError(endpoint_url='http://s3')))
+
+    def test_other_errors(self):
+        for e in [ValueError(), IOError(), KeyError()]:
+            self.assertFalse(fs.is_transient_error(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Unit tests of dvaapp.operations.retrieval, requires the database configured in dva.settings.
+Run with: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os, sys, shutil, tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+import django
+django.setup()
+import numpy as np
+from django.test import TestCase, override_settings
+from dvaapp.models import Video, TEvent, IndexEntries
+from dvaapp.operations.retrieval import Retrievers
+
+SHASUM = 'b' * 40
+
+
+class FakeRetriever(object):
+    pk = -1
+    source_filters = {}
+    indexer_shasum = SHASUM
+    approximator_shasum = None
+
+
+class FakeVisualIndex(object):
+    algorithm = 'exact'
+    name = 'fake'
+
+    def __init__(self):
+        self.loaded_entries = {}
+        self.findex = 0
+        self.entries = []
+
+    def load_index(self, vectors, entries):
+        self.findex += vectors.shape[0]
+        self.entries.extend(entries)
+
+    def memory_usage(self):
+        return 0
+
+
+class UpdateIndexTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root, ENABLE_INDEX_MMAP=False)
+        self.override.enable()
+        self.event = TEvent.objects.create(completed=True)
+        self.dr = FakeRetriever()
+        self.visual_index = FakeVisualIndex()
+        Retrievers._visual_retriever[self.dr.pk] = self.visual_index
+        Retrievers._index_watermark.pop(self.dr.pk, None)
+
+    def tearDown(self):
+        Retrievers._visual_retriever.pop(self.dr.pk, None)
+        Retrievers._index_watermark.pop(self.dr.pk, None)
+        Retrievers._index_version.pop(self.dr.pk, None)
+        self.override.disable()
+        shutil.rmtree(self.media_root)
+
+    def create_index_entries(self, rows, save=True):
+        video = Video.objects.create(name='video')
+        di = IndexEntries.objects.create(video=video, features_file_name='{}.npy'.format(video.pk),
+                                         entries=[{'frame_index': i} for i in range(rows)], algorithm='inception',
+                                         indexer_shasum=SHASUM, detection_name='Frame', count=rows,
+                                         contains_frames=True, event=self.event)
+        os.makedirs("{}/{}/indexes".format(self.media_root, video.pk))
+        if save:
+            self.save_vectors(di)
+        return di
+
+    def save_vectors(self, di):
+        np.save(di.npy_path(), np.ones((di.count, 4), dtype=np.float32))
+
+    def test_watermark_stops_at_failure(self):
+        first = self.create_index_entries(2)
+        missing = self.create_index_entries(3, save=False)
+        last = self.create_index_entries(4)
+        Retrievers.update_index(self.dr)
+        self.assertEqual(list(self.visual_index.loaded_entries.keys()), [first.pk])
+        self.assertEqual(Retrievers._index_watermark[self.dr.pk], first.pk)
+        self.save_vectors(missing)
+        Retrievers.update_index(self.dr)
+        self.assertEqual(sorted(self.visual_index.loaded_entries.keys()), [first.pk, missing.pk, last.pk])
+        self.assertEqual(self.visual_index.findex, 9)
+        self.assertEqual(Retrievers._index_watermark[self.dr.pk], last.pk)
+
+    def test_watermark_skips_running_events(self):
+        first = self.create_index_entries(2)
+        running = self.create_index_entries(3)
+        running.event = TEvent.objects.create(completed=False)
+        running.save()
+        self.create_index_entries(4)
+        Retrievers.update_index(self.dr)
+        self.assertEqual(list(self.visual_index.loaded_entries.keys()), [first.pk])
+        self.assertEqual(Retrievers._index_watermark[self.dr.pk], first.pk)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Unit tests of dvalib.retriever, each implementation is checked against a straightforward reference computation on
+small deterministic data. Run with: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+import numpy as np
+from dvalib import retriever
+
+try:
+    from lopq import LOPQModel, LOPQSearcher
+except ImportError:
+    LOPQModel, LOPQSearcher = None, None
+
+D = 8  # dimensions
+V = 3  # clusters per coarse split
+COARSE_SPLITS = 2
+FINE_SPLITS = 2  # fine splits per coarse split
+S = 5  # clusters per subquantizer
+
+
+def brute_force(queries, index, n):
+    dist = np.sqrt(((queries[:, np.newaxis, :].astype(np.float64) - index[np.newaxis, :, :]) ** 2).sum(axis=2))
+    ids = np.argsort(dist, axis=1)[:, :n]
+    return dist[np.arange(dist.shape[0])[:, np.newaxis], ids], ids
+
+
+class ExactSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(3)
+        self.index = rs.randn(40, D).astype(np.float32)
+        self.queries = rs.randn(4, D).astype(np.float32)
+
+    def blocks(self, block_size):
+        for start in range(0, self.index.shape[0], block_size):
+            block = self.index[start:start + block_size]
+            yield start, block, (block ** 2).sum(axis=1)
+
+    def test_matches_brute_force(self):
+        for block_size in (3, 7, 40, 100):
+            for n in (1, 5, 12):
+                dist, ids = retriever.exact_search(self.queries, self.blocks(block_size), n)
+                expected_dist, expected_ids = brute_force(self.queries, self.index, n)
+                np.testing.assert_array_equal(ids, expected_ids)
+                np.testing.assert_allclose(dist, expected_dist, rtol=1e-4, atol=1e-4)
+
+    def test_fewer_rows_than_n(self):
+        dist, ids = retriever.exact_search(self.queries[0], self.blocks(7), 100)
+        self.assertEqual(ids.shape, (1, self.index.shape[0]))
+        np.testing.assert_array_equal(ids, brute_force(self.queries[:1], self.index, 100)[1])
+
+
+
+class VectorStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        rs = np.random.RandomState(4)
+        self.vectors = rs.randn(30, D).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def mapped(self, vectors):
+        path = os.path.join(self.dirname, '{}.npy'.format(len(os.listdir(self.dirname))))
+        np.save(path, vectors)
+        return np.load(path, mmap_mode='r')
+
+    def assert_store(self, store, vectors, entries):
+        self.assertEqual(store.count, vectors.shape[0])
+        rows = np.concatenate([block for _, block, _ in store.blocks(block_size=4)])
+        norms = np.concatenate([block_norms for _, _, block_norms in store.blocks(block_size=4)])
+        starts = [start for start, _, _ in store.blocks(block_size=4)]
+        np.testing.assert_array_equal(rows, vectors)
+        np.testing.assert_allclose(norms, (vectors ** 2).sum(axis=1), rtol=1e-5)
+        self.assertEqual(starts, sorted(starts))
+        self.assertEqual([store.entry(i) for i in range(store.count)], entries)
+
+    def test_append_grows_capacity(self):
+        store = retriever.VectorStore(initial_capacity=2)
+        entries = ['e{}'.format(i) for i in range(30)]
+        for start, stop in ((0, 1), (1, 4), (4, 17), (17, 30)):
+            store.append(self.vectors[start:stop], entries[start:stop])
+        self.assertGreaterEqual(store.capacity, 30)
+        self.assert_store(store, self.vectors, entries)
+
+    def test_mapped_segments_come_first(self):
+        store = retriever.VectorStore(initial_capacity=2, mapped_min_rows=8)
+        entries = ['e{}'.format(i) for i in range(30)]
+        store.append(self.vectors[:5], entries[:5])
+        store.append(self.mapped(self.vectors[5:15]), entries[5:15])  # kept mapped
+        store.append(self.mapped(self.vectors[15:20]), entries[15:20])  # too small, copied
+        store.append(self.mapped(self.vectors[20:30]), entries[20:30])  # kept mapped
+        self.assertEqual(len(store.segments), 2)
+        self.assertEqual(store.mapped_nbytes, self.vectors[5:15].nbytes + self.vectors[20:30].nbytes)
+        order = list(range(5, 15)) + list(range(20, 30)) + list(range(0, 5)) + list(range(15, 20))
+        self.assert_store(store, self.vectors[order], [entries[i] for i in order])
+        dist, ids = retriever.exact_search(self.vectors[:3], store.blocks(block_size=4), 1)
+        self.assertEqual([store.entry(i) for i in ids[:, 0]], entries[:3])
+
+    def test_invalid_append(self):
+        store = retriever.VectorStore()
+        store.append(self.vectors[:2], ['a', 'b'])
+        self.assertRaises(ValueError, store.append, self.vectors[:2], ['a'])
+        self.assertRaises(ValueError, store.append, np.zeros((2, D + 1), dtype=np.float32), ['a', 'b'])
+
+
+class SyntheticModel(object):
+    """
+    Deterministic model with the attributes of lopq.LOPQModel that NumpyLOPQSearcher reads.
+    """
+
+    def __init__(self, seed=0):
+        rs = np.random.RandomState(seed)
+        half = D // COARSE_SPLITS
+        self.V = V
+        self.num_coarse_splits = COARSE_SPLITS
+        self.num_fine_splits = FINE_SPLITS
+        self.Cs = tuple(rs.randn(V, half) * 4 for _ in range(COARSE_SPLITS))
+        self.Rs = tuple(np.array([np.linalg.qr(rs.randn(half, half))[0] for _ in range(V)])
+                        for _ in range(COARSE_SPLITS))
+        self.mus = tuple(rs.randn(V, half) * 0.1 for _ in range(COARSE_SPLITS))
+        self.subquantizers = tuple([rs.randn(S, half // FINE_SPLITS) for _ in range(FINE_SPLITS)]
+                                   for _ in range(COARSE_SPLITS))
+
+    def get_split_parameters(self, split):
+        return self.Cs[split], self.Rs[split], self.mus[split], self.subquantizers[split]
+
+    def parameters(self):
+        return self.Cs, self.Rs, self.mus, self.subquantizers
+
+
+def reference_projection(model, x, split, cluster):
+    half = D // COARSE_SPLITS
+    cx = x[split * half:(split + 1) * half]
+    residual = cx - model.Cs[split][cluster] - model.mus[split][cluster]
+    R = model.Rs[split][cluster]
+    return np.array([sum(R[i, j] * residual[j] for j in range(half)) for i in range(half)])
+
+
+def reference_subquantizer_distances(model, x, split, cluster):
+    px = reference_projection(model, x, split, cluster)
+    size = D // (COARSE_SPLITS * FINE_SPLITS)
+    return np.array([[sum((px[j * size + k] - model.subquantizers[split][j][c][k]) ** 2 for k in range(size))
+                      for c in range(S)] for j in range(FINE_SPLITS)])
+
+
+def reference_distance(model, x, code):
+    coarse, fine = code
+    dist = 0.0
+    for split, cluster in enumerate(coarse):
+        lut = reference_subquantizer_distances(model, x, split, cluster)
+        for j in range(FINE_SPLITS):
+            dist += lut[j][fine[split * FINE_SPLITS + j]]
+    return dist
+
+
+def random_codes(count, seed=1):
+    rs = np.random.RandomState(seed)
+    return [(tuple(int(c) for c in rs.randint(0, V, COARSE_SPLITS)),
+             tuple(int(f) for f in rs.randint(0, S, COARSE_SPLITS * FINE_SPLITS))) for _ in range(count)]
+
+
+class NumpyLOPQSearcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = SyntheticModel()
+        self.query = np.random.RandomState(2).randn(D)
+
+    def test_subquantizer_distances(self):
+        searcher = retriever.NumpyLOPQSearcher(self.model)
+        for split in range(COARSE_SPLITS):
+            for cluster in range(V):
+                np.testing.assert_allclose(searcher.subquantizer_distances(self.query, split, cluster),
+                                           reference_subquantizer_distances(self.model, self.query, split, cluster),
+                                           rtol=1e-10)
+
+    def test_cells(self):
+        codes = random_codes(50)
+        searcher = retriever.NumpyLOPQSearcher(self.model)
+        searcher.add_codes(codes[:20])
+        searcher.add_codes(codes[20:], ids=range(100, 130))
+        searcher.consolidate()
+        ids = list(range(20)) + list(range(100, 130))
+        for cell in set(coarse for coarse, _ in codes):
+            expected = [(i, fine) for i, (coarse, fine) in zip(ids, codes) if coarse == cell]
+            cell_codes, cell_ids = searcher.get_cell(cell)
+            self.assertEqual([(int(i), tuple(int(f) for f in fine)) for i, fine in zip(cell_ids, cell_codes)],
+                             expected)
+
+    @unittest.skipIf(LOPQModel is None, "lopq is not installed")
+    def test_ranking_all_cells(self):
+        codes = random_codes(60)
+        searcher = retriever.NumpyLOPQSearcher(self.model)
+        searcher.add_codes(codes)
+        results, visited = searcher.search(self.query, quota=len(codes), limit=10)
+        expected = sorted(range(len(codes)), key=lambda i: reference_distance(self.model, self.query, codes[i]))[:10]
+        self.assertEqual([r.id for r in results], expected)
+        for r in results:
+            self.assertAlmostEqual(r.dist, reference_distance(self.model, self.query, codes[r.id]))
+
+    @unittest.skipIf(LOPQModel is None, "lopq is not installed")
+    def test_ranking_matches_lopq(self):
+        codes = random_codes(60)
+        model = LOPQModel(parameters=self.model.parameters())
+        searcher = retriever.NumpyLOPQSearcher(model)
+        searcher.add_codes(codes)
+        reference = LOPQSearcher(model)
+        reference.add_codes(codes)
+        for quota in (1, 7, 25, 60):
+            results, visited = searcher.search(self.query, quota=quota)
+            expected, expected_visited = reference.search(self.query, quota=quota, with_dists=True)
+            self.assertEqual(visited, expected_visited)
+            self.assertEqual([r.id for r in results], [r.id for r in expected])
+            np.testing.assert_allclose([r.dist for r in results], [r.dist for r in expected], rtol=1e-10)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
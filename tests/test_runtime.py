@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Unit tests of dvaapp.operations.runtime.ModelRuntime with fake models.
+Run with: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+import django
+django.setup()
+from collections import OrderedDict, defaultdict
+from django.test import SimpleTestCase, override_settings
+from dvaapp.operations import runtime
+from dvaapp.operations.runtime import ModelRuntime
+
+MB = 1024 * 1024
+
+
+class FakeRSS(object):
+
+    def __init__(self):
+        self.rss = 100 * MB
+
+    def __call__(self):
+        return self.rss
+
+
+class FakeModel(object):
+    """
+    Allocates load_memory when loaded and run_memory on its first run, like a TensorFlow model.
+    """
+
+    def __init__(self, rss, load_memory, run_memory=0):
+        self.rss = rss
+        self.load_memory = load_memory
+        self.run_memory = run_memory
+        self.allocated = 0
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        self.allocated = self.load_memory
+        self.rss.rss += self.load_memory
+
+    def warmup(self, path):
+        self.allocated += self.run_memory
+        self.rss.rss += self.run_memory
+
+    def unload(self):
+        self.rss.rss -= self.allocated
+        self.allocated = 0
+
+
+@override_settings(MODEL_MEMORY_BUDGET=100 * MB)
+class ModelRuntimeTest(SimpleTestCase):
+
+    def setUp(self):
+        self.get_rss = runtime.get_rss
+        self.get_warmup_image = runtime.get_warmup_image
+        runtime.get_rss = self.rss = FakeRSS()
+        runtime.get_warmup_image = lambda: 'warmup.jpg'
+        ModelRuntime._models = OrderedDict()
+        ModelRuntime._memory = {}
+        ModelRuntime._stats = defaultdict(int)
+        ModelRuntime._pins = defaultdict(int)
+
+    def tearDown(self):
+        runtime.get_rss = self.get_rss
+        runtime.get_warmup_image = self.get_warmup_image
+
+    def test_memory_includes_first_run(self):
+        model = FakeModel(self.rss, 10 * MB, run_memory=30 * MB)
+        ModelRuntime.acquire(('indexer', 1), model)
+        self.assertEqual(ModelRuntime.memory_usage(), 40 * MB)
+
+    def test_declared_memory(self):
+        model = FakeModel(self.rss, 10 * MB, run_memory=30 * MB)
+        ModelRuntime.acquire(('indexer', 1), model, memory=60 * MB)
+        self.assertEqual(ModelRuntime.memory_usage(), 60 * MB)
+
+    def test_least_recently_used_is_evicted(self):
+        models = {i: FakeModel(self.rss, 40 * MB) for i in range(3)}
+        ModelRuntime.acquire(('indexer', 0), models[0])
+        ModelRuntime.acquire(('indexer', 1), models[1])
+        ModelRuntime.acquire(('indexer', 0), models[0])
+        ModelRuntime.acquire(('indexer', 2), models[2])
+        self.assertEqual(list(ModelRuntime._models.keys()), [('indexer', 0), ('indexer', 2)])
+        self.assertEqual(models[1].allocated, 0)
+        self.assertEqual(ModelRuntime.stats()['evictions'], 1)
+        self.assertEqual(ModelRuntime.stats()['hits'], 1)
+        self.assertEqual(ModelRuntime.memory_usage(), 80 * MB)
+
+    def test_evicted_model_is_reloaded(self):
+        models = {i: FakeModel(self.rss, 60 * MB) for i in range(2)}
+        ModelRuntime.acquire(('indexer', 0), models[0])
+        ModelRuntime.acquire(('indexer', 1), models[1])
+        ModelRuntime.acquire(('indexer', 0), models[0])
+        self.assertEqual(list(ModelRuntime._models.keys()), [('indexer', 0)])
+        self.assertEqual((models[0].loads, models[1].loads), (2, 1))
+        self.assertEqual(models[1].allocated, 0)
+
+    def test_model_larger_than_budget_is_kept(self):
+        model = FakeModel(self.rss, 150 * MB)
+        ModelRuntime.acquire(('detector', 0), model)
+        self.assertEqual(list(ModelRuntime._models.keys()), [('detector', 0)])
+
+    def test_pinned_models_are_not_evicted(self):
+        detector, indexer = FakeModel(self.rss, 60 * MB), FakeModel(self.rss, 60 * MB)
+        with ModelRuntime.pinned():
+            ModelRuntime.acquire(('detector', 0), detector)
+            ModelRuntime.acquire(('indexer', 1), indexer)
+            self.assertEqual(list(ModelRuntime._models.keys()), [('detector', 0), ('indexer', 1)])
+            self.assertEqual((detector.allocated, indexer.allocated), (60 * MB, 60 * MB))
+        other = FakeModel(self.rss, 30 * MB)
+        ModelRuntime.acquire(('analyzer', 2), other)
+        self.assertEqual(list(ModelRuntime._models.keys()), [('indexer', 1), ('analyzer', 2)])
+        self.assertEqual(detector.allocated, 0)
+        self.assertEqual(ModelRuntime._pins, {})
+
+    def test_unpinned_models_are_evicted(self):
+        detector, indexer = FakeModel(self.rss, 60 * MB), FakeModel(self.rss, 60 * MB)
+        ModelRuntime.acquire(('detector', 0), detector)
+        ModelRuntime.acquire(('indexer', 1), indexer)
+        self.assertEqual(list(ModelRuntime._models.keys()), [('indexer', 1)])
+        self.assertEqual(detector.allocated, 0)